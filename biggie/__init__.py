@@ -5,4 +5,5 @@ A module for managing notoriously big data.
 
 from .core import Entity
 from .sources import Stash
+from .sources import ShardedStash
 from .version import version as __version__
@@ -0,0 +1,190 @@
+"""Reading and writing a Stash from asyncio code.
+
+Stash methods block on h5py, which would stall an event loop. An AsyncStash
+runs them on a dedicated, bounded executor instead, and returns entities
+read fully into memory, such that accessing them never goes to disk:
+
+>>> astash = AsyncStash(Stash('data.hdf5', mode='r'))
+>>> entity = await astash.aget('key')
+>>> async for key, entity in astash.iterate(prefetch=32):
+...     consume(entity)
+
+Concurrent reads of the same key are coalesced into a single read, so that
+thousands of lookups of a few popular keys cost a few reads.
+
+This module requires Python 3.7 or later, and is not imported by `biggie`.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import threading
+
+
+class AsyncStash(object):
+    """Asynchronous front-end to a Stash."""
+
+    def __init__(self, stash, max_workers=1, max_pending=1024):
+        """Wrap a stash.
+
+        Parameters
+        ----------
+        stash : Stash
+            Stash to read from and write to; it should not be used directly
+            while wrapped.
+
+        max_workers : int, default=1
+            Number of threads of the executor. Calls into the stash hold a
+            lock, as h5py serializes them anyway, so more threads only help
+            with the CPU work around them.
+
+        max_pending : int, default=1024
+            Maximum number of calls submitted to the executor at a time;
+            further ones wait in the event loop.
+        """
+        self.stash = stash
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self._max_pending = max_pending
+        self._slots = None
+        self._lock = threading.Lock()
+        self._reads = dict()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+
+    def __aiter__(self):
+        return self.iterate()
+
+    async def __call__(self, fx, *args, **kwargs):
+        """Run a function on the stash in the executor."""
+        if self._slots is None:
+            # Created here, to bind to the running loop.
+            self._slots = asyncio.Semaphore(self._max_pending)
+
+        def locked():
+            with self._lock:
+                return fx(*args, **kwargs)
+
+        async with self._slots:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, locked)
+
+    def __read__(self, key, fields):
+        """Read an entity into memory, or return None if missing."""
+        entity = self.stash.get(key, fields=fields)
+        return None if entity is None else entity.materialize()
+
+    async def aget(self, key, default=None, fields=None):
+        """Fetch the entity for a given key, read fully into memory.
+
+        Parameters
+        ----------
+        key : str
+            Key of the entity to get.
+
+        default : object
+            Returned for keys not in the stash.
+
+        fields : iterable of str, default=None
+            Fields to read; if None, all of them.
+
+        Returns
+        -------
+        entity : Entity
+            Entity holding the values read, or `default`.
+        """
+        fields = None if fields is None else tuple(fields)
+        read_key = (key, fields)
+        future = self._reads.get(read_key)
+        if future is None:
+            future = asyncio.ensure_future(
+                self(self.__read__, key, fields))
+            self._reads[read_key] = future
+            future.add_done_callback(
+                functools.partial(self.__forget__, read_key))
+        # Shielded, so a cancelled caller doesn't cancel the others' read.
+        entity = await asyncio.shield(future)
+        return default if entity is None else entity
+
+    def __forget__(self, read_key, future=None):
+        """Drop a read, so later requests read the key again."""
+        if future is None or self._reads.get(read_key) is future:
+            self._reads.pop(read_key, None)
+
+    def __invalidate__(self, key):
+        """Keep requests for a key from joining reads issued before now."""
+        for read_key in [k for k in self._reads if k[0] == key]:
+            self.__forget__(read_key)
+
+    async def aget_many(self, keys, fields=None):
+        """Fetch a batch of entities as stacked arrays; see `Stash.get_many`.
+        """
+        return await self(self.stash.get_many, list(keys), fields=fields)
+
+    async def aadd(self, key, entity, overwrite=False, storage=None):
+        """Add a key-entity pair to the stash; see `Stash.add`."""
+        self.__invalidate__(str(key))
+        await self(self.stash.add, key, entity, overwrite=overwrite,
+                   storage=storage)
+
+    async def aremove(self, key):
+        """Delete a key-entity pair from the stash; see `Stash.remove`."""
+        self.__invalidate__(key)
+        return await self(self.stash.remove, key)
+
+    async def akeys(self):
+        """Return a list of all keys in the stash."""
+        return await self(lambda: list(self.stash.keys()))
+
+    async def iterate(self, keys=None, prefetch=16, fields=None):
+        """Iterate over (key, entity) pairs, reading ahead.
+
+        Parameters
+        ----------
+        keys : iterable of str, default=None
+            Keys to read; if None, all keys in the stash. Missing keys raise
+            a KeyError.
+
+        prefetch : int, default=16
+            Maximum number of entities read ahead of the consumer.
+
+        fields : iterable of str, default=None
+            Fields to read; if None, all of them.
+
+        Yields
+        ------
+        key, entity : str, Entity
+            Entities in the order of `keys`.
+        """
+        if prefetch < 1:
+            raise ValueError("`prefetch` must be positive.")
+        keys = iter(await self.akeys() if keys is None else keys)
+        pending = collections.deque()
+        try:
+            while True:
+                while len(pending) < prefetch:
+                    key = next(keys, None)
+                    if key is None:
+                        break
+                    pending.append((key, asyncio.ensure_future(
+                        self.aget(key, fields=fields))))
+                if not pending:
+                    break
+                key, future = pending.popleft()
+                entity = await future
+                if entity is None:
+                    raise KeyError("The key '{}' does not exist."
+                                   "".format(key))
+                yield key, entity
+        finally:
+            for key, future in pending:
+                future.cancel()
+
+    async def aclose(self):
+        """Close the stash and shut down the executor."""
+        await self(self.stash.close)
+        self._executor.shutdown()
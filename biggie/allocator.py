@@ -0,0 +1,201 @@
+"""Allocation of internal addresses for the entities of a Stash.
+
+Addresses are computed arithmetically from an integer index (see
+`util.uniform_hexkey`), so an allocator only needs to track two things: the
+high-water mark, i.e. the next never-used index, and a free list of indices
+released by removals. Both persist in the HDF5 file, so reopening a stash
+resumes allocation in constant time, and disjoint ranges of indices can be
+reserved up front for independent writers.
+"""
+
+import numpy as np
+
+import biggie.util as util
+
+
+class AddressRange(object):
+    """Contiguous, picklable range of addresses reserved from an allocator."""
+
+    def __init__(self, start, stop, depth, width):
+        self.start = start
+        self.stop = stop
+        self.depth = depth
+        self.width = width
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, idx):
+        if not -len(self) <= idx < len(self):
+            raise IndexError("Index {} out of range.".format(idx))
+        idx = idx + len(self) if idx < 0 else idx
+        return util.uniform_hexkey(self.start + idx, self.depth, self.width)
+
+    def __iter__(self):
+        for index in range(self.start, self.stop):
+            yield util.uniform_hexkey(index, self.depth, self.width)
+
+    def __repr__(self):
+        return '{}<{}:{}>'.format(self.__class__.__name__,
+                                  self.start, self.stop)
+
+
+class AddressAllocator(object):
+    """Persistent, constant-time allocator of hexkey addresses.
+
+    Also an iterator, for compatibility with the generator it replaces:
+
+    >>> addr = next(allocator)
+    """
+
+    def __init__(self, root, name='__ALLOC__', depth=3, width=256,
+                 used=None):
+        """Open (or create) an allocator.
+
+        Parameters
+        ----------
+        root : callable
+            Function returning the HDF5 group (or file) holding the state.
+
+        name : str, default='__ALLOC__'
+            Name of the allocator group under `root`.
+
+        depth, width : int
+            Shape of the address tree; see `util.uniform_hexkey`.
+
+        used : callable, default=None
+            Function returning the addresses currently in use; consulted
+            only when no state exists on disk, to migrate older stashes.
+        """
+        self._root = root
+        self._name = name
+        self.depth = depth
+        self.width = width
+        self._next_index = 0
+        self._free = []
+        self._dirty = False
+        self.__load__(used)
+
+    def __getstate__(self):
+        """Pickle everything but the root, which is set by the owner."""
+        state = self.__dict__.copy()
+        state['_root'] = None
+        return state
+
+    def __load__(self, used):
+        root = self._root()
+        grp = root.get(self._name) if root else None
+        if grp is not None:
+            self._next_index = int(grp.attrs['next_index'])
+            self._free = grp['free'][()].tolist()
+            return
+
+        indices = [util.hexkey_to_index(addr, self.width)
+                   for addr in (used() if used else [])]
+        if indices:
+            self._next_index = max(indices) + 1
+            self._free = sorted(set(range(self._next_index)) - set(indices),
+                                reverse=True)
+            self._dirty = True
+
+    @property
+    def next_index(self):
+        """The high-water mark; no index at or above it has been handed out."""
+        return self._next_index
+
+    def __len__(self):
+        """Number of addresses currently allocated."""
+        return self._next_index - len(self._free)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.allocate()
+
+    next = __next__
+
+    def allocate(self):
+        """Return an unused address, preferring released ones."""
+        self._dirty = True
+        if self._free:
+            index = self._free.pop()
+        else:
+            index = self._next_index
+            self._next_index += 1
+        return util.uniform_hexkey(index, self.depth, self.width)
+
+    def allocate_many(self, count):
+        """Return a list of `count` unused addresses."""
+        split = len(self._free) - min(count, len(self._free))
+        addrs = [util.uniform_hexkey(index, self.depth, self.width)
+                 for index in reversed(self._free[split:])]
+        del self._free[split:]
+        if len(addrs) < count:
+            addrs.extend(self.reserve(count - len(addrs)))
+        self._dirty = True
+        return addrs
+
+    def reserve(self, count):
+        """Reserve a contiguous range of never-used addresses.
+
+        Ranges never overlap, so they may be handed to independent writers.
+
+        Parameters
+        ----------
+        count : int
+            Number of addresses to reserve.
+
+        Returns
+        -------
+        addrs : AddressRange
+            Iterable of the reserved addresses.
+        """
+        start = self._next_index
+        if start + count > self.width ** self.depth:
+            raise ValueError("Unique keys exhausted.")
+        self._next_index += count
+        self._dirty = True
+        return AddressRange(start, self._next_index, self.depth, self.width)
+
+    def release(self, addr):
+        """Return an address to the free list, for reuse."""
+        self._free.append(util.hexkey_to_index(addr, self.width))
+        self._dirty = True
+
+    def reconcile(self, changes):
+        """Catch up with address changes made since the state was written.
+
+        Idempotent, so changes the state already reflects are harmless.
+
+        Parameters
+        ----------
+        changes : iterable of (str, str) pairs
+            Addresses (old, new) in the order they changed, where None means
+            no address, e.g. (None, new) for an allocation.
+        """
+        free = set(self._free)
+        for old, new in changes:
+            if old is not None:
+                free.add(util.hexkey_to_index(old, self.width))
+            if new is not None:
+                index = util.hexkey_to_index(new, self.width)
+                if index >= self._next_index:
+                    free.update(range(self._next_index, index))
+                    self._next_index = index + 1
+                free.discard(index)
+        self._free = sorted(free, reverse=True)
+        self._dirty = True
+
+    def flush(self):
+        """Write the allocator state to disk."""
+        if not self._dirty:
+            return
+        grp = self._root().require_group(self._name)
+        if 'free' in grp:
+            del grp['free']
+        grp.create_dataset('free', data=np.asarray(self._free, dtype=np.int64))
+        grp.attrs['next_index'] = self._next_index
+        grp.attrs['depth'] = self.depth
+        grp.attrs['width'] = self.width
+        self._dirty = False
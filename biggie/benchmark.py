@@ -0,0 +1,465 @@
+"""Benchmarks of the hot paths of biggie.
+
+Each scenario times an operation (adding entities, reading them back, loading
+the keymap, ...) over synthetic data from `util.random_ndarray_generator`,
+across a grid of entity counts, field shapes and data types, and reports its
+throughput, latency percentiles and the peak memory (RSS) of the process.
+Scenarios run one at a time in fresh processes, so that their memory use can
+be told apart.
+
+Results are saved as JSON, for comparison across commits or machines:
+
+    $ python -m biggie.benchmark run -o before.json
+    $ git checkout my-branch
+    $ python -m biggie.benchmark run -o after.json
+    $ python -m biggie.benchmark compare before.json after.json
+
+`compare` exits with status 1 if the throughput of any scenario dropped by
+more than the given threshold (10% by default). Use `--quick` for a smaller
+grid, and `-s` to run only the scenarios whose names contain a string.
+"""
+
+from __future__ import print_function
+import argparse
+import collections
+import datetime
+import itertools
+import json
+import multiprocessing
+import numpy as np
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+
+import h5py
+from six.moves import queue
+
+import biggie.core as core
+import biggie.sources as sources
+import biggie.util as util
+import biggie.version as version
+
+try:
+    import resource
+except ImportError:
+    # Windows; peak memory isn't reported.
+    resource = None
+
+GRID = collections.OrderedDict([
+    ('num_entities', [100, 1000]),
+    ('shape', [(64,), (128, 64)]),
+    ('dtype', ['float32', 'float64'])])
+
+QUICK_GRID = collections.OrderedDict([
+    ('num_entities', [100]),
+    ('shape', [(128, 64)]),
+    ('dtype', ['float32'])])
+
+
+class Timer(object):
+    """Records the latency of each timed operation."""
+
+    def __init__(self):
+        self.latencies = []
+        self.items = 0
+        self.nbytes = 0
+
+    def time(self, fx, args=(), items=1, nbytes=0):
+        """Call a function, recording how long it took.
+
+        Parameters
+        ----------
+        fx : callable
+            Operation to time.
+
+        args : tuple, default=()
+            Positional arguments of `fx`.
+
+        items, nbytes : int, default=1, 0
+            Number of items and bytes processed by the operation, for
+            throughput.
+
+        Returns
+        -------
+        result : object
+            The return value of `fx`.
+        """
+        start = timeit.default_timer()
+        result = fx(*args)
+        self.latencies.append(timeit.default_timer() - start)
+        self.items += items
+        self.nbytes += nbytes
+        return result
+
+    def summary(self):
+        """Return the throughput and latency statistics recorded."""
+        latencies = np.asarray(self.latencies)
+        total = float(latencies.sum())
+        stats = dict(ops=len(latencies), items=self.items,
+                     nbytes=self.nbytes, total_sec=total,
+                     items_per_sec=self.items / total if total else None,
+                     bytes_per_sec=self.nbytes / total if total else None)
+        stats['latency'] = dict(
+            mean=float(latencies.mean()), min=float(latencies.min()),
+            max=float(latencies.max()), **dict(
+                ('p{}'.format(q), float(np.percentile(latencies, q)))
+                for q in (50, 90, 99)))
+        return stats
+
+
+def _entities(num_entities, shape, dtype):
+    """Yield (key, entity) pairs of synthetic data."""
+    data_gen = util.random_ndarray_generator(
+        shape, max_items=num_entities, dtype=np.dtype(dtype))
+    for idx, (key, value) in enumerate(data_gen):
+        yield str(key), core.Entity(data=value, label=idx)
+
+
+def _fill(workdir, num_entities, shape, dtype):
+    """Create a stash of synthetic data, returning its filename."""
+    filename = os.path.join(workdir, 'filled.hdf5')
+    stash = sources.Stash(filename)
+    stash.add_many(_entities(num_entities, shape, dtype))
+    stash.close()
+    return filename
+
+
+def _shuffled(keys, seed=12345):
+    keys = sorted(keys)
+    np.random.RandomState(seed).shuffle(keys)
+    return keys
+
+
+def stash_add(timer, workdir, num_entities, shape, dtype):
+    """Stash.add, one entity at a time."""
+    stash = sources.Stash(os.path.join(workdir, 'add.hdf5'))
+    for key, entity in _entities(num_entities, shape, dtype):
+        timer.time(stash.add, (key, entity), nbytes=entity.data.nbytes)
+    timer.time(stash.close, items=0)
+
+
+def stash_add_many(timer, workdir, num_entities, shape, dtype):
+    """Stash.add_many, all entities at once."""
+    items = list(_entities(num_entities, shape, dtype))
+    stash = sources.Stash(os.path.join(workdir, 'add_many.hdf5'))
+    timer.time(stash.add_many, (items,), items=len(items), nbytes=sum(
+        entity.data.nbytes for key, entity in items))
+    stash.close()
+
+
+def _get_value(stash, key):
+    return stash.get(key).data
+
+
+def stash_get(timer, workdir, num_entities, shape, dtype):
+    """Stash.get, reading each entity's array, in random order."""
+    stash = sources.Stash(_fill(workdir, num_entities, shape, dtype),
+                          mode='r')
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    for key in _shuffled(stash.keys()):
+        timer.time(_get_value, (stash, key), nbytes=nbytes)
+
+
+def stash_get_many(timer, workdir, num_entities, shape, dtype,
+                   batch_size=32):
+    """Stash.get_many, in random batches."""
+    stash = sources.Stash(_fill(workdir, num_entities, shape, dtype),
+                          mode='r')
+    keys = _shuffled(stash.keys())
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    for idx in range(0, len(keys), batch_size):
+        batch = keys[idx:idx + batch_size]
+        timer.time(stash.get_many, (batch,), items=len(batch),
+                   nbytes=nbytes * len(batch))
+
+
+def _load_keys(filename):
+    stash = sources.Stash(filename, mode='r')
+    keys = list(stash.keys())
+    stash.close()
+    return keys
+
+
+def keymap_load(timer, workdir, num_entities, repeat=10):
+    """Opening a stash and listing its keys."""
+    filename = _fill(workdir, num_entities, (1,), 'float32')
+    for _ in range(repeat):
+        timer.time(_load_keys, (filename,), items=num_entities)
+
+
+def keymap_dump(timer, workdir, num_entities, repeat=10):
+    """Writing the keymap, after adding a tenth as many keys again."""
+    stash = sources.Stash(_fill(workdir, num_entities, (1,), 'float32'))
+    count = max(num_entities // 10, 1)
+    for rep in range(repeat):
+        addrs = stash.agu.allocate_many(count)
+        stash._keymap.update(('dump{}-{}'.format(rep, idx), addr)
+                             for idx, addr in enumerate(addrs))
+        timer.time(stash._keymap.flush, items=count)
+    stash.close()
+
+
+def lazyfield_slice(timer, workdir, num_entities, shape, dtype,
+                    num_slices=1000):
+    """LazyField.slice, of a quarter of the first axis of random entities."""
+    stash = sources.Stash(_fill(workdir, num_entities, shape, dtype),
+                          mode='r')
+    fields = [stash.get(key)['data'] for key in stash.keys()]
+    rng = np.random.RandomState(12345)
+    length = max(shape[0] // 4, 1)
+    nbytes = int(np.prod((length,) + shape[1:])) * np.dtype(dtype).itemsize
+    for _ in range(num_slices):
+        field = fields[rng.randint(len(fields))]
+        start = rng.randint(shape[0] - length + 1)
+        timer.time(field.slice, (slice(start, start + length),),
+                   nbytes=nbytes)
+
+
+def uniform_hexgen(timer, workdir, num_entities, repeat=10):
+    """Generating keys with util.uniform_hexgen."""
+    for _ in range(repeat):
+        timer.time(lambda: list(itertools.islice(
+            util.uniform_hexgen(3, 256), num_entities)), items=num_entities)
+
+
+def unpack_entity_list(timer, workdir, num_entities, shape, dtype,
+                       repeat=10):
+    """util.unpack_entity_list, over entities held in memory."""
+    entities = [entity for key, entity in
+                _entities(num_entities, shape, dtype)]
+    nbytes = sum(entity.data.nbytes for entity in entities)
+    for _ in range(repeat):
+        timer.time(util.unpack_entity_list, (entities,),
+                   items=num_entities, nbytes=nbytes)
+
+
+# Scenarios, and the axes of the grid each runs over.
+SCENARIOS = collections.OrderedDict([
+    ('stash_add', (stash_add, ('num_entities', 'shape', 'dtype'))),
+    ('stash_add_many', (stash_add_many, ('num_entities', 'shape', 'dtype'))),
+    ('stash_get', (stash_get, ('num_entities', 'shape', 'dtype'))),
+    ('stash_get_many', (stash_get_many, ('num_entities', 'shape', 'dtype'))),
+    ('keymap_load', (keymap_load, ('num_entities',))),
+    ('keymap_dump', (keymap_dump, ('num_entities',))),
+    ('lazyfield_slice', (lazyfield_slice,
+                         ('num_entities', 'shape', 'dtype'))),
+    ('uniform_hexgen', (uniform_hexgen, ('num_entities',))),
+    ('unpack_entity_list', (unpack_entity_list,
+                            ('num_entities', 'shape', 'dtype')))])
+
+
+def peak_rss():
+    """Return the peak resident memory of this process in bytes, or None."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere.
+    return int(peak if sys.platform == 'darwin' else peak * 1024)
+
+
+def run_scenario(name, params):
+    """Run a scenario in this process.
+
+    Parameters
+    ----------
+    name : str
+        Name of the scenario; see `SCENARIOS`.
+
+    params : dict
+        Values of the scenario's grid axes.
+
+    Returns
+    -------
+    result : dict
+        Name, parameters and statistics of the scenario; see
+        `Timer.summary`. The peak RSS is that of the whole process so far.
+    """
+    fx = SCENARIOS[name][0]
+    timer = Timer()
+    workdir = tempfile.mkdtemp()
+    try:
+        fx(timer, workdir, **params)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    result = dict(name=name, params=dict(params), **timer.summary())
+    if 'shape' in params:
+        result['params']['shape'] = list(params['shape'])
+    result['peak_rss'] = peak_rss()
+    return result
+
+
+def _isolated_worker(name, params, results):
+    results.put(run_scenario(name, params))
+
+
+def _run_isolated(name, params):
+    """Run a scenario in a fresh process, for its own peak RSS."""
+    context = multiprocessing.get_context('spawn') \
+        if hasattr(multiprocessing, 'get_context') else multiprocessing
+    results = context.Queue()
+    worker = context.Process(target=_isolated_worker,
+                             args=(name, params, results))
+    worker.start()
+    while True:
+        try:
+            result = results.get(timeout=0.1)
+            break
+        except queue.Empty:
+            if worker.exitcode is not None:
+                raise RuntimeError("Scenario {}{} exited with code {}".format(
+                    name, dict(params), worker.exitcode))
+    worker.join()
+    return result
+
+
+def configurations(names=None, grid=None):
+    """Yield the (name, params) pairs of the scenarios to run.
+
+    Parameters
+    ----------
+    names : iterable of str, default=None
+        Substrings of the names of the scenarios to run; all if None.
+
+    grid : dict of lists, default=None
+        Values of each axis; `GRID` if None.
+    """
+    grid = GRID if grid is None else grid
+    for name, (fx, axes) in SCENARIOS.items():
+        if names and not any(n in name for n in names):
+            continue
+        for values in itertools.product(*[grid[axis] for axis in axes]):
+            yield name, collections.OrderedDict(zip(axes, values))
+
+
+def metadata():
+    """Return the versions and platform the benchmarks run with."""
+    return dict(
+        biggie=version.version, python=platform.python_version(),
+        numpy=np.__version__, h5py=h5py.version.version,
+        hdf5=h5py.version.hdf5_version, platform=platform.platform(),
+        processor=platform.processor(), cpu_count=multiprocessing.cpu_count(),
+        timestamp=datetime.datetime.utcnow().isoformat())
+
+
+def run(names=None, grid=None, isolate=True, verbose=False):
+    """Run benchmarks.
+
+    Parameters
+    ----------
+    names : iterable of str, default=None
+        Substrings of the names of the scenarios to run; all if None.
+
+    grid : dict of lists, default=None
+        Values of each axis; `GRID` if None.
+
+    isolate : bool, default=True
+        Run each scenario in a fresh process; otherwise, peak RSS is that of
+        this process.
+
+    verbose : bool, default=False
+        Print each result as it comes in.
+
+    Returns
+    -------
+    results : dict
+        Metadata ('meta') and a list of results ('results'); see
+        `run_scenario`.
+    """
+    results = []
+    for name, params in configurations(names, grid):
+        result = _run_isolated(name, params) if isolate else \
+            run_scenario(name, params)
+        results.append(result)
+        if verbose:
+            print(_format(result))
+    return dict(meta=metadata(), results=results)
+
+
+def _label(result):
+    return '{}[{}]'.format(result['name'], ', '.join(
+        '{}={}'.format(k, v) for k, v in sorted(result['params'].items())))
+
+
+def _format(result):
+    latency = result['latency']
+    rss = result['peak_rss']
+    return '{:<64} {:>12.1f} items/s  p50={:.2e}s p99={:.2e}s  rss={}'.format(
+        _label(result), result['items_per_sec'] or 0, latency['p50'],
+        latency['p99'], 'n/a' if rss is None else
+        '{:.0f}MB'.format(rss / 2. ** 20))
+
+
+def compare(baseline, current, threshold=0.1):
+    """Compare the throughput of two sets of results.
+
+    Parameters
+    ----------
+    baseline, current : dict
+        Results, as returned by `run` (or loaded from their JSON).
+
+    threshold : float, default=0.1
+        Relative drop in throughput beyond which a scenario regressed.
+
+    Returns
+    -------
+    rows : list of (str, float, bool) tuples
+        Label, ratio of current to baseline throughput, and whether it
+        regressed, for each scenario in both.
+    """
+    base = dict((_label(r), r) for r in baseline['results'])
+    rows = []
+    for result in current['results']:
+        label = _label(result)
+        if label not in base or not base[label]['items_per_sec'] or \
+                not result['items_per_sec']:
+            continue
+        ratio = result['items_per_sec'] / base[label]['items_per_sec']
+        rows.append((label, ratio, ratio < 1. - threshold))
+    return rows
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    run_parser = commands.add_parser('run', help="Run benchmarks.")
+    run_parser.add_argument('-o', '--output', default=None,
+                            help="JSON file to write the results to.")
+    run_parser.add_argument('-s', '--scenario', action='append',
+                            help="Run only scenarios containing this string.")
+    run_parser.add_argument('--quick', action='store_true',
+                            help="Use a smaller grid.")
+    run_parser.add_argument('--no-isolate', action='store_true',
+                            help="Run all scenarios in this process.")
+    compare_parser = commands.add_parser(
+        'compare', help="Compare the throughput of two result files.")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args(args)
+
+    if args.command == 'run':
+        results = run(args.scenario, QUICK_GRID if args.quick else GRID,
+                      isolate=not args.no_isolate, verbose=True)
+        if args.output:
+            with open(args.output, 'w') as fp:
+                json.dump(results, fp, indent=2)
+        return 0
+    elif args.command == 'compare':
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        with open(args.current) as fp:
+            current = json.load(fp)
+        rows = compare(baseline, current, args.threshold)
+        for label, ratio, regressed in rows:
+            print('{:<64} {:>6.2f}x{}'.format(
+                label, ratio, '  REGRESSED' if regressed else ''))
+        return int(any(regressed for _, _, regressed in rows))
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
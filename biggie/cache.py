@@ -0,0 +1,207 @@
+"""In-memory caching of Entities.
+
+A Stash can keep recently (or frequently) used entities resident in memory,
+bounded both by the number of entries and the number of bytes they occupy.
+Entities are expected to be materialized before they are cached, i.e. their
+fields should hold arrays rather than handles into an HDF5 file; otherwise a
+cache hit would still go to disk.
+"""
+
+import collections
+import sys
+
+
+def entity_nbytes(entity):
+    """Estimate the resident size of an entity, in bytes.
+
+    Parameters
+    ----------
+    entity : Entity
+        Entity to measure; fields are expected to be materialized.
+
+    Returns
+    -------
+    nbytes : int
+        Sum of the sizes of the field values.
+    """
+    nbytes = 0
+    for key in entity.keys():
+        value = entity[key].value
+        nbytes += getattr(value, 'nbytes', None) or sys.getsizeof(value)
+    return nbytes
+
+
+class EntityCache(object):
+    """Bounded key-entity cache with LRU or LFU eviction.
+
+    Either bound may be disabled by passing None; a cache with `max_items=0`
+    stores nothing, which is the default behavior of a Stash.
+    """
+    POLICIES = ('lru', 'lfu')
+
+    def __init__(self, max_items=None, max_bytes=None, policy='lru'):
+        """Create an entity cache.
+
+        Parameters
+        ----------
+        max_items : int, or None
+            Maximum number of entities to hold; None for no limit.
+
+        max_bytes : int, or None
+            Maximum number of bytes to hold; None for no limit.
+
+        policy : str, default='lru'
+            Eviction policy, one of 'lru' (least recently used) or 'lfu'
+            (least frequently used, ties broken by recency).
+        """
+        if policy not in self.POLICIES:
+            raise ValueError("Unsupported policy '{}'; must be one of {}"
+                             "".format(policy, self.POLICIES))
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.policy = policy
+
+        # key -> (entity, nbytes), ordered from least to most recently used.
+        self._data = collections.OrderedDict()
+        # LFU bookkeeping: key -> count, count -> OrderedDict of keys.
+        self._counts = dict()
+        self._buckets = dict()
+        self._min_count = 0
+
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_items != 0 and self.max_bytes != 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __getitem__(self, key):
+        """Peek at a cached entity, without touching counters or recency."""
+        return self._data[key][0]
+
+    def keys(self):
+        return self._data.keys()
+
+    def get(self, key, default=None):
+        """Fetch an entity from the cache, recording a hit or a miss.
+
+        Parameters
+        ----------
+        key : str
+            Key of the entity to get.
+
+        default : object
+            Return value for keys not in the cache.
+        """
+        if key not in self._data:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self.__touch__(key)
+        return self._data[key][0]
+
+    def put(self, key, entity, nbytes=None):
+        """Add an entity to the cache, evicting others as needed.
+
+        Entities larger than `max_bytes` are not cached at all.
+
+        Parameters
+        ----------
+        key : str
+            Key of the entity.
+
+        entity : Entity
+            Materialized entity to keep in memory.
+
+        nbytes : int, default=None
+            Size of the entity; estimated with `entity_nbytes` if not given.
+        """
+        if not self.enabled:
+            return
+        nbytes = entity_nbytes(entity) if nbytes is None else nbytes
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            return
+
+        self.pop(key)
+        while self._data and self.__overfull__(nbytes):
+            self.__evict__()
+
+        self._data[key] = (entity, nbytes)
+        self.nbytes += nbytes
+        if self.policy == 'lfu':
+            self.__count__(key, 0)
+            self._min_count = 1
+
+    def pop(self, key, default=None):
+        """Invalidate a key, returning its entity if it was cached."""
+        if key not in self._data:
+            return default
+        entity, nbytes = self._data.pop(key)
+        self.nbytes -= nbytes
+        if self.policy == 'lfu':
+            count = self._counts.pop(key)
+            del self._buckets[count][key]
+            if not self._buckets[count]:
+                del self._buckets[count]
+        return entity
+
+    def clear(self):
+        """Drop all entities, keeping the counters."""
+        self._data.clear()
+        self._counts.clear()
+        self._buckets.clear()
+        self._min_count = 0
+        self.nbytes = 0
+
+    def info(self):
+        """Return a dictionary of cache statistics."""
+        total = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, items=len(self),
+                    nbytes=self.nbytes, max_items=self.max_items,
+                    max_bytes=self.max_bytes, policy=self.policy,
+                    hit_rate=float(self.hits) / total if total else 0.0)
+
+    def __overfull__(self, nbytes):
+        """True if adding an entity of `nbytes` would exceed either bound."""
+        if self.max_items is not None and len(self._data) >= self.max_items:
+            return True
+        return (self.max_bytes is not None and
+                self.nbytes + nbytes > self.max_bytes)
+
+    def __count__(self, key, count):
+        """Move a key from the `count` frequency bucket to `count + 1`."""
+        if count:
+            del self._buckets[count][key]
+            if not self._buckets[count]:
+                del self._buckets[count]
+                if self._min_count == count:
+                    self._min_count = count + 1
+        self._counts[key] = count + 1
+        self._buckets.setdefault(
+            count + 1, collections.OrderedDict())[key] = None
+
+    def __touch__(self, key):
+        value = self._data.pop(key)
+        self._data[key] = value
+        if self.policy == 'lfu':
+            self.__count__(key, self._counts[key])
+
+    def __evict__(self):
+        if self.policy == 'lfu':
+            if self._min_count not in self._buckets:
+                self._min_count = min(self._buckets)
+            key = next(iter(self._buckets[self._min_count]))
+        else:
+            key = next(iter(self._data))
+        self.pop(key)
+        self.evictions += 1
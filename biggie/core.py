@@ -8,8 +8,65 @@ The goal of Entities / Fields is to provide a seamless de/serialization
 data structure for scaling well with potentially massive datasets.
 """
 
+import collections
+import h5py
 import numpy as np
 import six
+import sys
+import weakref
+
+
+def _read(dataset, selection=()):
+    """Read from an HDF5 dataset, returning variable-length strings as str.
+
+    Newer versions of h5py return these as bytes, unlike the data written.
+    """
+    value = dataset[selection]
+    if isinstance(value, bytes) and dataset.dtype.kind == 'O':
+        value = value.decode('utf-8')
+    return value
+
+
+def _nbytes(value):
+    """Estimate the size of a value in memory, in bytes.
+
+    Strings count by their encoded length, and arrays of objects by their
+    elements as well as the references to them.
+    """
+    if isinstance(value, six.text_type):
+        return len(value.encode('utf-8'))
+    elif isinstance(value, bytes):
+        return len(value)
+    nbytes = getattr(value, 'nbytes', None)
+    if nbytes is None:
+        return sys.getsizeof(value)
+    if value.dtype.hasobject:
+        nbytes += sum(_nbytes(item) for item in value.flat)
+    return nbytes
+
+
+def _hyperslab(selection, shape):
+    """Return the (start, count) of a selection of contiguous slices.
+
+    Returns None for selections that aren't simple hyperslabs, e.g. those
+    with integers or strides.
+    """
+    if selection is None or selection is Ellipsis:
+        return (0,) * len(shape), tuple(shape)
+    if not isinstance(selection, tuple):
+        selection = (selection,)
+    if len(selection) > len(shape) or \
+            not all(isinstance(sl, slice) for sl in selection):
+        return None
+    selection = selection + (slice(None),) * (len(shape) - len(selection))
+    start, count = [], []
+    for sl, dim in zip(selection, shape):
+        first, stop, step = sl.indices(dim)
+        if step != 1:
+            return None
+        start.append(first)
+        count.append(max(stop - first, 0))
+    return tuple(start), tuple(count)
 
 
 class Field(object):
@@ -18,6 +75,8 @@ class Field(object):
     TODO: In the future, be a bit more clever about caching data types in
     the `attrs` attribute.
     """
+    __slots__ = ('_attrs', '_value')
+
     def __init__(self, value):
         """Entity field.
 
@@ -28,11 +87,20 @@ class Field(object):
         value : object
             Supported types include all builtins and np.ndarrays.
         """
-        self._attrs = dict()
+        self._attrs = None
         self.value = value
 
+    def __getstate__(self):
+        return dict(_attrs=self._attrs, _value=self._value)
+
+    def __setstate__(self, state):
+        self._attrs = state['_attrs']
+        self._value = state['_value']
+
     @property
     def attrs(self):
+        if self._attrs is None:
+            self._attrs = dict()
         return self._attrs
 
     @property
@@ -50,6 +118,10 @@ class Field(object):
     def shape(self):
         return np.shape(self.value)
 
+    @property
+    def dtype(self):
+        return np.asarray(self.value).dtype
+
     def slice(self, slidx):
         """Return a slice of this field's value.
 
@@ -58,35 +130,187 @@ class Field(object):
         slidx : slice or tuple of slices
             Slice objects matching the dimensionality of the value.
         """
+        if isinstance(slidx, list):
+            slidx = tuple(slidx)
         return self.value[slidx]
 
+    def __getitem__(self, slidx):
+        return self.slice(slidx)
+
+    def read_direct(self, out, source_sel=None, dest_sel=None):
+        """Write (a slice of) this field's value into an existing array.
+
+        Parameters
+        ----------
+        out : np.ndarray
+            Array to write into.
+
+        source_sel : slice or tuple of slices, default=None
+            Selection of the value to read; all of it if None.
+
+        dest_sel : slice or tuple of slices, default=None
+            Selection of `out` to write to; all of it if None.
+        """
+        source_sel = Ellipsis if source_sel is None else source_sel
+        dest_sel = Ellipsis if dest_sel is None else dest_sel
+        out[dest_sel] = np.asarray(self.value)[source_sel]
+
     @classmethod
-    def from_hdf5_dataset(cls, hdf5_dataset):
+    def from_hdf5_dataset(cls, hdf5_dataset, policy='lazy', budget=None):
         """This might be poor practice."""
-        return LazyField(hdf5_dataset)
+        return LazyField(hdf5_dataset, policy=policy, budget=budget)
+
+
+class MemoryBudget(object):
+    """Shared memory accounting for memoized LazyFields.
+
+    Fields admitted to the budget hold on to their values until the total
+    would exceed `max_bytes`, at which point the least recently used values
+    are dropped (and re-read from disk on the next access).
+    """
+    def __init__(self, max_bytes):
+        """Create a memory budget.
+
+        Parameters
+        ----------
+        max_bytes : int
+            Upper bound on the bytes held by all fields sharing this budget.
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._fields = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._fields)
+
+    def admit(self, field, nbytes):
+        """Account for a field's value, evicting others to make room.
+
+        Parameters
+        ----------
+        field : LazyField
+            Field requesting to memoize its value.
+
+        nbytes : int
+            Size of the value.
+
+        Returns
+        -------
+        admitted : bool
+            False if the value can never fit in the budget.
+        """
+        if nbytes > self.max_bytes:
+            return False
+        self.release(field)
+        while self._fields and self.nbytes + nbytes > self.max_bytes:
+            ref, size = self._fields.popitem(last=False)[1]
+            self.nbytes -= size
+            if ref() is not None:
+                ref()._value = None
+        # Values of garbage-collected fields no longer count against the
+        # budget; the identity check guards against re-admitted fields.
+        field_id = id(field)
+
+        def collect(ref):
+            entry = self._fields.get(field_id)
+            if entry is not None and entry[0] is ref:
+                self.__release__(field_id)
+
+        self._fields[field_id] = (weakref.ref(field, collect), nbytes)
+        self.nbytes += nbytes
+        return True
+
+    def touch(self, field):
+        """Mark a field's value as recently used."""
+        if id(field) in self._fields:
+            self._fields[id(field)] = self._fields.pop(id(field))
+
+    def release(self, field):
+        """Stop accounting for a field's value."""
+        self.__release__(id(field))
+
+    def __release__(self, field_id):
+        if field_id in self._fields:
+            self.nbytes -= self._fields.pop(field_id)[1]
 
 
 class LazyField(Field):
     """Lazy-loading Field for reading data from HDF5 files.
 
-    Like a Field, but returns information as needed, wrapping h5py types."""
-    def __init__(self, hdf5_dataset):
+    Like a Field, but returns information as needed, wrapping h5py types.
+
+    The read policy determines what happens to values once read:
+      'lazy' : Never keep them; every access goes to disk.
+      'memoize' : Keep them after the first read.
+      'budget' : Keep them while they fit in a shared `MemoryBudget`.
+
+    Slicing (via `slice`, or indexing the field itself) reads only the
+    requested hyperslab from disk, unless the full value is held in memory.
+    """
+    POLICIES = ('lazy', 'memoize', 'budget')
+    __slots__ = ('_dataset', '_policy', '_budget', '__weakref__')
+
+    def __init__(self, hdf5_dataset, policy='lazy', budget=None):
+        """Wrap an HDF5 dataset.
+
+        Parameters
+        ----------
+        hdf5_dataset : h5py.Dataset
+            Dataset holding the field's value.
+
+        policy : str, default='lazy'
+            Read policy, one of 'lazy', 'memoize', or 'budget'.
+
+        budget : MemoryBudget, default=None
+            Shared memory budget; required for the 'budget' policy.
+        """
+        if policy not in self.POLICIES:
+            raise ValueError("Unsupported policy '{}'; must be one of {}"
+                             "".format(policy, self.POLICIES))
+        if policy == 'budget' and budget is None:
+            raise ValueError("The 'budget' policy requires a MemoryBudget.")
         self._dataset = hdf5_dataset
         self._value = None
-        self._attrs = dict()
+        self._attrs = None
+        self._policy = policy
+        self._budget = budget
+
+    def __getstate__(self):
+        raise TypeError("LazyFields can't be pickled; materialize the "
+                        "entity first.")
+
+    @property
+    def policy(self):
+        return self._policy
 
     @property
     def value(self):
         """LazyFields only pull data into the namespace when accessed."""
-        # if self._value is None:
-        #     self._value = self._dataset.value
-        # return self._value
-        return self._dataset.value
+        if self._value is not None:
+            if self._budget is not None:
+                self._budget.touch(self)
+            return self._value
+
+        value = self.__read__()
+        if self._policy == 'memoize':
+            self._value = value
+        elif self._policy == 'budget':
+            if self._budget.admit(self, _nbytes(value)):
+                self._value = value
+        return value
+
+    def __read__(self):
+        """Read the full value from disk."""
+        return _read(self._dataset)
 
     @property
     def shape(self):
         return np.shape(self._dataset)
 
+    @property
+    def dtype(self):
+        return self._dataset.dtype
+
     @property
     def attrs(self):
         """Manual override for pulling attributes into the namespace."""
@@ -95,9 +319,148 @@ class LazyField(Field):
         return self._attrs
 
     def slice(self, slidx):
+        if isinstance(slidx, list):
+            slidx = tuple(slidx)
+        if self._value is not None:
+            return self.value[slidx]
         return self._dataset[slidx]
-        # if self._value is None \
-        #     else self._value[slidx]
+
+    def read_direct(self, out, source_sel=None, dest_sel=None):
+        if self._value is not None or out.dtype.hasobject:
+            return Field.read_direct(self, out, source_sel, dest_sel)
+
+        # Read contiguous hyperslabs into contiguous destinations with the
+        # low-level API, sidestepping the high-level selection machinery.
+        if dest_sel is None:
+            dest = out
+        else:
+            dest_sel = dest_sel if isinstance(dest_sel, tuple) else (dest_sel,)
+            dest = out[dest_sel + (Ellipsis,)]
+        dsid = self._dataset.id
+        slab = _hyperslab(source_sel, dsid.shape)
+        if slab is None or slab[1] != dest.shape or \
+                not dest.flags.c_contiguous or not dest.size:
+            return self._dataset.read_direct(out, source_sel, dest_sel)
+
+        if source_sel is None:
+            dsid.read(h5py.h5s.ALL, h5py.h5s.ALL, dest)
+        else:
+            fspace = dsid.get_space()
+            fspace.select_hyperslab(*slab)
+            dsid.read(h5py.h5s.create_simple(dest.shape), fspace, dest)
+
+
+class DeferredField(LazyField):
+    """LazyField of a group member, whose dataset is opened on first use.
+
+    Opening a dataset costs far more than listing its name, so entities
+    loaded from a group only pay for the fields actually accessed.
+    """
+    __slots__ = ('_group', '_name')
+
+    def __init__(self, group, name, policy='lazy', budget=None):
+        """Refer to a member of an HDF5 group.
+
+        Parameters
+        ----------
+        group : h5py.Group
+            Group holding the field's dataset.
+
+        name : str
+            Name of the dataset in the group.
+
+        policy, budget : str, MemoryBudget
+            Read policy and memory budget; see `LazyField`.
+        """
+        LazyField.__init__(self, None, policy=policy, budget=budget)
+        self._group = group
+        self._name = name
+
+    @property
+    def _dataset(self):
+        dataset = _DATASET.__get__(self)
+        if dataset is None:
+            dataset = self._group[self._name]
+            _DATASET.__set__(self, dataset)
+        return dataset
+
+    @_dataset.setter
+    def _dataset(self, dataset):
+        _DATASET.__set__(self, dataset)
+
+
+# Slot of the dataset of a LazyField, shadowed by DeferredField.
+_DATASET = LazyField._dataset
+
+
+class Schema(object):
+    """Ordered field names, shared by all entities with the same fields.
+
+    Schemas are interned, so entities with the same fields (e.g. those loaded
+    from the same Stash) share a single table of keys and their positions,
+    and only hold a list of their Fields. Adding a field moves an entity to
+    the schema with the key appended, which is found in constant time.
+
+    Tables of schemas hold them weakly: a schema lives as long as an entity
+    (or another table entry) uses it.
+    """
+    __slots__ = ('keys', 'index', '_children', '__weakref__')
+    __TABLE__ = weakref.WeakValueDictionary()
+    # Schemas keyed by the raw (encoded) member names of HDF5 groups.
+    __GROUPS__ = weakref.WeakValueDictionary()
+
+    def __init__(self, keys):
+        self.keys = tuple(keys)
+        self.index = dict((key, n) for n, key in enumerate(self.keys))
+        self._children = weakref.WeakValueDictionary()
+
+    @classmethod
+    def get(cls, keys):
+        """Return the schema for the given field names, in order."""
+        keys = tuple(keys)
+        schema = cls.__TABLE__.get(keys)
+        if schema is None:
+            schema = cls.__TABLE__[keys] = cls(keys)
+        return schema
+
+    @classmethod
+    def of_group(cls, group):
+        """Return the schema of the members of an HDF5 group, by name.
+
+        Names are listed with a single low-level iteration, and decoded only
+        the first time a set of names is seen.
+        """
+        links = []
+        group.id.links.iterate(links.append)
+        links = tuple(links)
+        schema = cls.__GROUPS__.get(links)
+        if schema is None:
+            schema = cls.__GROUPS__[links] = cls.get(
+                link.decode('utf-8') for link in links)
+        return schema
+
+    def add(self, key):
+        """Return the schema with a key appended."""
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = self.get(self.keys + (key,))
+        return child
+
+    def remove(self, key):
+        """Return the schema without a key."""
+        return self.get([k for k in self.keys if k != key])
+
+
+def _group_schema(group, fields=None):
+    """Return the schema of the given fields of an HDF5 group, or of all its
+    members if None, raising a KeyError for missing fields."""
+    if fields is None:
+        return Schema.of_group(group)
+    schema = Schema.get(fields)
+    for key in schema.keys:
+        if not group.id.links.exists(key.encode('utf-8')):
+            raise KeyError(key)
+    return schema
 
 
 class Entity(object):
@@ -113,17 +476,40 @@ class Entity(object):
     >>> x['a'].value == 3
     True
 
+    Entities are compact: the names of the fields live in a `Schema` shared
+    with all entities of the same fields, while an entity only holds a list
+    of its Fields.
+
     See tests/test_core.py for more examples.
     """
+    __slots__ = ('_schema', '_fields')
+
     def __init__(self, **kwargs):
-        object.__init__(self)
-        for key, value in six.iteritems(kwargs):
-            self[key] = value
+        object.__setattr__(self, '_schema', Schema.get(kwargs.keys()))
+        object.__setattr__(
+            self, '_fields', [Field(value) for value in kwargs.values()])
 
     def __repr__(self):
         """Render the Field names of the Entity as a string."""
         return '{}<{}>'.format(self.__class__.__name__, ", ".join(self.keys()))
 
+    def __getstate__(self):
+        return dict(zip(_get_schema(self).keys, _get_fields(self)))
+
+    def __setstate__(self, state):
+        Entity.__init__(self)
+        for key, field in six.iteritems(state):
+            self.__set_field__(key, field)
+
+    def __set_field__(self, key, field):
+        """Set the Field for the given key."""
+        idx = _get_schema(self).index.get(key)
+        if idx is None:
+            object.__setattr__(self, '_schema', _get_schema(self).add(key))
+            _get_fields(self).append(field)
+        else:
+            _get_fields(self)[idx] = field
+
     def __setitem__(self, key, value):
         """Set value for the given key.
 
@@ -135,7 +521,7 @@ class Entity(object):
         value: scalar, string, list, or np.ndarray
             Data corresponding to the given key, stored as a Field.
         """
-        self.__dict__[key] = Field(value)
+        self.__set_field__(key, Field(value))
 
     def __setattr__(self, key, value):
         """Set value for key.
@@ -152,45 +538,94 @@ class Entity(object):
 
     def __getitem__(self, key):
         """Get value for key."""
-        return self.__dict__[key]
+        idx = _get_schema(self).index.get(key)
+        if idx is None:
+            raise KeyError(key)
+        return _get_fields(self)[idx]
 
     def __getattribute__(self, key):
-        """Unnecessary, but could make Fields more transparent?"""
-        obj = object.__getattribute__(self, key)
-        if isinstance(obj, Field) or isinstance(obj, LazyField):
-            # Back out Fields transparently.
-            obj = obj.value
-        return obj
+        """Back out Fields transparently; fields shadow everything else."""
+        try:
+            idx = _get_schema(self).index.get(key)
+        except AttributeError:
+            # Not yet initialized, e.g. while unpickling.
+            idx = None
+        if idx is None:
+            return object.__getattribute__(self, key)
+        return _get_fields(self)[idx].value
 
     def __delitem__(self, key):
         """Remove an attribute from the Entity."""
-        del self.__dict__[key]
+        idx = _get_schema(self).index.get(key)
+        if idx is None:
+            raise KeyError(key)
+        del _get_fields(self)[idx]
+        object.__setattr__(self, '_schema', _get_schema(self).remove(key))
 
     def __len__(self):
-        return len(self.keys())
+        return len(_get_fields(self))
 
     def get(self, key):
         return getattr(self, key)
 
     def keys(self):
         """Returns a list of field names (keys) of the entity."""
-        return self.__dict__.keys()
+        return list(_get_schema(self).keys)
 
     def values(self):
         """Returns a list of the values in the entity."""
-        return [self[k].value for k in self.keys()]
+        return [field.value for field in _get_fields(self)]
 
     def items(self):
         """Return the (key, value) items of the entity."""
-        return [(k, getattr(self, k)) for k in self.keys()]
+        return list(zip(_get_schema(self).keys, self.values()))
 
     def todict(self):
         return {k: v for k, v in self.items()}
 
+    def materialize(self):
+        """Return a copy of the entity with all values read into memory.
+
+        Useful for holding on to entities loaded from a Stash, which would
+        otherwise return to disk on every access of a lazy field.
+        """
+        return self.__class__(**self.todict())
+
     @classmethod
-    def from_hdf5_group(cls, group):
-        """writeme."""
+    def from_hdf5_group(cls, group, policy='lazy', budget=None, fields=None):
+        """Create an entity of LazyFields from an HDF5 group.
+
+        Datasets are only opened once their fields are first accessed; see
+        `DeferredField`.
+
+        Parameters
+        ----------
+        group : h5py.Group
+            Group holding one dataset per field.
+
+        policy : str, default='lazy'
+            Read policy of the fields; see `LazyField`.
+
+        budget : MemoryBudget, default=None
+            Memory budget shared by the fields, for the 'budget' policy.
+
+        fields : iterable of str, default=None
+            Fields to load, in order; if None, all members of the group.
+
+        Raises
+        ------
+        KeyError
+            If the group lacks any of the given fields.
+        """
+        schema = _group_schema(group, fields)
         new_grp = cls()
-        for key in group:
-            new_grp.__dict__[key] = Field.from_hdf5_dataset(group[key])
+        object.__setattr__(new_grp, '_schema', schema)
+        object.__setattr__(new_grp, '_fields', [
+            DeferredField(group, key, policy=policy, budget=budget)
+            for key in schema.keys])
         return new_grp
+
+
+# Direct slot access, bypassing `Entity.__getattribute__`.
+_get_schema = Entity._schema.__get__
+_get_fields = Entity._fields.__get__
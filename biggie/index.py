@@ -0,0 +1,407 @@
+"""Secondary indexes on the scalar fields of the entities in a Stash.
+
+Selecting entities by the value of a field, e.g. all those with
+`label == 3`, would otherwise read that field of every entity. An index
+keeps the values of chosen fields in columns, one row per entity:
+
+    __INDEX__/keys : Key of the entity in each row.
+    __INDEX__/live : Whether a row holds an entity.
+    __INDEX__/<field>/values : Value of the field in each row.
+    __INDEX__/<field>/present : Whether the entity in a row has the field.
+
+As in the packed layout, rows are the integer indices of the entities'
+addresses. Only scalars (numbers, booleans and strings) can be indexed.
+
+Columns are read into memory on first use, and kept up to date by the
+stash as entities are added and removed; `flush` writes the rows changed
+since the last one. Selections evaluate an expression over whole columns
+with NumPy:
+
+>>> stash.create_index('label')
+>>> stash.create_index('duration')
+>>> stash.select('(label == 3) & (duration > 10)')
+['key17', 'key42', ...]
+"""
+
+import h5py
+import numpy as np
+import six
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+
+def _column_dtype(value):
+    """Return the dtype of the column indexing a scalar value."""
+    if value.ndim:
+        raise ValueError("Only scalars can be indexed; received an array of "
+                         "shape {}".format(value.shape))
+    if value.dtype.kind in 'SUO':
+        return np.dtype(object)
+    elif value.dtype.kind == 'b':
+        return np.dtype(bool)
+    elif value.dtype.kind in 'iu':
+        return np.dtype(np.int64)
+    elif value.dtype.kind == 'f':
+        return np.dtype(np.float64)
+    raise ValueError("Unsupported type for an index: {}".format(value.dtype))
+
+
+def _read_strings(dataset):
+    """Read a dataset of variable-length strings as an array of str.
+
+    Newer versions of h5py return these as bytes; see `core._read`.
+    """
+    values = np.asarray(dataset[()], dtype=object)
+    for idx, value in enumerate(values):
+        if isinstance(value, bytes):
+            values[idx] = value.decode('utf-8')
+    return values
+
+
+def _convert(value, dtype):
+    """Convert a scalar value for a column of the given dtype."""
+    value = np.asarray(value)
+    kind = _column_dtype(value).kind
+    if dtype.kind == 'O':
+        if kind != 'O':
+            raise ValueError("Expected a string, received {}".format(value))
+        value = value[()]
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+    elif kind == 'O' or not np.can_cast(value.dtype, dtype, 'same_kind'):
+        raise ValueError("Expected a value of type {}, received {}"
+                         "".format(dtype, value))
+    return value.astype(dtype)[()]
+
+
+class Columns(Mapping):
+    """Mapping from indexed fields to their columns, noting those used."""
+
+    def __init__(self, index):
+        self._index = index
+        self.used = set()
+
+    def __getitem__(self, field):
+        if field not in self._index._columns:
+            raise KeyError("No index on field '{}'; see `create_index`."
+                           "".format(field))
+        self.used.add(field)
+        return self._index._columns[field][0][:self._index._num_rows]
+
+    def __iter__(self):
+        return iter(self._index._columns)
+
+    def __len__(self):
+        return len(self._index._columns)
+
+
+class SecondaryIndex(object):
+    """Columns of the values of indexed fields, by row."""
+
+    def __init__(self, root, name='__INDEX__'):
+        """Open (or create) the indexes of a stash.
+
+        Parameters
+        ----------
+        root : callable
+            Function returning the HDF5 group (or file) holding the indexes.
+
+        name : str, default='__INDEX__'
+            Name of the indexes' group under `root`.
+        """
+        self._root = root
+        self._name = name
+        self._keys = None
+        self._live = None
+        self._columns = dict()
+        self._num_rows = 0
+        self._dirty = None
+        self._fields = []
+        root = self._root()
+        grp = root.get(self._name) if root else None
+        if grp is not None:
+            self._fields = sorted(k for k, v in six.iteritems(grp)
+                                  if isinstance(v, h5py.Group))
+
+    def __getstate__(self):
+        """Pickle everything but the root and the columns."""
+        state = self.__dict__.copy()
+        state['_root'] = None
+        state['_keys'] = None
+        state['_live'] = None
+        state['_columns'] = dict()
+        state['_dirty'] = None
+        return state
+
+    @property
+    def fields(self):
+        """Names of the indexed fields."""
+        return list(self._fields)
+
+    def __load__(self):
+        """Read the columns into memory, unless done already."""
+        if self._keys is not None:
+            return
+        grp = self._root().get(self._name)
+        if grp is None:
+            self._keys = np.empty(0, dtype=object)
+            self._live = np.zeros(0, dtype=bool)
+            return
+        self._keys = _read_strings(grp['keys'])
+        # Older files marked unused rows with empty keys.
+        self._live = grp['live'][()] if 'live' in grp else self._keys != ''
+        self._num_rows = len(self._keys)
+        for field in self._fields:
+            values, present = grp[field]['values'], grp[field]['present']
+            if values.dtype.kind == 'O':
+                values = _read_strings(values)
+            else:
+                values = values[()]
+            self._columns[field] = [values, present[()]]
+
+    def __grow__(self, row):
+        """Make room for a row in all columns."""
+        size = len(self._keys)
+        if row < size:
+            return
+        size = max(row + 1, 2 * size)
+        self._keys = self.__resize__(self._keys, size, '')
+        self._live = self.__resize__(self._live, size, False)
+        for column in self._columns.values():
+            column[0] = self.__resize__(column[0], size,
+                                        '' if column[0].dtype.kind == 'O'
+                                        else 0)
+            column[1] = self.__resize__(column[1], size, False)
+
+    def __resize__(self, arr, size, fill):
+        grown = np.empty(size, dtype=arr.dtype)
+        grown.fill(fill)
+        grown[:len(arr)] = arr
+        return grown
+
+    def __touch__(self, row):
+        """Mark a row as changed since the last flush."""
+        lo, hi = self._dirty or (row, row + 1)
+        self._dirty = (min(lo, row), max(hi, row + 1))
+
+    def extract(self, entity):
+        """Return the values of the indexed fields of an entity, converted.
+
+        Raises a ValueError for values that can't be indexed, so that
+        entities may be checked before they're written.
+
+        Parameters
+        ----------
+        entity : Entity or dict
+            Entity, or its fields.
+
+        Returns
+        -------
+        values : dict
+            Values of the indexed fields the entity has.
+        """
+        if not self._fields:
+            return dict()
+        self.__load__()
+        fields = entity if isinstance(entity, dict) else dict(
+            (field, entity[field]) for field in entity.keys())
+        values = dict()
+        for field in self._fields:
+            if field in fields:
+                value = fields[field]
+                value = getattr(value, 'value', value)
+                try:
+                    values[field] = _convert(
+                        value, self._columns[field][0].dtype)
+                except ValueError as derp:
+                    raise ValueError("Can't index field '{}': {}"
+                                     "".format(field, derp))
+        return values
+
+    def put(self, row, key, values):
+        """Set the row of an entity.
+
+        Parameters
+        ----------
+        row : int
+            Row of the entity.
+
+        key : str
+            Key of the entity.
+
+        values : dict
+            Values of its indexed fields, as returned by `extract`.
+        """
+        if not self._fields:
+            return
+        self.__load__()
+        self.__grow__(row)
+        self._keys[row] = key
+        self._live[row] = True
+        for field, (column, present) in six.iteritems(self._columns):
+            column[row] = values.get(
+                field, '' if column.dtype.kind == 'O' else 0)
+            present[row] = field in values
+        self._num_rows = max(self._num_rows, row + 1)
+        self.__touch__(row)
+
+    def remove(self, row):
+        """Clear the row of an entity."""
+        if not self._fields:
+            return
+        self.__load__()
+        if row < self._num_rows:
+            self._keys[row] = ''
+            self._live[row] = False
+            for column, present in self._columns.values():
+                present[row] = False
+            self.__touch__(row)
+
+    def row(self, row):
+        """Return the values of the indexed fields in a row, as a dict."""
+        if not self._fields:
+            return dict()
+        self.__load__()
+        if row >= self._num_rows:
+            return dict()
+        return dict((field, column[row])
+                    for field, (column, present) in
+                    six.iteritems(self._columns) if present[row])
+
+    def dtype(self, field):
+        """Return the dtype of the column of an indexed field."""
+        if field not in self._fields:
+            raise KeyError("No index on field '{}'.".format(field))
+        self.__load__()
+        return self._columns[field][0].dtype
+
+    def create(self, field, items, dtype=None):
+        """Index a field.
+
+        Parameters
+        ----------
+        field : str
+            Field to index; must not be indexed already.
+
+        items : iterable of (int, str, object) triples
+            Row, key and value of every entity with the field.
+
+        dtype : np.dtype, default=None
+            Type of the column; if None, derived from the first value.
+        """
+        self.__load__()
+        rows, keys, values = [], [], []
+        for row, key, value in items:
+            if dtype is None:
+                dtype = _column_dtype(np.asarray(value))
+            try:
+                values.append(_convert(value, dtype))
+            except ValueError as derp:
+                raise ValueError("Can't index field '{}' of '{}': {}"
+                                 "".format(field, key, derp))
+            rows.append(row)
+            keys.append(key)
+        if dtype is None:
+            raise ValueError("No entity has the field '{}'; can't determine "
+                             "the type of its index.".format(field))
+
+        size = len(self._keys)
+        column = np.empty(size, dtype=dtype)
+        column.fill('' if dtype.kind == 'O' else 0)
+        self._columns[field] = [column, np.zeros(size, dtype=bool)]
+        if rows:
+            self.__grow__(max(rows))
+            column, present = self._columns[field]
+            column[rows] = values
+            present[rows] = True
+            self._keys[rows] = keys
+            self._live[rows] = True
+            self._num_rows = max(self._num_rows, max(rows) + 1)
+        self._fields = sorted(self._columns)
+        self._dirty = (0, self._num_rows)
+
+        grp = self._root().require_group(self._name)
+        if field in grp:
+            del grp[field]
+        self.flush()
+
+    def drop(self, field):
+        """Remove the index of a field."""
+        if field not in self._fields:
+            raise KeyError("No index on field '{}'.".format(field))
+        self.__load__()
+        del self._columns[field]
+        self._fields.remove(field)
+        grp = self._root()[self._name]
+        del grp[field]
+        if not self._fields:
+            del self._root()[self._name]
+            self._keys = np.empty(0, dtype=object)
+            self._live = np.zeros(0, dtype=bool)
+            self._num_rows = 0
+            self._dirty = None
+
+    def select(self, expr):
+        """Return the keys of the entities matching an expression.
+
+        Parameters
+        ----------
+        expr : str or callable
+            Expression over the columns of the indexed fields, evaluating to
+            a boolean array; either a string, in which fields are names
+            (e.g. `'(label == 3) & (duration > 10)'`, with `np` for NumPy),
+            or a function of a mapping from fields to columns. Entities
+            without a field used by the expression never match.
+
+            String expressions are evaluated with `eval`, which is no
+            sandbox even without builtins: they must come from trusted
+            input. Build a callable instead for anything else, e.g.
+            `lambda fields: fields['name'] == user_input`.
+
+        Returns
+        -------
+        keys : list of str
+            Keys of the matching entities, in the order of their rows.
+        """
+        self.__load__()
+        columns = Columns(self)
+        if callable(expr):
+            mask = expr(columns)
+        else:
+            mask = eval(expr, {'__builtins__': {}, 'np': np}, columns)
+        keys = self._keys[:self._num_rows]
+        mask = np.asarray(mask, dtype=bool) & self._live[:self._num_rows]
+        for field in columns.used:
+            mask &= self._columns[field][1][:self._num_rows]
+        return keys[mask].tolist()
+
+    def flush(self):
+        """Write the rows changed since the last flush to disk."""
+        if self._dirty is None:
+            return
+        lo, hi = self._dirty
+        grp = self._root().require_group(self._name)
+        text = h5py.special_dtype(vlen=six.text_type)
+        self.__write__(grp, 'keys', self._keys, text, lo, hi)
+        self.__write__(grp, 'live', self._live, bool, lo, hi)
+        for field, (column, present) in six.iteritems(self._columns):
+            fgrp = grp.require_group(field)
+            self.__write__(fgrp, 'values', column, text
+                           if column.dtype.kind == 'O' else column.dtype,
+                           lo, hi)
+            self.__write__(fgrp, 'present', present, bool, lo, hi)
+        self._dirty = None
+
+    def __write__(self, grp, name, arr, dtype, lo, hi):
+        """Write rows [lo, hi) of a column, growing its dataset as needed."""
+        if name not in grp:
+            grp.create_dataset(name, shape=(0,), maxshape=(None,),
+                               chunks=(4096,), dtype=dtype)
+            lo, hi = 0, self._num_rows
+        dset = grp[name]
+        if dset.shape[0] < self._num_rows:
+            dset.resize((self._num_rows,))
+        if hi > lo:
+            dset[lo:hi] = arr[lo:hi]
@@ -0,0 +1,386 @@
+"""Ingesting entities from many producer processes through a single writer.
+
+HDF5 files take one writer at a time, so processes computing entities in
+parallel would otherwise serialize on `Stash.add`. Instead, an Ingestor
+starts a dedicated writer process, which owns the stash; producers hand it
+(key, entity) pairs over a bounded queue, and get on with the next one:
+
+>>> with Ingestor('features.hdf5') as ingestor:
+...     pool = multiprocessing.Pool(
+...         8, initializer=init_worker, initargs=(ingestor.producer,))
+...     pool.map(extract_features, filenames)
+...     pool.close()
+...     pool.join()
+
+where each worker keeps the producer given to `init_worker`, and calls its
+`send` method for every entity it computes. Producers must be handed to
+processes as they are created, like any multiprocessing queue.
+
+Arrays of at least `shm_threshold` bytes travel through shared memory,
+rather than being pickled through the queue; the writer writes them to disk
+straight from there. Entities are written through a `BulkWriter`, committed
+every `batch_size` entities or `interval` seconds, whichever comes first.
+
+Once `max_pending` entities wait in the queue, producers block until the
+writer catches up, which bounds the memory held by entities in flight.
+Progress (entities and bytes written, throughput, and failures) is reported
+on every commit; see `Ingestor.progress`.
+"""
+
+import collections
+import logging
+import multiprocessing
+import numpy as np
+import threading
+import time
+import traceback
+
+from six.moves import queue
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    # Python < 3.8; arrays are pickled through the queue.
+    resource_tracker = shared_memory = None
+
+import biggie.core as core
+
+# Descriptor of an array in a shared memory block.
+SharedArray = collections.namedtuple('SharedArray', ['name', 'shape', 'dtype'])
+
+
+def _create_shm(nbytes):
+    """Create a shared memory block, to be unlinked by the writer."""
+    try:
+        return shared_memory.SharedMemory(create=True, size=nbytes,
+                                          track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        # Keep this process's resource tracker from unlinking it as well.
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+def _release_shm(shm):
+    """Close and unlink a shared memory block."""
+    try:
+        shm.close()
+    except BufferError:
+        # Still viewed, e.g. from a traceback; unmapped once collected.
+        pass
+    shm.unlink()
+
+
+class Producer(object):
+    """Sends entities to the writer of an Ingestor; safe to share."""
+
+    def __init__(self, messages, shm_threshold=2 ** 16):
+        """Create a producer.
+
+        Parameters
+        ----------
+        messages : multiprocessing.Queue
+            Queue read by the writer.
+
+        shm_threshold : int, default=2**16
+            Arrays of at least this many bytes are passed through shared
+            memory; None to always pickle them.
+        """
+        self._messages = messages
+        self.shm_threshold = shm_threshold
+
+    def __encode__(self, entity, shms):
+        """Return the (field, value) pairs of an entity, sharing arrays."""
+        fields = []
+        for field, value in entity.items():
+            if shared_memory is not None and \
+                    self.shm_threshold is not None and \
+                    isinstance(value, np.ndarray) and \
+                    not value.dtype.hasobject and \
+                    value.nbytes >= max(self.shm_threshold, 1):
+                shm = _create_shm(value.nbytes)
+                shms.append(shm)
+                np.ndarray(value.shape, dtype=value.dtype,
+                           buffer=shm.buf)[...] = value
+                value = SharedArray(shm.name, value.shape, value.dtype.str)
+            fields.append((field, value))
+        return fields
+
+    def send(self, key, entity, timeout=None):
+        """Queue a key-entity pair for writing.
+
+        Blocks while the writer is `max_pending` entities behind.
+
+        Parameters
+        ----------
+        key : str
+            Key to write the entity under.
+
+        entity : Entity or dict
+            Data to write.
+
+        timeout : float, default=None
+            Seconds to wait for room in the queue; forever if None.
+
+        Raises
+        ------
+        queue.Full
+            If the queue is still full after `timeout` seconds.
+        """
+        shms = []
+        try:
+            fields = self.__encode__(entity, shms)
+            self._messages.put((str(key), fields), timeout=timeout)
+        except BaseException:
+            for shm in shms:
+                _release_shm(shm)
+            raise
+        for shm in shms:
+            shm.close()
+
+
+def _decode(fields, shms):
+    """Rebuild an entity from its message, viewing shared arrays in place."""
+    values = dict()
+    for field, value in fields:
+        if isinstance(value, SharedArray):
+            shm = shared_memory.SharedMemory(name=value.name)
+            shms.append(shm)
+            value = np.ndarray(value.shape, dtype=np.dtype(value.dtype),
+                               buffer=shm.buf)
+        values[field] = value
+    return core.Entity(**values)
+
+
+def _writer_main(filename, stash_kwargs, messages, reports, batch_size,
+                 interval, overwrite, max_failures):
+    """Write entities from the queue until a None arrives."""
+    import biggie.sources as sources
+
+    stash = sources.Stash(filename, **stash_kwargs)
+    writer = stash.bulk_writer(overwrite=overwrite)
+    status = dict(count=0, nbytes=0, commits=0, failures=0, failed=[],
+                  done=False)
+    start = last_commit = time.time()
+    uncommitted = 0
+
+    def report():
+        elapsed = time.time() - start
+        status.update(elapsed=elapsed,
+                      entities_per_sec=status['count'] / max(elapsed, 1e-9),
+                      bytes_per_sec=status['nbytes'] / max(elapsed, 1e-9))
+        reports.put(dict(status, failed=list(status['failed'])))
+
+    while True:
+        try:
+            message = messages.get(timeout=interval)
+        except queue.Empty:
+            message = False
+        if message is None:
+            break
+        if message:
+            key, fields = message
+            shms = []
+            try:
+                entity = _decode(fields, shms)
+                writer.add(key, entity)
+                status['count'] += 1
+                status['nbytes'] += sum(np.asarray(v).nbytes
+                                        for v in entity.values())
+                uncommitted += 1
+            except Exception as derp:
+                status['failures'] += 1
+                status['failed'].append((key, "{}: {}".format(
+                    derp.__class__.__name__, derp)))
+                del status['failed'][:-max_failures]
+            finally:
+                entity = None
+                for shm in shms:
+                    _release_shm(shm)
+        if uncommitted >= batch_size or (
+                uncommitted and time.time() - last_commit >= interval):
+            writer.commit()
+            status['commits'] += 1
+            uncommitted, last_commit = 0, time.time()
+            report()
+
+    writer.commit()
+    stash.close()
+    status['commits'] += 1
+    status['done'] = True
+    report()
+
+
+class Ingestor(object):
+    """Single writer process, adding entities sent by any number of others.
+    """
+
+    def __init__(self, filename, max_pending=256, batch_size=1024,
+                 interval=1.0, overwrite=False, shm_threshold=2 ** 16,
+                 callback=None, max_failures=100, **kwargs):
+        """Create an ingestor; the writer starts with `start`.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the stash to write to.
+
+        max_pending : int, default=256
+            Number of entities waiting to be written at which producers
+            block.
+
+        batch_size : int, default=1024
+            Number of entities written between commits.
+
+        interval : float, default=1.0
+            Maximum number of seconds between commits, while entities come
+            in.
+
+        overwrite : bool, default=False
+            Overwrite key-entity pairs for keys that currently exist; if
+            False, these fail (see `progress`).
+
+        shm_threshold : int, default=2**16
+            Arrays of at least this many bytes are passed through shared
+            memory; None to always pickle them.
+
+        callback : callable, default=None
+            Called with the progress (see `progress`) on every commit, from a
+            thread of this process.
+
+        max_failures : int, default=100
+            Number of the latest failures to report.
+
+        kwargs
+            Further arguments for the writer's Stash; it journals its keymap
+            unless given `journal=False`, so that commits are cheap and
+            survive a crash of the writer (see `Stash.flush`).
+        """
+        self.filename = filename
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.interval = interval
+        self.overwrite = overwrite
+        self.shm_threshold = shm_threshold
+        self.callback = callback
+        self.max_failures = max_failures
+        self._stash_kwargs = dict(kwargs)
+        self._stash_kwargs.setdefault('journal', True)
+        # Start fresh interpreters; see `stream.Prefetcher`.
+        self._context = multiprocessing.get_context('spawn') \
+            if hasattr(multiprocessing, 'get_context') else multiprocessing
+        self._messages = self._context.Queue(max_pending)
+        self._reports = self._context.Queue()
+        self._progress = dict(count=0, nbytes=0, commits=0, failures=0,
+                              failed=[], done=False, elapsed=0.0,
+                              entities_per_sec=0.0, bytes_per_sec=0.0)
+        self._lock = threading.Lock()
+        self._writer = None
+        self._monitor = None
+        self._logger = logging.getLogger('Ingestor')
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def producer(self):
+        """A Producer, sending entities to this ingestor's writer."""
+        return Producer(self._messages, shm_threshold=self.shm_threshold)
+
+    @property
+    def started(self):
+        return self._writer is not None
+
+    def start(self):
+        """Start the writer process."""
+        if self.started:
+            return
+        self._writer = self._context.Process(
+            target=_writer_main,
+            args=(self.filename, self._stash_kwargs, self._messages,
+                  self._reports, self.batch_size, self.interval,
+                  self.overwrite, self.max_failures))
+        self._writer.daemon = True
+        self._writer.start()
+        self._monitor = threading.Thread(target=self.__monitor__)
+        self._monitor.daemon = True
+        self._monitor.start()
+
+    def __monitor__(self):
+        """Collect the writer's reports, until it is done or dies."""
+        while True:
+            try:
+                report = self._reports.get(timeout=0.1)
+            except queue.Empty:
+                if not self._writer.is_alive():
+                    return
+                continue
+            with self._lock:
+                self._progress = report
+            self._logger.debug(
+                "Wrote {count} entities ({entities_per_sec:.1f}/s, "
+                "{bytes_per_sec:.0f} bytes/s), {failures} failed"
+                "".format(**report))
+            if self.callback is not None:
+                try:
+                    self.callback(report)
+                except Exception:
+                    self._logger.error("Progress callback failed:\n{}"
+                                       "".format(traceback.format_exc()))
+            if report['done']:
+                return
+
+    def send(self, key, entity, timeout=None):
+        """Queue a key-entity pair for writing; see `Producer.send`."""
+        if not self.started:
+            raise RuntimeError("The ingestor has not been started.")
+        self.producer.send(key, entity, timeout=timeout)
+
+    def progress(self):
+        """Return the progress of the writer, as of its latest commit.
+
+        Returns
+        -------
+        progress : dict
+            With the number of entities written ('count'), their size in
+            bytes ('nbytes'), the number of commits ('commits'), failures
+            ('failures') and the latest (key, error) pairs among them
+            ('failed'), seconds since the writer started ('elapsed'), the
+            average throughput ('entities_per_sec', 'bytes_per_sec'), and
+            whether the writer is done ('done').
+        """
+        with self._lock:
+            return dict(self._progress)
+
+    def close(self, timeout=None):
+        """Write everything sent so far, and stop the writer.
+
+        Parameters
+        ----------
+        timeout : float, default=None
+            Seconds to wait for the writer; forever if None.
+
+        Returns
+        -------
+        progress : dict
+            Final progress of the writer; see `progress`.
+
+        Raises
+        ------
+        RuntimeError
+            If the writer exited unexpectedly.
+        """
+        if not self.started:
+            return self.progress()
+        if self._writer.is_alive():
+            self._messages.put(None)
+        self._writer.join(timeout)
+        self._monitor.join(timeout)
+        if self._writer.exitcode:
+            raise RuntimeError("Writer exited unexpectedly with code {}"
+                               "".format(self._writer.exitcode))
+        return self.progress()
@@ -0,0 +1,413 @@
+"""On-disk index of the keys in a Stash.
+
+A Keymap is a dictionary-like object mapping keys to the internal addresses
+of entities, stored in an HDF5 group as sorted, fixed-width byte strings:
+
+    keys, addrs : The bulk of the map, sorted by key.
+    fences : Every `BLOCK`-th key, for locating the block holding a key.
+    tail_keys, tail_addrs : A small sorted run of recent changes, where an
+        empty address marks a deleted key.
+
+Opening a keymap reads only the tail; the fences are read on the first
+lookup, after which each lookup reads (at most) a single block of keys and
+addresses; the most recently used blocks are kept in memory. Changes are
+collected in the tail until `flush`, which either appends the tail to the
+main run in place (when all its keys sort after it), folds it into the main
+run (once it outgrows a fraction of it), or just writes the tail.
+
+Keymaps opened with `journal=True` may instead `sync`, which appends the
+changes since the last one to a journal, one record per change:
+
+    journal_keys, journal_addrs : Changes in order, where an empty address
+        marks a deleted key.
+
+The cost of a sync is that of the records appended, regardless of the size
+of the map. Opening a keymap replays its journal (see `recovered`), and
+`flush` folds it into the map, emptying it.
+
+Older stashes kept the whole keymap as a single JSON string; these are
+migrated on the first `flush`.
+"""
+
+import collections
+import h5py
+import json
+import numpy as np
+import six
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+
+def _width(values):
+    """Return the fixed width needed to hold a collection of byte strings."""
+    return max([len(v) for v in values] + [1])
+
+
+class Keymap(MutableMapping):
+    """Sorted, incrementally updated mapping from keys to addresses."""
+    BLOCK = 1024
+    CACHED_BLOCKS = 64
+    MIN_TAIL = 4096
+    TAIL_RATIO = 8
+
+    def __init__(self, root, name='__KEYINDEX__', legacy_name=None,
+                 journal=False):
+        """Open (or create) a keymap.
+
+        Parameters
+        ----------
+        root : callable
+            Function returning the HDF5 group (or file) holding the keymap;
+            called whenever the file is accessed.
+
+        name : str, default='__KEYINDEX__'
+            Name of the keymap group under `root`.
+
+        legacy_name : str, default=None
+            Name of a JSON keymap dataset to migrate from, if present.
+
+        journal : bool, default=False
+            Record changes in the journal on `sync`; otherwise, `sync` is
+            the same as `flush`. Journals are replayed on open either way.
+        """
+        self._root = root
+        self._name = name
+        self._legacy_name = None
+        self._tail = dict()
+        self._size = 0
+        self._num_main = 0
+        self._last = None
+        self._fences = None
+        self._blocks = collections.OrderedDict()
+        self._dsets = (None, None, None)
+        self._dirty = False
+        self._journal = False
+        self._records = []
+        # (key, old, new) of the changes replayed from the journal, where
+        # None means no address.
+        self.recovered = []
+        self.__load__(legacy_name)
+        self._journal = journal
+
+    def __load__(self, legacy_name):
+        root = self._root()
+        grp = root.get(self._name) if root else None
+        if grp is not None:
+            self._size = int(grp.attrs['size'])
+            self._num_main = grp['keys'].shape[0]
+            for key, addr in zip(grp['tail_keys'][()].tolist(),
+                                 grp['tail_addrs'][()].tolist()):
+                self._tail[key] = addr or None
+            if 'journal_keys' in grp:
+                self.__replay__(grp)
+        elif root and legacy_name and legacy_name in root:
+            legacy = root[legacy_name][()]
+            legacy = legacy.decode('utf-8') \
+                if isinstance(legacy, bytes) else str(legacy)
+            for key, addr in six.iteritems(json.loads(legacy)):
+                self._tail[six.ensure_binary(key)] = six.ensure_binary(addr)
+            self._size = len(self._tail)
+            self._legacy_name = legacy_name
+            self._dirty = True
+
+    def __replay__(self, grp):
+        """Apply the records of the journal, noting the addresses changed."""
+        keys, addrs = grp['journal_keys'], grp['journal_addrs']
+        # A sync cut short may have grown one dataset but not the other.
+        count = min(keys.shape[0], addrs.shape[0])
+        for key, addr in zip(keys[:count].tolist(), addrs[:count].tolist()):
+            old = self.__lookup__(key)
+            if addr:
+                self[key] = addr
+            elif old is not None:
+                del self[key]
+            self.recovered.append(tuple(
+                six.ensure_str(a) if a else None for a in (key, old, addr)))
+        self._dirty = True
+
+    @property
+    def journal(self):
+        """Whether `sync` records changes in the journal."""
+        return self._journal
+
+    def __getstate__(self):
+        """Pickle everything but the root, open datasets and cached blocks."""
+        state = self.__dict__.copy()
+        state['_root'] = None
+        state['_records'] = []
+        state['_blocks'] = collections.OrderedDict()
+        state['_dsets'] = (None, None, None)
+        return state
+
+    @property
+    def _group(self):
+        return self._root()[self._name]
+
+    def __datasets__(self):
+        """Return the (keys, addrs) datasets, reusing them while possible."""
+        root = self._root()
+        if self._dsets[0] is not root:
+            grp = root[self._name]
+            self._dsets = (root, grp['keys'], grp['addrs'])
+        return self._dsets[1:]
+
+    def __read_block__(self, block):
+        """Read a block of (keys, addrs) from the main run."""
+        start = block * self.BLOCK
+        count = min(self.BLOCK, self._num_main - start)
+        mspace = h5py.h5s.create_simple((count,))
+        arrays = []
+        for dset in self.__datasets__():
+            fspace = dset.id.get_space()
+            fspace.select_hyperslab((start,), (count,))
+            arr = np.empty(count, dtype=dset.dtype)
+            dset.id.read(mspace, fspace, arr)
+            arrays.append(arr)
+        return tuple(arrays)
+
+    def __search__(self, bkey):
+        """Return the address of an encoded key in the main run, or None."""
+        if not self._num_main:
+            return None
+        if self._fences is None:
+            self._fences = self._group['fences'][()]
+        if len(bkey) > self._fences.dtype.itemsize:
+            return None
+
+        block = int(np.searchsorted(self._fences, bkey, side='right')) - 1
+        if block < 0:
+            return None
+        if block in self._blocks:
+            keys, addrs = self._blocks.pop(block)
+        else:
+            keys, addrs = self.__read_block__(block)
+            if len(self._blocks) >= self.CACHED_BLOCKS:
+                self._blocks.popitem(last=False)
+        self._blocks[block] = (keys, addrs)
+
+        idx = np.searchsorted(keys, bkey)
+        if idx < len(keys) and keys[idx] == bkey:
+            return addrs[idx]
+        return None
+
+    def __lookup__(self, bkey):
+        if bkey in self._tail:
+            return self._tail[bkey]
+        return self.__search__(bkey)
+
+    def __getitem__(self, key):
+        addr = self.__lookup__(six.ensure_binary(key))
+        if addr is None:
+            raise KeyError(key)
+        return six.ensure_str(addr)
+
+    def __contains__(self, key):
+        return self.__lookup__(six.ensure_binary(key)) is not None
+
+    def __setitem__(self, key, addr):
+        bkey = six.ensure_binary(key)
+        if self.__lookup__(bkey) is None:
+            self._size += 1
+        self._tail[bkey] = six.ensure_binary(addr)
+        self._dirty = True
+        if self._journal:
+            self._records.append((bkey, self._tail[bkey]))
+
+    def __delitem__(self, key):
+        bkey = six.ensure_binary(key)
+        if self.__lookup__(bkey) is None:
+            raise KeyError(key)
+        if self.__search__(bkey) is None:
+            del self._tail[bkey]
+        else:
+            self._tail[bkey] = None
+        self._size -= 1
+        self._dirty = True
+        if self._journal:
+            self._records.append((bkey, b''))
+
+    def __len__(self):
+        return self._size
+
+    def __main_chunks__(self):
+        """Yield the main run as (keys, addrs) arrays, in sorted order."""
+        if not self._num_main:
+            return
+        grp = self._group
+        step = 64 * self.BLOCK
+        for start in range(0, self._num_main, step):
+            yield (grp['keys'][start:start + step],
+                   grp['addrs'][start:start + step])
+
+    def __iteritems__(self):
+        """Yield live (key, addr) pairs as byte strings, sorted by key."""
+        tail = sorted(self._tail.items())
+        tidx, num_tail = 0, len(tail)
+        for keys, addrs in self.__main_chunks__():
+            for key, addr in zip(keys.tolist(), addrs.tolist()):
+                while tidx < num_tail and tail[tidx][0] < key:
+                    if tail[tidx][1] is not None:
+                        yield tail[tidx]
+                    tidx += 1
+                if tidx < num_tail and tail[tidx][0] == key:
+                    # Changes in the tail shadow the main run.
+                    if tail[tidx][1] is not None:
+                        yield tail[tidx]
+                    tidx += 1
+                else:
+                    yield key, addr
+        for item in tail[tidx:]:
+            if item[1] is not None:
+                yield item
+
+    def __iter__(self):
+        for key, addr in self.__iteritems__():
+            yield six.ensure_str(key)
+
+    def items(self):
+        return [(six.ensure_str(k), six.ensure_str(a))
+                for k, a in self.__iteritems__()]
+
+    def values(self):
+        return [six.ensure_str(a) for k, a in self.__iteritems__()]
+
+    def __appendable__(self, tail):
+        """True if the tail can be appended to the main run in place."""
+        if any(addr is None for key, addr in tail):
+            return False
+        if not self._num_main:
+            return True
+        keys, addrs = self._group['keys'], self._group['addrs']
+        if self._last is None:
+            self._last = keys[self._num_main - 1]
+        return (tail[0][0] > self._last and
+                _width([k for k, a in tail]) <= keys.dtype.itemsize and
+                _width([a for k, a in tail]) <= addrs.dtype.itemsize)
+
+    def __create__(self, grp, name, data, width):
+        if name in grp:
+            del grp[name]
+        return grp.create_dataset(
+            name, data=np.asarray(data, dtype='S{}'.format(width)),
+            maxshape=(None,), chunks=(self.BLOCK,))
+
+    def __append__(self, grp, tail):
+        """Append sorted items to the main run, creating it if needed."""
+        keys, addrs = zip(*tail) if tail else ((), ())
+        if not self._num_main:
+            self.__create__(grp, 'keys', keys, _width(keys))
+            self.__create__(grp, 'addrs', addrs, _width(addrs))
+            self.__create__(grp, 'fences', keys[::self.BLOCK], _width(keys))
+        else:
+            start, stop = self._num_main, self._num_main + len(tail)
+            for name, values in (('keys', keys), ('addrs', addrs)):
+                grp[name].resize((stop,))
+                grp[name][start:stop] = values
+            first = -(-start // self.BLOCK) * self.BLOCK
+            fences = keys[first - start::self.BLOCK]
+            if fences:
+                num_fences = grp['fences'].shape[0]
+                grp['fences'].resize((num_fences + len(fences),))
+                grp['fences'][num_fences:] = fences
+        self._num_main += len(tail)
+        self._last = keys[-1] if keys else None
+
+    def __merge__(self, grp):
+        """Fold the tail into the main run, rewriting it."""
+        width = _width(list(self._tail.keys()))
+        addr_width = _width([a for a in self._tail.values() if a])
+        if self._num_main:
+            width = max(width, grp['keys'].dtype.itemsize)
+            addr_width = max(addr_width, grp['addrs'].dtype.itemsize)
+
+        new_keys = self.__create__(grp, 'keys~', [], width)
+        new_addrs = self.__create__(grp, 'addrs~', [], addr_width)
+        keys, addrs, count = [], [], 0
+        items = self.__iteritems__()
+        while True:
+            for key, addr in items:
+                keys.append(key)
+                addrs.append(addr)
+                if len(keys) >= 64 * self.BLOCK:
+                    break
+            if not keys:
+                break
+            new_keys.resize((count + len(keys),))
+            new_keys[count:] = keys
+            new_addrs.resize((count + len(keys),))
+            new_addrs[count:] = addrs
+            count += len(keys)
+            keys, addrs = [], []
+
+        for name in ('keys', 'addrs'):
+            if name in grp:
+                del grp[name]
+            grp.move(name + '~', name)
+        self.__create__(grp, 'fences', grp['keys'][::self.BLOCK], width)
+        self._num_main = count
+        self._last = None
+
+    def sync(self):
+        """Append the changes since the last sync to the journal.
+
+        Without a journal, or before the keymap was first flushed, this
+        flushes instead.
+        """
+        if not self._journal or self._name not in self._root():
+            return self.flush()
+        if not self._records:
+            return
+        grp = self._group
+        if 'journal_keys' not in grp:
+            for name in ('journal_keys', 'journal_addrs'):
+                grp.create_dataset(name, shape=(0,), maxshape=(None,),
+                                   chunks=(self.BLOCK,),
+                                   dtype=h5py.special_dtype(vlen=bytes))
+        for name, values in zip(('journal_keys', 'journal_addrs'),
+                                zip(*self._records)):
+            dset = grp[name]
+            start = dset.shape[0]
+            dset.resize((start + len(values),))
+            dset[start:] = np.array(values, dtype=object)
+        self._records = []
+
+    def flush(self):
+        """Write any changes to disk, folding in and emptying the journal."""
+        self._records = []
+        if not self._dirty:
+            return
+        grp = self._root().require_group(self._name)
+        tail = sorted(self._tail.items())
+        if tail and self.__appendable__(tail):
+            self.__append__(grp, tail)
+            self._tail = dict()
+        elif len(tail) > max(self.MIN_TAIL, self._num_main // self.TAIL_RATIO):
+            self.__merge__(grp)
+            self._tail = dict()
+        elif not self._num_main:
+            self.__append__(grp, [])
+
+        tail = sorted(self._tail.items())
+        keys = [k for k, a in tail]
+        addrs = [a or b'' for k, a in tail]
+        self.__create__(grp, 'tail_keys', keys, _width(keys))
+        self.__create__(grp, 'tail_addrs', addrs, _width(addrs))
+        grp.attrs['size'] = self._size
+        grp.attrs['version'] = 1
+        for name in ('journal_keys', 'journal_addrs'):
+            if name in grp:
+                del grp[name]
+
+        if self._legacy_name is not None:
+            root = self._root()
+            if self._legacy_name in root:
+                del root[self._legacy_name]
+            self._legacy_name = None
+
+        self._fences = None
+        self._blocks.clear()
+        self._dsets = (None, None, None)
+        self._dirty = False
@@ -0,0 +1,206 @@
+"""Memory-mapped, zero-copy reads of contiguous datasets.
+
+HDF5 stores the values of unfiltered, contiguous datasets as a single run of
+bytes in the file. Rather than reading these through h5py, which copies
+them into a fresh array on every access, a FileMap maps the file into memory
+once and returns read-only views of these runs: reads are served straight
+from the OS page cache, and processes reading the same file share the same
+physical pages.
+
+Chunked, compressed or variable-length datasets fall back to regular reads.
+
+>>> stash = Stash('data.hdf5', mode='r', mmap=True)
+>>> stash.get('key')['cqt'].value.flags.owndata
+False
+"""
+
+import h5py
+import mmap
+import numpy as np
+
+import biggie.core as core
+
+
+def dataset_offset(dsid):
+    """Return the offset of a dataset's values in its file, if mappable.
+
+    Parameters
+    ----------
+    dsid : h5py.h5d.DatasetID
+        Low-level identifier of the dataset.
+
+    Returns
+    -------
+    offset : int or None
+        Byte offset of the values, or None if they are not stored as a single
+        run of raw bytes; e.g. for chunked, filtered, external, empty or
+        variable-length datasets.
+    """
+    if dsid.dtype.hasobject or not dsid.get_storage_size():
+        return None
+    dcpl = dsid.get_create_plist()
+    if dcpl.get_layout() != h5py.h5d.CONTIGUOUS or dcpl.get_nfilters() or \
+            dcpl.get_external_count():
+        return None
+    return dsid.get_offset()
+
+
+class FileMap(object):
+    """Read-only memory map of a file, shared by the views into it."""
+
+    def __init__(self, filename):
+        """Create a file map; the file is mapped on first use.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the file.
+        """
+        self._filename = filename
+        self._map = None
+
+    def __getstate__(self):
+        """Pickle everything but the map itself."""
+        state = self.__dict__.copy()
+        state['_map'] = None
+        return state
+
+    def __remap__(self):
+        """Map the file as it is now, e.g. after it has grown.
+
+        Views of the previous map keep it alive until they are collected.
+        """
+        with open(self._filename, 'rb') as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def view(self, offset, shape, dtype):
+        """Return a read-only array over a range of the file.
+
+        Parameters
+        ----------
+        offset : int
+            Byte offset of the array in the file.
+
+        shape : tuple
+            Shape of the array.
+
+        dtype : np.dtype
+            Data type of the array.
+
+        Returns
+        -------
+        view : np.ndarray
+            Read-only array, sharing memory with the map.
+        """
+        count = int(np.prod(shape))
+        nbytes = count * np.dtype(dtype).itemsize
+        if self._map is None or offset + nbytes > len(self._map):
+            self.__remap__()
+        if offset + nbytes > len(self._map):
+            raise ValueError("Range {}:{} beyond the end of '{}'".format(
+                offset, offset + nbytes, self._filename))
+        return np.frombuffer(self._map, dtype=dtype, count=count,
+                             offset=offset).reshape(shape)
+
+
+class MappedField(core.DeferredField):
+    """LazyField whose value is a read-only view of a memory-mapped file.
+
+    The dataset is opened and mapped on first access. Values are never
+    copied, so read policies don't apply; slices are views as well, and
+    neither must be written to. Datasets that can't be mapped are read like
+    a LazyField.
+    """
+    __slots__ = ('_filemap', '_view')
+
+    def __init__(self, group, name, filemap, policy='lazy', budget=None):
+        """Refer to a member of an HDF5 group.
+
+        Parameters
+        ----------
+        group : h5py.Group
+            Group holding the field's dataset.
+
+        name : str
+            Name of the dataset in the group.
+
+        filemap : FileMap
+            Map of the dataset's file.
+
+        policy, budget : str, MemoryBudget
+            Read policy and memory budget, should the dataset not be
+            mappable; see `LazyField`.
+        """
+        core.DeferredField.__init__(self, group, name, policy=policy,
+                                    budget=budget)
+        self._filemap = filemap
+        self._view = None
+
+    def __map__(self):
+        """Return the view of the dataset's values, or False if unmappable."""
+        if self._view is None:
+            dataset = self._dataset
+            offset = dataset_offset(dataset.id)
+            self._view = False if offset is None else self._filemap.view(
+                offset, dataset.shape, dataset.dtype)
+        return self._view
+
+    @property
+    def mapped(self):
+        """True if the value is read from the memory map."""
+        return self.__map__() is not False
+
+    @property
+    def value(self):
+        view = self.__map__()
+        if view is False:
+            return core.LazyField.value.fget(self)
+        # Scalars are returned as such, like h5py does.
+        return view if view.ndim else view[()]
+
+    def slice(self, slidx):
+        if self.__map__() is False:
+            return core.LazyField.slice(self, slidx)
+        return core.Field.slice(self, slidx)
+
+    def read_direct(self, out, source_sel=None, dest_sel=None):
+        if self.__map__() is False:
+            return core.LazyField.read_direct(self, out, source_sel, dest_sel)
+        return core.Field.read_direct(self, out, source_sel, dest_sel)
+
+
+def load_group(group, filemap, policy='lazy', budget=None, fields=None):
+    """Create an entity of memory-mapped fields from an HDF5 group.
+
+    Parameters
+    ----------
+    group : h5py.Group
+        Group holding one dataset per field.
+
+    filemap : FileMap
+        Map of the group's file.
+
+    policy, budget : str, MemoryBudget
+        Read policy and memory budget of the fields that can't be mapped;
+        see `LazyField`.
+
+    fields : iterable of str, default=None
+        Fields to load, in order; if None, all members of the group.
+
+    Returns
+    -------
+    entity : Entity
+        Entity of MappedFields.
+
+    Raises
+    ------
+    KeyError
+        If the group lacks any of the given fields.
+    """
+    schema = core._group_schema(group, fields)
+    entity = core.Entity()
+    object.__setattr__(entity, '_schema', schema)
+    object.__setattr__(entity, '_fields', [
+        MappedField(group, key, filemap, policy=policy, budget=budget)
+        for key in schema.keys])
+    return entity
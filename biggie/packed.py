@@ -0,0 +1,431 @@
+"""Columnar ("packed") storage of entities.
+
+In the default layout of a Stash, each entity is an HDF5 group holding one
+dataset per field. For many small entities, the metadata of all these
+objects dominates both the size of the file and the time spent reading it.
+
+In the packed layout, each field is instead a single dataset, in which the
+values of all entities are concatenated along the first axis:
+
+    __PACKED__/keys : Key of the entity in each row, for recovery.
+    __PACKED__/<field>/data : Concatenated values of the field.
+    __PACKED__/<field>/offsets, lengths : Position of each row's value in
+        `data`; a negative length marks a row without the field.
+
+Rows are the integer indices of the entities' addresses, and thus reused
+as entities are removed and added; the space of removed values is not.
+Values of scalar fields (and strings) take up a single element of `data`;
+other values may vary in the length of their first axis only.
+
+New entities are buffered in memory, and written a field at a time on
+`flush`. Entities are loaded as `PackedField`s, views of their slice of
+each dataset, without reading any data.
+"""
+
+import collections
+import h5py
+import numpy as np
+import six
+
+import biggie.core as core
+import biggie.storage as biggie_storage
+
+# Length of rows without a given field.
+ABSENT = -1
+
+
+class PackedField(core.LazyField):
+    """Lazy-loading view of one entity's slice of a packed dataset."""
+    __slots__ = ('_start', '_stop')
+
+    def __init__(self, hdf5_dataset, start, stop=None, policy='lazy',
+                 budget=None):
+        """Wrap a slice of an HDF5 dataset.
+
+        Parameters
+        ----------
+        hdf5_dataset : h5py.Dataset
+            Dataset holding the concatenated values of a field.
+
+        start, stop : int
+            Rows of the value in the dataset; a scalar at `start` if `stop`
+            is None.
+
+        policy, budget : str, MemoryBudget
+            Read policy and memory budget; see `LazyField`.
+        """
+        core.LazyField.__init__(self, hdf5_dataset, policy=policy,
+                                budget=budget)
+        self._start = start
+        self._stop = stop
+
+    def __read__(self):
+        if self._stop is None:
+            return core._read(self._dataset, self._start)
+        return self._dataset[self._start:self._stop]
+
+    @property
+    def shape(self):
+        if self._stop is None:
+            return ()
+        return (self._stop - self._start,) + self._dataset.shape[1:]
+
+    @property
+    def attrs(self):
+        if self._attrs is None:
+            self._attrs = dict()
+        return self._attrs
+
+    def __compose__(self, selection):
+        """Translate a selection of the value into one of the dataset.
+
+        Returns None for selections that can't be translated, e.g. those
+        with negative strides or fancy indexing.
+        """
+        if selection is None or selection is Ellipsis:
+            selection = ()
+        if not isinstance(selection, tuple):
+            selection = (selection,)
+        if self._stop is None:
+            if selection:
+                raise IndexError("Scalar values can't be sliced.")
+            return self._start
+
+        rows = slice(self._start, self._stop)
+        if not selection:
+            return (rows,)
+        first, length = selection[0], self._stop - self._start
+        if first is Ellipsis:
+            return (rows,) + selection
+        if isinstance(first, slice):
+            start, stop, step = first.indices(length)
+            if step < 1:
+                return None
+            first = slice(self._start + start,
+                          self._start + max(start, stop), step)
+        elif isinstance(first, six.integer_types + (np.integer,)):
+            index = first + length if first < 0 else first
+            if not 0 <= index < length:
+                raise IndexError("Index {} out of range for length {}"
+                                 "".format(first, length))
+            first = self._start + int(index)
+        else:
+            return None
+        return (first,) + selection[1:]
+
+    def slice(self, slidx):
+        if isinstance(slidx, list):
+            slidx = tuple(slidx)
+        selection = self.__compose__(slidx)
+        if self._value is not None or selection is None:
+            return self.value[slidx]
+        return self._dataset[selection]
+
+    def read_direct(self, out, source_sel=None, dest_sel=None):
+        selection = self.__compose__(source_sel)
+        if self._value is not None or out.dtype.hasobject or \
+                selection is None:
+            return core.Field.read_direct(self, out, source_sel, dest_sel)
+        return core.LazyField.read_direct(self, out, selection, dest_sel)
+
+
+class PackedStore(object):
+    """Columnar storage of the fields of entities, indexed by row."""
+    BUFFER_SIZE = 4096
+    # Size of the data chunks of fields without a chunked storage policy.
+    CHUNK_BYTES = 2 ** 20
+
+    def __init__(self, root, name='__PACKED__', storage=None):
+        """Open (or create) a packed store.
+
+        Parameters
+        ----------
+        root : callable
+            Function returning the HDF5 group (or file) holding the store.
+
+        name : str, default='__PACKED__'
+            Name of the store's group under `root`.
+
+        storage : StoragePolicy or dict, default=None
+            Chunking and filters of the fields' datasets, applied as they
+            are created; see `biggie.storage`.
+        """
+        self._root = root
+        self._name = name
+        self._storage = storage
+        self._pending = collections.OrderedDict()
+        self._specs = dict()
+        self._index = dict()
+        self._dsets = (None, dict())
+        self.__load__()
+
+    def __load__(self):
+        root = self._root()
+        grp = root.get(self._name) if root else None
+        if grp is None:
+            return
+        for field, fgrp in six.iteritems(grp):
+            if isinstance(fgrp, h5py.Group):
+                data = fgrp['data']
+                self._specs[field] = (data.dtype, data.shape[1:],
+                                      bool(fgrp.attrs['scalar']))
+
+    def __getstate__(self):
+        """Pickle everything but the root, open datasets and the index."""
+        state = self.__dict__.copy()
+        state['_root'] = None
+        state['_index'] = dict()
+        state['_dsets'] = (None, dict())
+        return state
+
+    @property
+    def fields(self):
+        """Names of the fields stored so far."""
+        return sorted(self._specs.keys())
+
+    def __datasets__(self, field):
+        """Return the (data, offsets, lengths) datasets of a field."""
+        root = self._root()
+        if self._dsets[0] is not root:
+            self._dsets = (root, dict())
+        dsets = self._dsets[1]
+        if field not in dsets:
+            fgrp = root[self._name][field]
+            dsets[field] = (fgrp['data'], fgrp['offsets'], fgrp['lengths'])
+        return dsets[field]
+
+    def __field_index__(self, field):
+        """Return the in-memory (offsets, lengths) arrays of a field."""
+        if field not in self._index:
+            data, offsets, lengths = self.__datasets__(field)
+            self._index[field] = [offsets[()], lengths[()]]
+        return self._index[field]
+
+    def __spec__(self, field, value):
+        """Return the (dtype, shape, scalar) spec of a value."""
+        scalar = value.ndim == 0
+        if value.dtype.hasobject or value.dtype.kind in 'SU':
+            if not scalar:
+                raise ValueError("Packed fields can't hold arrays of strings "
+                                 "or objects; received '{}'".format(field))
+            return h5py.special_dtype(vlen=six.text_type), (), True
+        return value.dtype, () if scalar else value.shape[1:], scalar
+
+    def check(self, items):
+        """Check that the fields of an entity fit the packed datasets.
+
+        Parameters
+        ----------
+        items : iterable of (str, object) pairs
+            Fields of the entity.
+
+        Returns
+        -------
+        specs : list of (str, np.ndarray, tuple) triples
+            Field, value as an array, and (dtype, shape, scalar) spec of each
+            field.
+
+        Raises
+        ------
+        ValueError
+            If a field can't be packed, or its shape doesn't match the rows
+            of its dataset.
+        """
+        specs = []
+        for field, value in items:
+            value = np.asarray(value)
+            spec = self.__spec__(field, value)
+            expected = self._specs.get(field, spec)
+            if spec[1:] != expected[1:]:
+                raise ValueError(
+                    "Shape mismatch for '{}': received {}, expected rows of "
+                    "{}".format(field, value.shape,
+                                'scalars' if expected[2] else expected[1]))
+            specs.append((field, value, spec))
+        return specs
+
+    def add(self, row, key, items):
+        """Buffer the fields of an entity, to be written on `flush`.
+
+        Parameters
+        ----------
+        row : int
+            Row of the entity.
+
+        key : str
+            Key of the entity.
+
+        items : iterable of (str, object) pairs
+            Fields of the entity; see `check`.
+        """
+        values = []
+        for field, value, spec in self.check(items):
+            self._specs.setdefault(field, spec)
+            values.append((field, value))
+        self._pending[row] = (key, values)
+        if len(self._pending) >= self.BUFFER_SIZE:
+            self.flush()
+
+    def remove(self, row):
+        """Remove the fields of an entity."""
+        if self._pending.pop(row, None) is not None:
+            return
+        grp = self._root().get(self._name)
+        for field in self._specs:
+            if grp is None or field not in grp:
+                continue
+            offsets, lengths = self.__field_index__(field)
+            if row < len(lengths) and lengths[row] != ABSENT:
+                lengths[row] = ABSENT
+                self.__datasets__(field)[2][row] = ABSENT
+
+    def load(self, row, policy='lazy', budget=None, fields=None):
+        """Return the entity in a row, as views of the packed datasets.
+
+        Parameters
+        ----------
+        row : int
+            Row of the entity.
+
+        policy, budget : str, MemoryBudget
+            Read policy and memory budget of the fields; see `LazyField`.
+
+        fields : iterable of str, default=None
+            Fields to load, in order; if None, all fields of the entity.
+
+        Returns
+        -------
+        entity : Entity
+            Entity of PackedFields, or of Fields if not yet written to disk.
+
+        Raises
+        ------
+        KeyError
+            If the entity lacks any of the given fields.
+        """
+        entity = core.Entity()
+        if row in self._pending:
+            values = self._pending[row][1]
+            if fields is not None:
+                values = dict(values)
+                values = [(field, values[field]) for field in fields]
+            for field, value in values:
+                entity.__set_field__(field, core.Field(
+                    value if value.ndim else value[()]))
+            return entity
+
+        grp = self._root().get(self._name)
+        for field in sorted(self._specs) if fields is None else fields:
+            if grp is None or field not in grp:
+                if fields is None:
+                    continue
+                raise KeyError(field)
+            offsets, lengths = self.__field_index__(field)
+            if row >= len(lengths) or lengths[row] == ABSENT:
+                if fields is None:
+                    continue
+                raise KeyError(field)
+            start = int(offsets[row])
+            stop = None if self._specs[field][2] else start + int(lengths[row])
+            entity.__set_field__(field, PackedField(
+                self.__datasets__(field)[0], start, stop, policy=policy,
+                budget=budget))
+        return entity
+
+    def __create__(self, grp, field):
+        """Create the datasets of a field."""
+        dtype, shape, scalar = self._specs[field]
+        fgrp = grp.create_group(field)
+        fgrp.attrs['scalar'] = scalar
+        policy = biggie_storage.resolve(self._storage, field) or \
+            biggie_storage.StoragePolicy()
+        # Resizable datasets must be chunked; fewer rows per chunk as rows
+        # get bigger, lest a chunk not fit in memory.
+        chunks = policy.chunk_shape((self.BUFFER_SIZE,) + shape, dtype) or \
+            biggie_storage.StoragePolicy(
+                chunks=True, chunk_bytes=self.CHUNK_BYTES).chunk_shape(
+                    (self.BUFFER_SIZE,) + shape, dtype) or \
+            (self.BUFFER_SIZE,) + shape
+        kwargs = policy.dataset_kwargs(np.empty((1,) + shape, dtype=dtype))
+        kwargs['chunks'] = chunks
+        try:
+            fgrp.create_dataset('data', shape=(0,) + shape, dtype=dtype,
+                                maxshape=(None,) + shape, **kwargs)
+            for name, fill in (('offsets', 0), ('lengths', ABSENT)):
+                fgrp.create_dataset(name, shape=(0,), dtype=np.int64,
+                                    maxshape=(None,),
+                                    chunks=(self.BUFFER_SIZE,),
+                                    fillvalue=fill)
+        except Exception:
+            # Half-created fields would fail every later flush.
+            del grp[field]
+            raise
+
+    def __write_rows__(self, dset, rows, values):
+        """Write values at the given (sorted) rows of a 1-d dataset."""
+        if rows[-1] >= dset.shape[0]:
+            dset.resize((rows[-1] + 1,))
+        if rows[-1] - rows[0] + 1 == len(rows):
+            dset[rows[0]:rows[-1] + 1] = values
+        else:
+            # Read, modify and write the range covering the rows.
+            block = dset[rows[0]:rows[-1] + 1]
+            block[np.asarray(rows) - rows[0]] = values
+            dset[rows[0]:rows[-1] + 1] = block
+
+    def flush(self):
+        """Write buffered entities to disk.
+
+        Should writing fail, the entities stay buffered, so that `flush` may
+        be retried; values written before the failure are written again (and
+        their first copy left unused).
+        """
+        if not self._pending:
+            return
+        grp = self._root().require_group(self._name)
+        rows = sorted(self._pending.keys())
+
+        if 'keys' not in grp:
+            grp.create_dataset(
+                'keys', shape=(0,), maxshape=(None,),
+                chunks=(self.BUFFER_SIZE,),
+                dtype=h5py.special_dtype(vlen=six.text_type))
+        self.__write_rows__(grp['keys'], rows, np.array(
+            [self._pending[row][0] for row in rows], dtype=object))
+
+        columns = collections.defaultdict(lambda: ([], []))
+        for row in rows:
+            for field, value in self._pending[row][1]:
+                columns[field][0].append(row)
+                columns[field][1].append(value)
+
+        for field, (field_rows, values) in sorted(columns.items()):
+            if field not in grp:
+                self.__create__(grp, field)
+            data, offsets, lengths = self.__datasets__(field)
+            index = self.__field_index__(field)
+            if self._specs[field][2]:
+                counts = np.ones(len(values), dtype=np.int64)
+                block = np.array([v[()] for v in values], dtype=object
+                                 if data.dtype.kind == 'O' else data.dtype)
+            else:
+                counts = np.array([len(v) for v in values], dtype=np.int64)
+                block = np.concatenate(values)
+            start = data.shape[0]
+            data.resize((start + len(block),) + data.shape[1:])
+            data[start:] = block
+            starts = start + np.cumsum(counts) - counts
+            self.__write_rows__(offsets, field_rows, starts)
+            self.__write_rows__(lengths, field_rows, counts)
+
+            # Keep the in-memory index in sync.
+            size = max(len(index[1]), field_rows[-1] + 1)
+            for n, arr in enumerate(index):
+                if len(arr) < size:
+                    grown = np.empty(size, dtype=np.int64)
+                    grown.fill(0 if n == 0 else ABSENT)
+                    grown[:len(arr)] = arr
+                    index[n] = arr = grown
+                arr[field_rows] = starts if n == 0 else counts
+
+        self._pending.clear()
@@ -0,0 +1,243 @@
+"""Sampling fixed-length windows from the entities of a Stash.
+
+Rather than loading whole entities to cut a window out of each, a
+WindowSampler reads only the hyperslab of each window from disk, straight
+into its slot of a batch array; the cost of a batch thus depends on the size
+of the windows, not on the size of the entities they are drawn from.
+
+>>> sampler = WindowSampler(stash, 'cqt', length=64)
+>>> batch = sampler.sample(32)
+>>> batch['cqt'].shape
+(32, 64, 252)
+"""
+
+import h5py
+import numpy as np
+import six
+
+import biggie.core as core
+
+
+class WindowSampler(object):
+    """Draws random windows from the fields of entities in a Stash."""
+
+    def __init__(self, stash, fields, length, axis=0, keys=None,
+                 weighted=True, seed=None):
+        """Create a window sampler.
+
+        Parameters
+        ----------
+        stash : Stash
+            Stash to sample from.
+
+        fields : str or iterable of str
+            Field(s) to take windows from; windows of different fields of an
+            entity are aligned, and all must share the length of the sampled
+            axis.
+
+        length : int
+            Length of the windows, along `axis`.
+
+        axis : int, default=0
+            Axis along which windows are taken.
+
+        keys : iterable of str, default=None
+            Keys of the entities to sample from; if None, all of them.
+            Entities shorter than `length` are never sampled.
+
+        weighted : bool, default=True
+            If True, entities are drawn with probability proportional to the
+            number of windows they hold, such that all windows are equally
+            likely; otherwise entities are drawn uniformly.
+
+        seed : int, default=None
+            Seed for the random number generator.
+        """
+        self.stash = stash
+        self.fields = [fields] if isinstance(fields, six.string_types) \
+            else list(fields)
+        self.length = int(length)
+        self.axis = axis
+        self.weighted = weighted
+        self.rng = np.random.RandomState(seed)
+        self._keys = None
+        self._shapes = None
+        self._dtypes = None
+        self._index = None
+        self.refresh(keys)
+
+    def refresh(self, keys=None):
+        """Re-read the shapes of the entities to sample from.
+
+        Only dataset metadata is read; shapes are cached until the next call.
+
+        Parameters
+        ----------
+        keys : iterable of str, default=None
+            Keys of the entities to sample from; if None, all of them.
+        """
+        keys = self.stash.keys() if keys is None else list(keys)
+        self._keys, shapes = [], []
+        for key in keys:
+            values = self.__values__(key)
+            if self._dtypes is None:
+                self._dtypes = [value.dtype for value in values]
+            lengths = set(value.shape[self.axis] for value in values)
+            if len(lengths) > 1:
+                raise ValueError(
+                    "Fields {} of '{}' differ in length along axis {}"
+                    "".format(self.fields, key, self.axis))
+            if lengths.pop() >= self.length:
+                self._keys.append(key)
+                shapes.append([value.shape for value in values])
+
+        if not self._keys:
+            raise ValueError("No entities hold windows of length {}"
+                             "".format(self.length))
+        self._shapes = shapes
+        self._index = dict((k, n) for n, k in enumerate(self._keys))
+        num_windows = np.array([s[0][self.axis] for s in shapes]) \
+            - self.length + 1
+        self._probs = None
+        if self.weighted:
+            self._probs = num_windows / float(num_windows.sum())
+        self._num_windows = num_windows
+
+    def __values__(self, key, lazy=False):
+        """Return the sampled fields of an entity, without reading them.
+
+        Unless `lazy`, these are low-level dataset identifiers where
+        possible, which suffice for shapes and types.
+        """
+        if key in self.stash.__local__:
+            entity = self.stash.__local__[key]
+            return [entity[field] for field in self.fields]
+        if self.stash.layout == 'packed':
+            entity = self.stash.__load__(key)
+            return [entity[field] for field in self.fields]
+
+        gid = h5py.h5g.open(self.stash._fhandle.id,
+                            self.stash._keymap[key].encode('utf-8'))
+        dsids = [h5py.h5d.open(gid, field.encode('utf-8'))
+                 for field in self.fields]
+        if lazy:
+            return [core.LazyField(h5py.Dataset(dsid)) for dsid in dsids]
+        return dsids
+
+    @property
+    def keys(self):
+        """Keys of the entities sampled from."""
+        return list(self._keys)
+
+    def __len__(self):
+        """Number of distinct windows that can be drawn."""
+        return int(self._num_windows.sum())
+
+    def draw(self, count):
+        """Draw the positions of random windows, without reading them.
+
+        Parameters
+        ----------
+        count : int
+            Number of windows to draw.
+
+        Returns
+        -------
+        windows : list of (str, int) tuples
+            Key of the entity and offset of each window.
+        """
+        idx = self.rng.choice(len(self._keys), size=count, p=self._probs)
+        offsets = (self.rng.random_sample(count) *
+                   self._num_windows[idx]).astype(int)
+        return [(self._keys[i], int(o)) for i, o in zip(idx, offsets)]
+
+    def __window_shapes__(self, shapes):
+        result = []
+        for shape in shapes:
+            shape = list(shape)
+            shape[self.axis] = self.length
+            result.append(tuple(shape))
+        return result
+
+    def read(self, windows, out=None):
+        """Read windows into batch arrays.
+
+        Parameters
+        ----------
+        windows : list of (str, int) tuples
+            Key of the entity and offset of each window, as from `draw`.
+
+        out : dict of np.ndarrays, default=None
+            Arrays keyed by field, each shaped (len(windows), ...), into which
+            the i-th window is written at index i; allocated if None. All
+            windows of a field must then share the same shape.
+
+        Returns
+        -------
+        out : dict of np.ndarrays
+            Windows keyed by field, with the batch along the first axis.
+        """
+        index = self._index
+        if out is None:
+            shapes = self.__window_shapes__(self._shapes[index[windows[0][0]]])
+            out = dict()
+            for field, shape, dtype in zip(self.fields, shapes, self._dtypes):
+                out[field] = np.empty((len(windows),) + shape, dtype=dtype)
+
+        # Read in row (allocation) order, for locality on disk.
+        rows = [self.stash.__row__(self.stash._keymap[key])
+                for key, offset in windows]
+        for idx in sorted(range(len(windows)), key=rows.__getitem__):
+            key, offset = windows[idx]
+            shapes = self.__window_shapes__(self._shapes[index[key]])
+            values = self.__values__(key, lazy=True)
+            for field, value, shape in zip(self.fields, values, shapes):
+                if shape != out[field].shape[1:]:
+                    raise ValueError(
+                        "Shape mismatch for '{}' in '{}': received {}, "
+                        "expected {}".format(field, key, shape,
+                                             out[field].shape[1:]))
+                sel = [slice(None)] * len(shape)
+                sel[self.axis] = slice(offset, offset + self.length)
+                value.read_direct(out[field], tuple(sel), idx)
+        return out
+
+    def sample(self, batch_size, out=None):
+        """Draw and read a batch of random windows.
+
+        Parameters
+        ----------
+        batch_size : int
+            Number of windows in the batch.
+
+        out : dict of np.ndarrays, default=None
+            Arrays to read into; see `read`.
+
+        Returns
+        -------
+        batch : dict of np.ndarrays
+            Windows keyed by field, with the batch along the first axis.
+        """
+        return self.read(self.draw(batch_size), out=out)
+
+    def batches(self, batch_size, max_batches=None):
+        """Yield batches of random windows, reusing the same arrays.
+
+        Parameters
+        ----------
+        batch_size : int
+            Number of windows per batch.
+
+        max_batches : int, default=None
+            Number of batches to yield; infinite if None.
+
+        Yields
+        ------
+        batch : dict of np.ndarrays
+            Windows keyed by field; overwritten by the next batch.
+        """
+        out, count = None, 0
+        while max_batches is None or count < max_batches:
+            out = self.sample(batch_size, out=out)
+            yield out
+            count += 1
@@ -0,0 +1,166 @@
+"""Shuffled passes over the entities of a Stash, with local reads.
+
+Reading entities in a uniformly random order seeks all over the file. An
+EpochShuffler trades a little randomness for locality instead:
+
+1. Keys are sorted by address, and cut into blocks of `block_size`
+   entities, which lie close together on disk.
+2. Blocks are read one after the other, in random order, each from start
+   to end.
+3. Entities read enter a shuffle buffer of `buffer_size` entities; once it
+   is full, each new one takes the place of a random one, which is
+   delivered. The buffer is drained in random order at the end.
+
+Entities thus travel at most `buffer_size` places from their position in
+the order of the blocks, and memory is bounded by the buffer (plus the
+entities read ahead).
+
+>>> shuffler = EpochShuffler(stash, block_size=64, buffer_size=4096, seed=0)
+>>> for key, entity in shuffler:
+...     consume(entity)
+
+Each epoch has its own order, determined by the seed and the number of the
+epoch alone. Orders are computed on keys, without reading anything, so a
+pass may be resumed from any position (see `state`); only the entities in
+the buffer at that point are read again.
+"""
+
+import numpy as np
+
+
+class EpochShuffler(object):
+    """Iterator over a Stash in block-wise, buffered shuffled order."""
+
+    def __init__(self, stash, keys=None, block_size=64, buffer_size=1024,
+                 seed=None, prefetch=16, fields=None):
+        """Create a shuffler.
+
+        Parameters
+        ----------
+        stash : Stash
+            Stash to read from.
+
+        keys : iterable of str, default=None
+            Keys to read; if None, all keys in the stash. These must not
+            change for epochs to be resumed.
+
+        block_size : int, default=64
+            Number of entities, contiguous on disk, read at a time.
+
+        buffer_size : int, default=1024
+            Number of entities held in the shuffle buffer; the larger, the
+            closer to a uniform shuffle.
+
+        seed : int, default=None
+            Seed of the orders of all epochs; drawn at random if None.
+
+        prefetch : int, default=16
+            Maximum number of entities read ahead; see `stream.Prefetcher`.
+
+        fields : iterable of str, default=None
+            Fields to read; if None, all of them.
+        """
+        if block_size < 1 or buffer_size < 1:
+            raise ValueError("`block_size` and `buffer_size` must be "
+                             "positive.")
+        self.stash = stash
+        self.block_size = block_size
+        self.buffer_size = buffer_size
+        self.seed = np.random.randint(2 ** 31) if seed is None else seed
+        self.prefetch = prefetch
+        self.fields = fields
+        keys = stash.keys() if keys is None else keys
+        rows = dict((key, stash.__row__(stash._keymap[key])) for key in keys)
+        self._keys = sorted(rows, key=rows.__getitem__)
+        self.epoch = 0
+        self.position = 0
+
+    def __len__(self):
+        """Number of entities per epoch."""
+        return len(self._keys)
+
+    def state(self):
+        """Return the position of the shuffler, e.g. to checkpoint it.
+
+        Returns
+        -------
+        state : dict
+            Seed, epoch and position (number of entities delivered) within
+            the epoch; see `load_state`.
+        """
+        return dict(seed=self.seed, epoch=self.epoch, position=self.position,
+                    num_keys=len(self._keys))
+
+    def load_state(self, state):
+        """Resume from a state returned by `state`."""
+        if state['num_keys'] != len(self._keys):
+            raise ValueError("The state is of {} keys, not {}".format(
+                state['num_keys'], len(self._keys)))
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        self.position = state['position']
+
+    def schedule(self, epoch=None):
+        """Compute the order of an epoch, without reading anything.
+
+        Parameters
+        ----------
+        epoch : int, default=None
+            Number of the epoch; the current one if None.
+
+        Returns
+        -------
+        order : list of str
+            Keys in the order they are delivered.
+
+        reads : list of str
+            Keys in the order they are read.
+
+        num_read : np.ndarray
+            Number of keys read before each key in `order` is delivered.
+        """
+        epoch = self.epoch if epoch is None else epoch
+        rng = np.random.RandomState([self.seed, epoch])
+        num_blocks = -(-len(self._keys) // self.block_size)
+        reads = []
+        for block in rng.permutation(num_blocks):
+            start = block * self.block_size
+            reads.extend(self._keys[start:start + self.block_size])
+
+        order, num_read, buf = [], [], []
+        for count, key in enumerate(reads):
+            if len(buf) < self.buffer_size:
+                buf.append(key)
+                continue
+            idx = rng.randint(len(buf))
+            order.append(buf[idx])
+            num_read.append(count)
+            buf[idx] = key
+        order.extend(buf[idx] for idx in rng.permutation(len(buf)))
+        num_read.extend([len(reads)] * len(buf))
+        return order, reads, np.asarray(num_read, dtype=int)
+
+    def __iter__(self):
+        """Iterate over (key, entity) pairs of the rest of the current epoch;
+        the next epoch starts when it ends.
+        """
+        order, reads, num_read = self.schedule()
+        start = self.position
+        read_from = num_read[start] if start < len(order) else len(reads)
+        # Entities that were in the buffer at the position resumed from.
+        delivered = set(order[:start])
+        buffered = [key for key in reads[:read_from] if key not in delivered]
+
+        buf = dict()
+        with self.stash.iterate(keys=buffered + reads[read_from:],
+                                prefetch=self.prefetch,
+                                fields=self.fields) as entities:
+            for pos in range(start, len(order)):
+                # Reads never run ahead of the schedule's.
+                while order[pos] not in buf:
+                    key, entity = next(entities)
+                    buf[key] = entity
+                self.position = pos + 1
+                yield order[pos], buf.pop(order[pos])
+        self.epoch += 1
+        self.position = 0
@@ -5,19 +5,44 @@ import h5py
 import json
 import logging
 import numpy as np
+import os
+import six
+import weakref
+import zlib
 
+import biggie.allocator as allocator
+import biggie.cache as cache
 import biggie.core as core
+import biggie.index as biggie_index
+import biggie.keymap as keymap
+import biggie.mapped as mapped
+import biggie.packed as packed
+import biggie.stats as biggie_stats
+import biggie.storage as biggie_storage
+import biggie.stream as stream
 import biggie.util as util
 
+# Whether h5py can open files without HDF5's file locking.
+_H5PY_LOCKING = tuple(h5py.version.version_tuple[:2]) >= (3, 5)
+
 
 class Stash(object):
     """On-disk dictionary-like object."""
     __KEYMAP__ = "__KEYMAP__"
+    __KEYINDEX__ = "__KEYINDEX__"
+    __ALLOC__ = "__ALLOC__"
+    __PACKED__ = "__PACKED__"
+    __INDEX__ = "__INDEX__"
+    LAYOUTS = ('tree', 'packed')
     __WIDTH__ = 256
     __DEPTH__ = 3
 
     def __init__(self, filename, mode=None, cache_size=False,
-                 log_level=logging.INFO, keep_open=True):
+                 log_level=logging.INFO, keep_open=True, cache_bytes=None,
+                 cache_policy='lru', field_policy='lazy', field_budget=None,
+                 swmr=False, storage=None, rdcc_nbytes=None,
+                 rdcc_nslots=None, rdcc_w0=None, layout=None, mmap=False,
+                 stats=False, journal=False):
         """Create a Stash object, pointing to an hdf5 file on-disk.
 
         Parameters
@@ -25,8 +50,8 @@ class Stash(object):
         filename : str
             Path to file on disk
 
-        mode : str
-            Filemode for the object.
+        mode : str, default=None
+            Filemode for the object; None is equivalent to 'a'.
 
         cache_size : int or False-equivalent, default=False
             Number of items to keep cached internally (for speed).
@@ -35,57 +60,286 @@ class Stash(object):
             Level for setting the internal logger; see logging.X for more info.
 
         keep_open : bool, default=True
-            If True, maintain a reference to the HDF5 file, otherwise re-open
-            it when necessary; trades a slight drop in efficiency for parallel
-            reads.
+            If False, release the file handle opened during construction, so
+            that it isn't inherited by processes forked afterwards. In either
+            case, each process opens its own handle on first use and keeps it
+            until `close`.
+
+        cache_bytes : int, default=None
+            If given, upper bound on the memory held by cached entities; when
+            `cache_size` is False-equivalent, only this bound applies.
+
+        cache_policy : str, default='lru'
+            Cache eviction policy, one of 'lru' or 'lfu'; see
+            `biggie.cache.EntityCache`.
+
+        field_policy : str, default='lazy'
+            Read policy for the fields of loaded entities, one of 'lazy',
+            'memoize' or 'budget'; see `biggie.core.LazyField`.
+
+        field_budget : int, default=None
+            Bytes shared by all memoized fields under the 'budget' policy.
+
+        swmr : bool, default=False
+            Open read-only stashes in HDF5's single-writer / multiple-reader
+            mode, allowing reads while another process appends to the file.
+            The writer must have created the file with `libver='latest'`.
+
+        storage : StoragePolicy or dict, default=None
+            Chunking and filters of the fields written, for all fields or per
+            field name; see `biggie.storage`. Contiguous and unfiltered if
+            None.
+
+        rdcc_nbytes, rdcc_nslots, rdcc_w0 : int, int, float, default=None
+            Size in bytes, number of hash slots, and eviction weight of
+            HDF5's raw data chunk cache, per dataset; library defaults if
+            None. Only matters for chunked fields.
+
+        layout : str, default=None
+            How entities are laid out in the file, fixed when it is created:
+            'tree', one HDF5 group per entity, or 'packed', one dataset per
+            field, shared by all entities (see `biggie.packed`); the latter
+            suits many small entities of the same fields. If None, that of
+            the file, or 'tree' for new files.
+
+        mmap : bool, default=False
+            Read the values of contiguous, unfiltered fields as read-only
+            views of a memory map of the file, without copying them; see
+            `biggie.mapped`. Other fields are read as usual. Requires
+            `mode='r'`, as writes may not yet have reached the file.
+
+        stats : bool or stats.Recorder, default=False
+            Count and time operations, field reads, and bytes read and
+            written per field, reported by `stats`; a Recorder may be given
+            to share it, or to add hooks. See `biggie.stats`.
+
+        journal : bool, default=False
+            Make `flush` append the keymap changes since the last one to a
+            journal in the file, at a cost independent of the size of the
+            stash, rather than rewriting the keymap; `checkpoint` (and
+            `close`) fold the journal into the keymap. Journals left behind,
+            e.g. by a crash, are replayed on open either way.
+
+        Notes
+        -----
+        Stashes may be pickled, e.g. to hand them to worker processes; the
+        copies open the file read-only, as HDF5 does not support concurrent
+        writers, and without file locking, so they may read while the
+        original remains open. Close (or flush) writers before doing so.
         """
         self._filename = filename
-        self._mode = mode
+        self._mode = mode or 'a'
         self._keep_open = keep_open
+        self._swmr = swmr
+        self._storage = storage
+        self._rdcc = dict(rdcc_nbytes=rdcc_nbytes, rdcc_nslots=rdcc_nslots,
+                          rdcc_w0=rdcc_w0)
+        self._locking = True
+        self._journal = journal
+        self._stats = None
+        if stats:
+            self._stats = stats if isinstance(stats, biggie_stats.Recorder) \
+                else biggie_stats.Recorder()
         self.__handle__ = None
+        self.__pid__ = os.getpid()
+        self._handle_opens = 0
         self._cache_size = cache_size
-        self.__local__ = dict()
-        self._agu = None
+        max_items = cache_size or (None if cache_bytes else 0)
+        self.__local__ = cache.EntityCache(
+            max_items=max_items, max_bytes=cache_bytes, policy=cache_policy)
+        self._field_policy = field_policy
+        self._field_budget = None
+        if field_budget is not None:
+            self._field_budget = core.MemoryBudget(field_budget)
 
         self._logger = logging.getLogger('Stash')
         self._logger.setLevel(log_level)
+        self._keymap = self._allocator = self._packed = self._index = None
+        if mmap and self._mode != 'r':
+            raise ValueError("Memory-mapped reads require mode='r'.")
+        self._filemap = mapped.FileMap(filename) if mmap else None
+        self.__load_layout__(layout)
         self.__load_keymap__()
+        self.__load_allocator__()
+        if self._layout == 'packed':
+            self._packed = packed.PackedStore(
+                self.__root__(), name=self.__PACKED__, storage=storage)
+        self.__load_index__()
+        if self._keymap.recovered and self._mode != 'r':
+            self.checkpoint()
+        if not keep_open:
+            self.__release__()
 
     @property
     def _fhandle(self):
-        fh = None
-        if self.__handle__ is None:
-            fh = h5py.File(name=self._filename, mode=self._mode)
-        if self._keep_open and fh:
-            self.__handle__ = fh
-        return self.__handle__ if self.__handle__ is not None else fh
+        """The HDF5 file handle of the current process, opened as needed."""
+        if self.__pid__ != os.getpid():
+            # Forked; the handle belongs to the parent, so leave it be.
+            self.__handle__ = None
+            self.__pid__ = os.getpid()
+        if not self.__handle__:
+            kwargs = dict((k, v) for k, v in six.iteritems(self._rdcc)
+                          if v is not None)
+            if self._swmr and self._mode == 'r':
+                kwargs['swmr'] = True
+            if not self._locking and _H5PY_LOCKING:
+                kwargs['locking'] = False
+            self.__handle__ = h5py.File(
+                name=self._filename, mode=self._mode, **kwargs)
+            self._handle_opens += 1
+            if self._mode in ('w', 'w-', 'x'):
+                # Created; reopening (e.g. after `compact`) must not
+                # truncate the file, nor fail because it exists.
+                self._mode = 'a'
+        return self.__handle__
+
+    def __release__(self):
+        """Close the file handle of this process, if open, without flushing.
+
+        The next access reopens the file.
+        """
+        if self.__pid__ == os.getpid() and self.__handle__:
+            self.__handle__.close()
+        self.__handle__ = None
+
+    def __getstate__(self):
+        """Pickle everything but the file handle and in-memory caches."""
+        state = self.__dict__.copy()
+        state['__handle__'] = None
+        state['__local__'] = cache.EntityCache(
+            max_items=self.__local__.max_items,
+            max_bytes=self.__local__.max_bytes, policy=self.__local__.policy)
+        if self._field_budget is not None:
+            state['_field_budget'] = core.MemoryBudget(
+                self._field_budget.max_bytes)
+        if self._stats is not None:
+            state['_stats'] = biggie_stats.Recorder()
+        return state
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._mode = 'r'
+        self._locking = False
+        self._keymap._root = self.__root__()
+        self._allocator._root = self.__root__()
+        if self._packed is not None:
+            self._packed._root = self.__root__()
+        self._index._root = self.__root__()
+
+    def __root__(self):
+        """Return a function returning the root group of the HDF5 file.
+
+        The stash is only weakly referenced, so that the keymap and allocator
+        holding on to the function don't keep it (and its file) alive.
+        """
+        ref = weakref.ref(self)
+        return lambda: ref()._fhandle
+
+    def __load_layout__(self, layout):
+        """Determine the layout of the file, recording it for new files."""
+        if layout is not None and layout not in self.LAYOUTS:
+            raise ValueError("Unsupported layout '{}'; must be one of {}"
+                             "".format(layout, self.LAYOUTS))
+        fhandle = self._fhandle
+        current = fhandle.attrs.get('layout')
+        if current is None:
+            # Files without entities may still pick a layout.
+            current = 'tree'
+            if layout is not None and self._mode != 'r' and \
+                    not [k for k in fhandle if k != self.__KEYINDEX__]:
+                fhandle.attrs['layout'] = current = layout
+        current = six.ensure_str(current)
+        if layout is not None and layout != current:
+            raise ValueError("Layout mismatch: requested '{}', but the file "
+                             "is '{}'".format(layout, current))
+        self._layout = current
+
+    @property
+    def layout(self):
+        """How entities are laid out in the file, 'tree' or 'packed'."""
+        return self._layout
+
+    def __row__(self, addr):
+        """Return the row of an address in the packed layout."""
+        return util.hexkey_to_index(addr, self.__WIDTH__)
+
+    @biggie_stats.timed('keymap_load')
     def __load_keymap__(self):
-        if not self._fhandle or self.__KEYMAP__ not in self._fhandle:
-            self._keymap = dict()
-        else:
-            keymap_dset = self._fhandle.get(self.__KEYMAP__)
-            self._keymap = json.loads(str(keymap_dset.value))
+        """Open the keymap, migrating a legacy JSON keymap if present."""
+        self._keymap = keymap.Keymap(
+            self.__root__(), name=self.__KEYINDEX__,
+            legacy_name=self.__KEYMAP__, journal=self._journal)
 
+    @biggie_stats.timed('keymap_dump')
     def __dump_keymap__(self):
-        if self.__KEYMAP__ in self._fhandle:
-            del self._fhandle[self.__KEYMAP__]
+        if self._mode != 'r':
+            # The keymap goes last, as flushing it empties the journal.
+            for part in (self._packed, self._index, self._allocator,
+                         self._keymap):
+                if part is not None:
+                    part.flush()
 
-        self._fhandle.create_dataset(
-            name=self.__KEYMAP__,
-            data=np.str(json.dumps(self._keymap)))
+    def __load_allocator__(self):
+        """Open the address allocator, deriving its state for older files."""
+        self._allocator = allocator.AddressAllocator(
+            self.__root__(), name=self.__ALLOC__, depth=self.__DEPTH__,
+            width=self.__WIDTH__, used=self.__addrs__)
+        # Changes replayed from the journal postdate the allocator's state.
+        if self._keymap.recovered:
+            self._allocator.reconcile(
+                (old, new) for key, old, new in self._keymap.recovered)
+
+    def __load_index__(self):
+        """Open the secondary indexes, updating them with any changes
+        replayed from the journal.
+        """
+        self._index = biggie_index.SecondaryIndex(
+            self.__root__(), name=self.__INDEX__)
+        if not self._index.fields or not self._keymap.recovered:
+            return
+        keys = set()
+        for key, old, new in self._keymap.recovered:
+            for addr in (old, new):
+                if addr is not None:
+                    self._index.remove(self.__row__(addr))
+            keys.add(key)
+        for key in keys:
+            if key in self._keymap:
+                self._index.put(self.__row__(self._keymap[key]), key,
+                                self._index.extract(self.__load__(key)))
+
+    @biggie_stats.timed('flush')
+    def flush(self):
+        """Make the changes made so far durable.
+
+        With a journal, only the keymap changes since the last flush are
+        written; otherwise, this is a `checkpoint`.
+        """
+        if self._mode == 'r':
+            return
+        if not self._keymap.journal:
+            return self.checkpoint()
+        if self._packed is not None:
+            self._packed.flush()
+        self._keymap.sync()
+        self._fhandle.flush()
+
+    def checkpoint(self):
+        """Write the keymap and allocator in full, emptying the journal."""
+        if self._mode == 'r':
+            return
+        self.__dump_keymap__()
+        self._fhandle.flush()
 
     @property
     def agu(self):
-        """Currently, this lil guy causes problems with parallelization.
+        """Address generating unit; see `allocator.AddressAllocator`.
 
-        TODO: The AGU should be superseded by a "figure-out-the-next-address"
-        function, based on the state of the keymap. In the meantime, converting
-        the generator to a class might suffice...
+        Addresses are computed in constant time and the allocator's state
+        lives in the file, so appends to a reopened stash need not skip past
+        the addresses already in use.
         """
-        if self._agu is None:
-            self._agu = util.uniform_hexgen(self.__DEPTH__, self.__WIDTH__)
-        return self._agu
+        return self._allocator
 
     def __del__(self):
         """Safe default destructor"""
@@ -93,22 +347,60 @@ class Stash(object):
 
     def close(self):
         """write keys and paths to disk"""
-        self.__dump_keymap__()
-        if self.__handle__:
-            self.__handle__ = self.__handle__.close()
+        if self.__pid__ == os.getpid():
+            # Weak references to the stash are already cleared when collected
+            # as part of a reference cycle, so flush through strong ones.
+            parts = [part for part in (self._packed, self._index,
+                                       self._keymap, self._allocator)
+                     if part is not None]
+            roots = [part._root for part in parts]
+            for part in parts:
+                part._root = lambda: self._fhandle
+            try:
+                self.__dump_keymap__()
+            finally:
+                for part, root in zip(parts, roots):
+                    part._root = root
+        self.__release__()
 
-    def __load__(self, key):
-        """Deeply load an entity from the base HDF5 file."""
+    def __load__(self, key, fields=None):
+        """Deeply load an entity (or only some of its fields) from the base
+        HDF5 file."""
         addr = self._keymap[key]
-        raw_group = self._fhandle.get(addr)
-        raw_key = raw_group.attrs.get("key")
-        if raw_key != key:
-            raise ValueError("Key inconsistency: received '{}'"
-                             ", expected '{}'".format(raw_key, key))
-        self._logger.debug("Loading {}".format(key))
-        return core.Entity.from_hdf5_group(raw_group)
-
-    def get(self, key, default=None):
+        if self._packed is not None:
+            entity = self._packed.load(self.__row__(addr),
+                                       policy=self._field_policy,
+                                       budget=self._field_budget,
+                                       fields=fields)
+        else:
+            raw_group = self._fhandle.get(addr)
+            if raw_group is None:
+                raise IOError(
+                    "Can't resolve the group of '{}' at '{}'; if it's linked "
+                    "from another stash (see `merge`), that file may be "
+                    "missing, or open read-only in this process."
+                    "".format(key, addr))
+            raw_key = raw_group.attrs.get("key")
+            if raw_key != key:
+                raise ValueError("Key inconsistency: received '{}'"
+                                 ", expected '{}'".format(raw_key, key))
+            self._logger.debug("Loading {}".format(key))
+            # Groups merged as external links live in other files.
+            if self._filemap is not None and \
+                    raw_group.file.id == self._fhandle.id:
+                entity = mapped.load_group(
+                    raw_group, self._filemap, policy=self._field_policy,
+                    budget=self._field_budget, fields=fields)
+            else:
+                entity = core.Entity.from_hdf5_group(
+                    raw_group, policy=self._field_policy,
+                    budget=self._field_budget, fields=fields)
+        if self._stats is not None:
+            self._stats.instrument(entity)
+        return entity
+
+    @biggie_stats.timed('get')
+    def get(self, key, default=None, fields=None):
         """Fetch the entity for a given key.
 
         Parameters
@@ -118,24 +410,221 @@ class Stash(object):
 
         default : object
             If given, default return entity on unfound keys.
+
+        fields : iterable of str, default=None
+            Fields to get, in order; if None, all of them. Other fields are
+            neither read nor looked up on disk.
+
+        Raises
+        ------
+        KeyError
+            If the entity lacks any of the given fields.
         """
+        if key not in self._keymap:
+            return default
+        fields = None if fields is None else list(fields)
+
+        if not self.__local__.enabled:
+            return self.__load__(key, fields)
+
         # Check local cache for the data first.
         entity = self.__local__.get(key, None)
 
-        # If key is not in local (entity == None), go get that sucker.
-        entity = self.__load__(key) if entity is None else entity
+        if entity is not None and fields is not None:
+            projection = core.Entity()
+            for field in fields:
+                projection.__set_field__(field, entity[field])
+            return projection
 
-        # Caching logic.
-        if self._cache_size > 0 and (len(self.__local__) >= self._cache_size):
-            # TODO: Pick a entity and ditch it.
-            pass
+        # Partial entities aren't cached, lest they shadow the full ones.
+        if entity is None and fields is not None:
+            return self.__load__(key, fields)
 
-        if self._cache_size > 0:
-            self.__local__[key] = entity
+        # If key is not in local (entity == None), go get that sucker; cached
+        # entities are materialized, lest a hit still go to disk.
+        if entity is None:
+            entity = self.__load__(key).materialize()
+            self.__local__.put(key, entity)
 
         return entity
 
-    def add(self, key, entity, overwrite=False):
+    def cache_info(self):
+        """Return hit / miss counters and occupancy of the entity cache."""
+        return self.__local__.info()
+
+    @property
+    def recorder(self):
+        """The stats.Recorder of an instrumented stash, or None."""
+        return self._stats
+
+    def stats(self):
+        """Return the statistics of the stash.
+
+        Returns
+        -------
+        stats : dict
+            Entity cache statistics ('cache'; see `cache_info`) and the
+            number of times this process opened the file ('handle_opens');
+            for instrumented stashes, also latency summaries keyed by
+            operation ('ops'), and bytes read and written keyed by field
+            ('bytes_read', 'bytes_written'); see `stats.Recorder.summary`.
+        """
+        result = dict(cache=self.cache_info(),
+                      handle_opens=self._handle_opens)
+        if self._stats is not None:
+            result.update(self._stats.summary())
+        return result
+
+    @biggie_stats.timed('get_many')
+    def get_many(self, keys, fields=None):
+        """Fetch a batch of entities as a dictionary of stacked arrays.
+
+        Reads are issued in row order (that in which addresses were
+        allocated), and each field is read directly into a single
+        preallocated array; this is considerably cheaper than calling `get`
+        per key and stacking the results.
+
+        Parameters
+        ----------
+        keys : iterable of str
+            Keys of the entities to get; all must share the same fields, and
+            each field must have the same shape across entities.
+
+        fields : iterable of str, default=None
+            Fields to read; if None, all fields of the first entity.
+
+        Returns
+        -------
+        arrays : dict of np.ndarrays
+            Values keyed by field, with the batch along the first axis, in the
+            same order as `keys`.
+        """
+        keys = list(keys)
+        if not keys:
+            return dict()
+
+        # Schema is taken from the metadata of the first entity.
+        entity = self.__load__(keys[0], fields)
+        fields = entity.keys() if fields is None else list(fields)
+        out = dict()
+        for field in fields:
+            value = entity[field]
+            out[field] = np.empty((len(keys),) + value.shape,
+                                  dtype=value.dtype)
+        return self.read_into(keys, out)
+
+    @biggie_stats.timed('read_into')
+    def read_into(self, keys, out):
+        """Read a batch of entities into preallocated arrays.
+
+        Parameters
+        ----------
+        keys : iterable of str
+            Keys of the entities to read.
+
+        out : dict of np.ndarrays
+            Arrays keyed by field name, each shaped (len(keys), ...), into
+            which the fields of the i-th key are written at index i.
+
+        Returns
+        -------
+        out : dict of np.ndarrays
+            The arrays given, now filled.
+        """
+        keys = list(keys)
+        addrs = [self._keymap[key] for key in keys]
+        fields = [(field.encode('utf-8'), field, arr)
+                  for field, arr in six.iteritems(out)]
+        fid = self._fhandle.id
+        order = [self.__row__(addr) for addr in addrs]
+        num_read = 0
+        for idx in sorted(range(len(keys)), key=order.__getitem__):
+            if keys[idx] in self.__local__:
+                entity = self.__local__.get(keys[idx])
+                for name, field, arr in fields:
+                    arr[idx] = entity[field].value
+                continue
+
+            if self._packed is not None:
+                entity = self.__load__(keys[idx], list(out))
+                for name, field, arr in fields:
+                    value = entity[field]
+                    if value.shape != arr.shape[1:]:
+                        raise ValueError(
+                            "Shape mismatch for '{}' in '{}': received {}, "
+                            "expected {}".format(field, keys[idx],
+                                                 value.shape, arr.shape[1:]))
+                    value.read_direct(arr, dest_sel=idx)
+                continue
+
+            # Low-level reads, sidestepping the high-level object overhead.
+            gid = h5py.h5g.open(fid, addrs[idx].encode('utf-8'))
+            for name, field, arr in fields:
+                dsid = h5py.h5d.open(gid, name)
+                if dsid.shape != arr.shape[1:]:
+                    raise ValueError(
+                        "Shape mismatch for '{}' in '{}': received {}, "
+                        "expected {}".format(field, keys[idx], dsid.shape,
+                                             arr.shape[1:]))
+                dest = arr[idx, ...]
+                if arr.dtype.hasobject or not dest.flags.c_contiguous:
+                    arr[idx] = core._read(h5py.Dataset(dsid))
+                else:
+                    dsid.read(h5py.h5s.ALL, h5py.h5s.ALL, dest)
+            num_read += 1
+
+        if self._stats is not None:
+            # Reads of packed fields are recorded by the fields themselves.
+            for name, field, arr in fields:
+                self._stats.read(field, num_read * arr[0].nbytes
+                                 if len(arr) else 0)
+        return out
+
+    def iterate(self, keys=None, prefetch=16, workers=1, fields=None,
+                ordered=True, backend='thread'):
+        """Iterate over (key, entity) pairs, reading ahead in the background.
+
+        >>> with stash.iterate(prefetch=32) as entities:
+        ...     for key, entity in entities:
+        ...         consume(entity)
+
+        Entities are read into memory by `workers` threads or processes,
+        never more than `prefetch` ahead of the consumer; see
+        `stream.Prefetcher` for details. While iterating with threads, the
+        stash should not be used from other threads.
+
+        Parameters
+        ----------
+        keys : iterable of str, default=None
+            Keys to read; if None, all keys in the stash.
+
+        prefetch : int, default=16
+            Maximum number of entities read ahead of the consumer.
+
+        workers : int, default=1
+            Number of threads or processes reading entities.
+
+        fields : iterable of str, default=None
+            Fields to read; if None, all of them.
+
+        ordered : bool, default=True
+            If True, entities are delivered in the order of `keys`; otherwise
+            as soon as they are read.
+
+        backend : str, default='thread'
+            One of 'thread' or 'process'.
+
+        Returns
+        -------
+        entities : stream.Prefetcher
+            Iterator over (key, entity) pairs.
+        """
+        return stream.Prefetcher(
+            self, keys=keys, prefetch=prefetch, workers=workers,
+            fields=fields, ordered=ordered, backend=backend)
+
+    @biggie_stats.timed('add')
+    def add(self, key, entity, overwrite=False, storage=None):
         """Add a key-entity pair to the Stash.
 
         Parameters
@@ -148,31 +637,222 @@ class Stash(object):
 
         overwrite : bool, default=False
             Overwrite the key-entity pair if the key currently exists.
+
+        storage : StoragePolicy or dict, default=None
+            Chunking and filters of the fields; the stash's if None.
         """
-        # TODO(ejhumphrey): update locals!!
         key = str(key)
+        if key in self._keymap and not overwrite:
+            raise ValueError(
+                "Data exists for '{}'; did you mean `overwrite=True?`"
+                "".format(key))
+
+        # Validate before removing anything, lest a rejected entity cost the
+        # one it was to replace.
+        indexed = self._index.extract(entity)
+        items = entity.items()
+        if self._packed is not None:
+            self._packed.check(items)
         if key in self._keymap:
-            if not overwrite:
-                raise ValueError(
-                    "Data exists for '{}'; did you mean `overwrite=True?`"
-                    "".format(key))
-            else:
-                addr = self.remove(key)
-        else:
-            addr = next(self.agu)
+            self.remove(key)
 
-        while addr in self._fhandle:
-            addr = next(self.agu)
+        if self._packed is not None:
+            addr = self._allocator.allocate()
+            try:
+                self._packed.add(self.__row__(addr), key, items)
+            except ValueError:
+                self._allocator.release(addr)
+                raise
+            self._keymap[key] = addr
+            self._index.put(self.__row__(addr), key, indexed)
+            if self._stats is not None:
+                for field, value in items:
+                    self._stats.written(field, np.asarray(value).nbytes)
+            return
 
-        self._keymap[key] = addr
+        while True:
+            addr = self._allocator.allocate()
+            try:
+                grp = self._fhandle.create_group(addr)
+                break
+            except ValueError:
+                # Orphaned group, not in the keymap; skip it.
+                self._logger.warning("Skipping orphaned address {}"
+                                     "".format(addr))
 
-        grp = self._fhandle.create_group(addr)
+        self._keymap[key] = addr
+        self._index.put(self.__row__(addr), key, indexed)
         grp.attrs['key'] = key
-        for field, value in entity.items():
-            grp.create_dataset(name=field, data=value)
+        storage = self._storage if storage is None else storage
+        for field, value in items:
+            policy = biggie_storage.resolve(storage, field)
+            kwargs = policy.dataset_kwargs(value) if policy else dict()
+            grp.create_dataset(name=field, data=value, **kwargs)
+            if self._stats is not None:
+                self._stats.written(field, np.asarray(value).nbytes)
             # for k, v in six.iteritems(dict(**dset.attrs)):
             #     dset.attrs.create(name=k, data=v)
 
+    def bulk_writer(self, overwrite=False, block_size=1024, storage=None):
+        """Return a context-managed writer for adding many entities at once.
+
+        >>> with stash.bulk_writer() as writer:
+        ...     for key, entity in items:
+        ...         writer.add(key, entity)
+
+        See `BulkWriter` for details.
+        """
+        return BulkWriter(self, overwrite=overwrite, block_size=block_size,
+                          storage=storage)
+
+    @biggie_stats.timed('add_many')
+    def add_many(self, items, overwrite=False, storage=None):
+        """Add a number of key-entity pairs to the Stash.
+
+        Equivalent to calling `add` for each pair, but considerably faster
+        for large numbers of entities; the keymap is committed once, at the
+        end.
+
+        Parameters
+        ----------
+        items : iterable of (key, entity) pairs
+            Data to write to file.
+
+        overwrite : bool, default=False
+            Overwrite key-entity pairs for keys that currently exist.
+
+        storage : StoragePolicy or dict, default=None
+            Chunking and filters of the fields; the stash's if None.
+
+        Returns
+        -------
+        count : int
+            Number of entities added.
+        """
+        with self.bulk_writer(overwrite=overwrite, storage=storage) as writer:
+            for key, entity in items:
+                writer.add(key, entity)
+        return writer.count
+
+    @biggie_stats.timed('merge')
+    def merge(self, other, keys=None, on_conflict='error', link=False):
+        """Copy entities from another stash into this one.
+
+        Entities are copied as HDF5 objects, without decoding their fields,
+        in the address order of `other`, to freshly allocated addresses;
+        only their key attribute is rewritten, if renamed. Stashes of the
+        packed layout are copied an entity at a time instead, through a
+        bulk writer.
+
+        Parameters
+        ----------
+        other : Stash
+            Stash to copy from.
+
+        keys : iterable of str or dict, default=None
+            Keys of the entities to copy, or a mapping from these to the keys
+            to copy them under; if None, all keys of `other`.
+
+        on_conflict : str, default='error'
+            What to do with keys already in this stash: 'error' raises a
+            ValueError before copying anything, 'skip' keeps the entities
+            of this stash, and 'overwrite' replaces them.
+
+        link : bool, default=False
+            Link to the entities of `other` as HDF5 external links, by the
+            absolute path of its file, instead of copying them; `other`
+            must then remain in place. Requires the tree layout and keys
+            that aren't renamed. HDF5 can't resolve links into a file open
+            read-only in the same process, so linked entities can't be read
+            while `other` (or any stash of its file) is open with mode='r'.
+
+        Returns
+        -------
+        count : int
+            Number of entities copied (or linked).
+        """
+        if self._mode == 'r':
+            raise ValueError("Can't merge into a read-only stash.")
+        if on_conflict not in ('error', 'skip', 'overwrite'):
+            raise ValueError("Unsupported value for `on_conflict`: '{}'"
+                             "".format(on_conflict))
+        if keys is None:
+            pairs = [(key, key) for key in other.keys()]
+        elif isinstance(keys, dict):
+            pairs = [(src, str(dst)) for src, dst in six.iteritems(keys)]
+        else:
+            pairs = [(key, key) for key in keys]
+        for src, dst in pairs:
+            if src not in other._keymap:
+                raise KeyError("The key '{}' does not exist.".format(src))
+        seen = set()
+        for src, dst in pairs:
+            if dst in seen:
+                raise ValueError("Several entities would be copied to '{}'."
+                                 "".format(dst))
+            seen.add(dst)
+        tree = self._packed is None and other._packed is None
+        if link and not (tree and all(src == dst for src, dst in pairs)):
+            raise ValueError("Merging as links requires the tree layout, "
+                             "and keys that aren't renamed.")
+
+        conflicts = [dst for src, dst in pairs if dst in self._keymap]
+        if conflicts and on_conflict == 'error':
+            raise ValueError(
+                "Data exists for '{}' ({} keys in all); did you mean "
+                "`on_conflict='overwrite'`?".format(conflicts[0],
+                                                    len(conflicts)))
+        elif conflicts and on_conflict == 'skip':
+            conflicts = set(conflicts)
+            pairs = [(src, dst) for src, dst in pairs if dst not in conflicts]
+        else:
+            for dst in conflicts:
+                self.remove(dst)
+
+        if not tree:
+            with self.bulk_writer() as writer:
+                for src, dst in pairs:
+                    writer.add(dst, other.__load__(src))
+            return writer.count
+
+        # Read the source sequentially.
+        pairs = sorted(((src, dst, other._keymap[src]) for src, dst in pairs),
+                       key=lambda item: other.__row__(item[2]))
+        fhandle, filename = self._fhandle, os.path.abspath(other._filename)
+        src_id = other._fhandle.id
+        lcpl = h5py.h5p.create(h5py.h5p.LINK_CREATE)
+        lcpl.set_create_intermediate_group(True)
+        addrs = self._allocator.allocate_many(len(pairs))
+        addrs.reverse()
+        pending = dict()
+        for src, dst, src_addr in pairs:
+            while True:
+                addr = addrs.pop() if addrs else self._allocator.allocate()
+                try:
+                    if link:
+                        fhandle.id.links.create_external(
+                            addr.encode('utf-8'), filename.encode('utf-8'),
+                            src_addr.encode('utf-8'), lcpl=lcpl)
+                    else:
+                        h5py.h5o.copy(src_id, src_addr.encode('utf-8'),
+                                      fhandle.id, addr.encode('utf-8'),
+                                      lcpl=lcpl)
+                    break
+                except RuntimeError:
+                    # Orphaned group, not in the keymap; skip it.
+                    self._logger.warning("Skipping orphaned address {}"
+                                         "".format(addr))
+            if src != dst:
+                fhandle[addr].attrs['key'] = dst
+            if self._index.fields:
+                self._index.put(self.__row__(addr), dst, self._index.extract(
+                    other.__load__(src)))
+            pending[dst] = addr
+        self._keymap.update(pending)
+        self.flush()
+        return len(pending)
+
+    @biggie_stats.timed('remove')
     def remove(self, key):
         """Delete a key-entity pair from the stash.
 
@@ -190,7 +870,13 @@ class Stash(object):
         if addr is None:
             raise KeyError("The key '{}' does not exist.".format(key))
 
-        del self._fhandle[addr]
+        self.__local__.pop(key)
+        if self._packed is not None:
+            self._packed.remove(self.__row__(addr))
+        else:
+            del self._fhandle[addr]
+        self._index.remove(self.__row__(addr))
+        self._allocator.release(addr)
         return addr
 
     def keys(self):
@@ -203,3 +889,612 @@ class Stash(object):
 
     def __len__(self):
         return len(self.keys())
+
+    @property
+    def indexes(self):
+        """Names of the fields with a secondary index; see `create_index`."""
+        return self._index.fields
+
+    def create_index(self, field):
+        """Index the values of a scalar field, for `select`.
+
+        The values of the field are read from every entity once; the index
+        is then kept up to date as entities are added and removed. See
+        `biggie.index` for details.
+
+        Parameters
+        ----------
+        field : str
+            Name of the field; its values must be numbers, booleans or
+            strings, all of the same kind.
+        """
+        if self._mode == 'r':
+            raise ValueError("Can't index a read-only stash.")
+        if field in self._index.fields:
+            raise ValueError("The field '{}' is indexed already."
+                             "".format(field))
+
+        def items():
+            for key, addr in six.iteritems(self._keymap):
+                entity = self.__load__(key)
+                if field in entity.keys():
+                    yield self.__row__(addr), key, entity[field].value
+
+        self._index.create(field, items())
+
+    def drop_index(self, field):
+        """Remove the index of a field."""
+        if self._mode == 'r':
+            raise ValueError("Can't drop an index of a read-only stash.")
+        self._index.drop(field)
+
+    @biggie_stats.timed('select')
+    def select(self, expr):
+        """Return the keys of the entities matching an expression over
+        indexed fields, without loading any entity.
+
+        >>> stash.select('(label == 3) & (duration > 10)')
+        >>> stash.select(lambda fields: np.isin(fields['label'], [1, 2]))
+
+        Parameters
+        ----------
+        expr : str or callable
+            Expression evaluating to a boolean array over the columns of
+            indexed fields; see `index.SecondaryIndex.select`. Strings are
+            evaluated with `eval`, so must come from trusted input; use a
+            callable otherwise.
+
+        Returns
+        -------
+        keys : list of str
+            Keys of the matching entities, in address order.
+        """
+        return self._index.select(expr)
+
+    def __ordered_items__(self, order):
+        """Return the (key, addr) pairs of the stash, in the given order."""
+        if order is None:
+            return sorted(six.iteritems(self._keymap),
+                          key=lambda item: self.__row__(item[1]))
+        elif order == 'key':
+            return list(six.iteritems(self._keymap))
+        elif isinstance(order, six.string_types):
+            raise ValueError("Unsupported order '{}'; must be None, 'key' "
+                             "or an iterable of keys".format(order))
+
+        items, seen = [], set()
+        for key in order:
+            if key in seen:
+                continue
+            addr = self._keymap.get(key)
+            if addr is None:
+                raise KeyError("The key '{}' does not exist.".format(key))
+            items.append((key, addr))
+            seen.add(key)
+        # Everything else follows, in address order.
+        items.extend(item for item in self.__ordered_items__(None)
+                     if item[0] not in seen)
+        return items
+
+    @biggie_stats.timed('repack')
+    def repack(self, dest, order=None, **kwargs):
+        """Copy the live entities of the stash into a new file.
+
+        Space freed by `remove` (and `add` with `overwrite=True`) is never
+        reclaimed by HDF5; the copy leaves it behind, along with orphaned
+        groups, and lays out entities contiguously in the order given.
+
+        Entities are streamed one at a time: groups are copied by HDF5
+        itself (keeping their chunking and filters), and packed entities
+        are buffered by the new stash as usual.
+
+        Parameters
+        ----------
+        dest : str
+            Path of the new file; must not exist.
+
+        order : None, 'key' or iterable of str, default=None
+            Order of the entities in the new file: that of their addresses
+            (i.e. that of this file) if None, sorted by key if 'key', or that
+            of the given keys, e.g. an expected access order, followed by
+            any others in address order.
+
+        kwargs
+            Further arguments of the new Stash. Its layout is that of this
+            one, unless given; entities are then copied through a bulk
+            writer, as by `merge`.
+
+        Returns
+        -------
+        stash : Stash
+            The new stash.
+        """
+        if os.path.exists(dest):
+            raise ValueError("The file '{}' already exists.".format(dest))
+        layout = kwargs.pop('layout', None) or self.layout
+        items = self.__ordered_items__(order)
+        # Write out pending changes, which copies would otherwise miss.
+        self.__dump_keymap__()
+        stash = Stash(dest, mode='a', layout=layout, **kwargs)
+
+        if layout != self.layout:
+            stash.merge(self, keys=[key for key, addr in items])
+            addrs = [stash._keymap[key] for key, addr in items]
+        elif self._packed is not None:
+            addrs = stash.agu.reserve(len(items))
+            for (key, addr), new_addr in zip(items, addrs):
+                entity = self._packed.load(self.__row__(addr))
+                stash._packed.add(stash.__row__(new_addr), key,
+                                  entity.items())
+                stash._keymap[key] = new_addr
+        else:
+            addrs = stash.agu.reserve(len(items))
+            src, dst = self._fhandle.id, stash._fhandle.id
+            lcpl = h5py.h5p.create(h5py.h5p.LINK_CREATE)
+            lcpl.set_create_intermediate_group(True)
+            for (key, addr), new_addr in zip(items, addrs):
+                h5py.h5o.copy(src, addr.encode('utf-8'), dst,
+                              new_addr.encode('utf-8'), lcpl=lcpl)
+                stash._keymap[key] = new_addr
+        # Indexes move along with their rows.
+        rows = [(stash.__row__(new_addr), key,
+                 self._index.row(self.__row__(addr)))
+                for (key, addr), new_addr in zip(items, addrs)
+                ] if self._index.fields else []
+        for field in self._index.fields:
+            stash._index.create(field, (
+                (row, key, values[field]) for row, key, values in rows
+                if field in values), dtype=self._index.dtype(field))
+        stash.__dump_keymap__()
+        return stash
+
+    def compact(self, order=None):
+        """Reclaim the space left by removed and overwritten entities.
+
+        The stash is repacked (see `repack`) into a temporary file next to
+        it, which then replaces the original. Other handles on the file,
+        e.g. in pickled copies of the stash, must be closed beforehand.
+
+        Parameters
+        ----------
+        order : None, 'key' or iterable of str, default=None
+            Order of the entities in the compacted file; see `repack`.
+
+        Returns
+        -------
+        freed : int
+            Number of bytes by which the file shrank.
+        """
+        if self._mode == 'r':
+            raise ValueError("Can't compact a read-only stash.")
+        size = os.path.getsize(self._filename)
+        tmp_name = '{}.compact-{}'.format(self._filename, os.getpid())
+        try:
+            self.repack(tmp_name, order=order, storage=self._storage).close()
+            self.close()
+            os.rename(tmp_name, self._filename)
+        finally:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+
+        self.__local__.clear()
+        self.__load_keymap__()
+        self.__load_allocator__()
+        if self._packed is not None:
+            self._packed = packed.PackedStore(
+                self.__root__(), name=self.__PACKED__, storage=self._storage)
+        self.__load_index__()
+        if not self._keep_open:
+            self.__release__()
+        return size - os.path.getsize(self._filename)
+
+
+class BulkWriter(object):
+    """Fast, deferred-commit ingestion of entities into a Stash.
+
+    Compared to `Stash.add`, addresses are allocated a block at a time,
+    groups and datasets are created through the low-level h5py API with
+    property lists reused across entities of the same schema, and the keymap
+    is updated (and written to disk) once, on `commit`.
+
+    Fields holding strings or objects fall back to h5py's `create_dataset`.
+    Stashes with the packed layout buffer entities themselves, so these are
+    simply passed on to `Stash.add`.
+    """
+
+    def __init__(self, stash, overwrite=False, block_size=1024, storage=None):
+        """Create a bulk writer.
+
+        Parameters
+        ----------
+        stash : Stash
+            Stash to write into.
+
+        overwrite : bool, default=False
+            Overwrite key-entity pairs for keys that currently exist.
+
+        block_size : int, default=1024
+            Number of addresses to allocate at a time.
+
+        storage : StoragePolicy or dict, default=None
+            Chunking and filters of the fields; the stash's if None.
+        """
+        self._stash = stash
+        self._storage = stash._storage if storage is None else storage
+        self._stats = stash._stats
+        self._overwrite = overwrite
+        self._block_size = block_size
+        self._pending = dict()
+        self._addrs = list()
+        self._specs = dict()
+        self._lcpl = h5py.h5p.create(h5py.h5p.LINK_CREATE)
+        self._lcpl.set_create_intermediate_group(True)
+        self._key_dtype = h5py.special_dtype(vlen=six.text_type)
+        self._key_tid = h5py.h5t.py_create(self._key_dtype, logical=True)
+        self._scalar = h5py.h5s.create(h5py.h5s.SCALAR)
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Groups written so far are on disk, so commit regardless.
+        self.commit()
+
+    def __next_addr__(self):
+        if not self._addrs:
+            self._addrs = self._stash.agu.allocate_many(self._block_size)
+            self._addrs.reverse()
+        return self._addrs.pop()
+
+    def __spec__(self, field, value):
+        """Return a cached (type, space, dcpl) triple for a field schema."""
+        spec_key = (field, value.dtype.str, value.shape)
+        if spec_key not in self._specs:
+            tid = h5py.h5t.py_create(value.dtype, logical=True)
+            if value.shape:
+                space = h5py.h5s.create_simple(value.shape)
+            else:
+                space = self._scalar
+            policy = biggie_storage.resolve(self._storage, field)
+            if policy is None:
+                dcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+            else:
+                dcpl = policy.dcpl(value.shape, value.dtype)
+            self._specs[spec_key] = (tid, space, dcpl)
+        return self._specs[spec_key]
+
+    @biggie_stats.timed('bulk_add')
+    def add(self, key, entity):
+        """Write a key-entity pair, deferring the keymap update.
+
+        Parameters
+        ----------
+        key : str
+            Key to write the entity under.
+
+        entity : Entity or dict
+            Data to write to file.
+        """
+        key = str(key)
+        if self._stash.layout == 'packed':
+            self._stash.add(key, entity, overwrite=self._overwrite)
+            self.count += 1
+            return
+
+        exists = key in self._pending or key in self._stash._keymap
+        if exists and not self._overwrite:
+            raise ValueError(
+                "Data exists for '{}'; did you mean `overwrite=True?`"
+                "".format(key))
+
+        # Validate before removing anything; see `Stash.add`.
+        indexed = self._stash._index.extract(entity)
+        if key in self._pending:
+            addr = self._pending.pop(key)
+            del self._stash._fhandle[addr]
+            self._addrs.append(addr)
+        elif exists:
+            self._stash.remove(key)
+
+        fhandle = self._stash._fhandle
+        while True:
+            addr = self.__next_addr__()
+            try:
+                gid = h5py.h5g.create(fhandle.id, addr.encode('utf-8'),
+                                      lcpl=self._lcpl)
+                break
+            except ValueError:
+                # Orphaned group, not in the keymap; skip it.
+                continue
+
+        aid = h5py.h5a.create(gid, b'key', self._key_tid, self._scalar)
+        aid.write(np.array(key, dtype=self._key_dtype))
+        for field, value in entity.items():
+            arr = np.asarray(value)
+            if arr.dtype.hasobject or arr.dtype.kind in 'SU':
+                policy = biggie_storage.resolve(self._storage, field)
+                kwargs = policy.dataset_kwargs(value) if policy else dict()
+                h5py.Group(gid).create_dataset(name=field, data=value,
+                                               **kwargs)
+            else:
+                tid, space, dcpl = self.__spec__(field, arr)
+                dsid = h5py.h5d.create(gid, field.encode('utf-8'), tid, space,
+                                       dcpl=dcpl)
+                dsid.write(h5py.h5s.ALL, h5py.h5s.ALL,
+                           np.ascontiguousarray(arr))
+            if self._stats is not None:
+                self._stats.written(field, arr.nbytes)
+
+        self._pending[key] = addr
+        self._stash._index.put(self._stash.__row__(addr), key, indexed)
+        self.count += 1
+
+    @biggie_stats.timed('bulk_commit')
+    def commit(self):
+        """Update the Stash's keymap with everything written so far, and
+        make it durable; see `Stash.flush`.
+        """
+        for addr in self._addrs:
+            self._stash.agu.release(addr)
+        self._addrs = list()
+        if self._pending:
+            self._stash._keymap.update(self._pending)
+            self._pending = dict()
+        self._stash.flush()
+
+
+def shard_index(key, num_shards):
+    """Return the shard of a key, stable across processes and platforms.
+
+    Parameters
+    ----------
+    key : str
+        Key of an entity.
+
+    num_shards : int
+        Number of shards.
+
+    Returns
+    -------
+    index : int
+        Index of the key's shard, in [0, num_shards).
+    """
+    return (zlib.crc32(six.ensure_binary(key)) & 0xffffffff) % num_shards
+
+
+class ShardedStash(object):
+    """Dictionary-like object spreading its entities over many Stashes.
+
+    Keys are assigned to one of N shard files by a stable hash of the key,
+    and a small manifest in the same directory records the number of shards
+    and their file names:
+
+        <path>/manifest.json
+        <path>/shard-00000.hdf5, ...
+
+    As each shard is an independent HDF5 file, separate processes may write
+    to different shards at the same time; restrict each to its shards with
+    `shards`, and route keys to them with `shard_of`.
+
+    >>> stash = ShardedStash('data', num_shards=4, shards=[worker_idx])
+    >>> for key, entity in items:
+    ...     if stash.shard_of(key) == worker_idx:
+    ...         stash.add(key, entity)
+    """
+    MANIFEST = "manifest.json"
+    SHARD_FMT = "shard-{:05d}.hdf5"
+
+    def __init__(self, path, num_shards=None, mode=None, shards=None,
+                 **kwargs):
+        """Open (or create) a sharded stash.
+
+        Parameters
+        ----------
+        path : str
+            Directory holding the manifest and the shards; created as
+            needed.
+
+        num_shards : int, default=None
+            Number of shards; required to create a new stash, and must
+            match the manifest otherwise.
+
+        mode : str, default=None
+            Filemode of the shards, one of 'r' or 'a'; None is equivalent
+            to 'a'.
+
+        shards : iterable of int, default=None
+            Shards this object may access; if None, all of them. Keys of
+            other shards raise a ValueError.
+
+        kwargs
+            Further arguments for each shard's Stash.
+        """
+        self._path = path
+        self._mode = mode or 'a'
+        if self._mode not in ('r', 'a'):
+            raise ValueError("Unsupported mode '{}'; must be one of 'r' or "
+                             "'a'".format(self._mode))
+        self._kwargs = kwargs
+        self._manifest = self.__load_manifest__(num_shards)
+        self.num_shards = self._manifest['num_shards']
+        self._shards = range(self.num_shards) if shards is None \
+            else sorted(set(shards))
+        for idx in self._shards:
+            if not 0 <= idx < self.num_shards:
+                raise ValueError("Shard {} out of range for {} shards"
+                                 "".format(idx, self.num_shards))
+        self._stashes = dict()
+
+    def __load_manifest__(self, num_shards):
+        """Read the manifest, writing it first for new stashes."""
+        fpath = os.path.join(self._path, self.MANIFEST)
+        if os.path.exists(fpath):
+            with open(fpath) as fp:
+                manifest = json.load(fp)
+            if num_shards is not None and \
+                    num_shards != manifest['num_shards']:
+                raise ValueError(
+                    "Shard mismatch: requested {}, but '{}' has {}; see "
+                    "`reshard`".format(num_shards, self._path,
+                                       manifest['num_shards']))
+            return manifest
+
+        if self._mode == 'r' or num_shards is None:
+            raise ValueError("No sharded stash at '{}'; `num_shards` is "
+                             "required to create one.".format(self._path))
+        if num_shards < 1:
+            raise ValueError("Invalid number of shards: {}".format(num_shards))
+        manifest = dict(
+            num_shards=int(num_shards), hash='crc32',
+            files=[self.SHARD_FMT.format(n) for n in range(num_shards)])
+        if not os.path.exists(self._path):
+            os.makedirs(self._path)
+        # Write and rename, so concurrent openers never see a partial file.
+        tmp_path = '{}.{}'.format(fpath, os.getpid())
+        with open(tmp_path, 'w') as fp:
+            json.dump(manifest, fp, indent=2)
+        os.rename(tmp_path, fpath)
+        return manifest
+
+    def __getstate__(self):
+        """Pickle everything but the open shards."""
+        state = self.__dict__.copy()
+        state['_stashes'] = dict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._mode = 'r'
+
+    @property
+    def shards(self):
+        """Indices of the shards this object may access."""
+        return list(self._shards)
+
+    def shard_of(self, key):
+        """Return the index of the shard holding a key."""
+        return shard_index(str(key), self.num_shards)
+
+    def shard(self, idx):
+        """Return the Stash of a shard, opening it as needed."""
+        if idx not in self._stashes:
+            if idx not in self._shards:
+                raise ValueError("Shard {} is not accessible; accessible "
+                                 "shards are {}".format(idx, self.shards))
+            fpath = os.path.join(self._path, self._manifest['files'][idx])
+            if self._mode == 'r' and not os.path.exists(fpath):
+                # Never written to.
+                return None
+            self._stashes[idx] = Stash(fpath, mode=self._mode, **self._kwargs)
+        return self._stashes[idx]
+
+    def __shard__(self, key):
+        return self.shard(self.shard_of(key))
+
+    def get(self, key, default=None, fields=None):
+        """Fetch the entity for a given key; see `Stash.get`."""
+        stash = self.__shard__(key)
+        return default if stash is None else stash.get(key, default, fields)
+
+    def add(self, key, entity, overwrite=False, storage=None):
+        """Add a key-entity pair to its shard; see `Stash.add`."""
+        self.__shard__(key).add(key, entity, overwrite=overwrite,
+                                storage=storage)
+
+    def add_many(self, items, overwrite=False, storage=None):
+        """Add a number of key-entity pairs; see `Stash.add_many`.
+
+        Entities are streamed into a bulk writer per shard, all of which
+        are committed at the end.
+
+        Returns
+        -------
+        count : int
+            Number of entities added.
+        """
+        writers = dict()
+        try:
+            for key, entity in items:
+                idx = self.shard_of(key)
+                if idx not in writers:
+                    writers[idx] = self.shard(idx).bulk_writer(
+                        overwrite=overwrite, storage=storage)
+                writers[idx].add(key, entity)
+        finally:
+            for writer in writers.values():
+                writer.commit()
+        return sum(writer.count for writer in writers.values())
+
+    def remove(self, key):
+        """Delete a key-entity pair from its shard; see `Stash.remove`."""
+        stash = self.__shard__(key)
+        if stash is None:
+            raise KeyError("The key '{}' does not exist.".format(key))
+        return stash.remove(key)
+
+    def keys(self):
+        """Return a list of all keys in the accessible shards."""
+        keys = []
+        for idx in self._shards:
+            stash = self.shard(idx)
+            if stash is not None:
+                keys.extend(stash.keys())
+        return keys
+
+    def __len__(self):
+        return sum(len(stash) for stash in map(self.shard, self._shards)
+                   if stash is not None)
+
+    def close(self):
+        """Close all open shards."""
+        for stash in self._stashes.values():
+            stash.close()
+        self._stashes = dict()
+
+    def reshard(self, path, num_shards, **kwargs):
+        """Copy all entities into a new sharded stash of a different size.
+
+        Entities are streamed shard by shard, never holding more than one in
+        memory, into a bulk writer per new shard.
+
+        Parameters
+        ----------
+        path : str
+            Directory of the new sharded stash; must not hold one already.
+
+        num_shards : int
+            Number of shards of the new stash.
+
+        kwargs
+            Further arguments for the new stash's shards; those of this one
+            if not given.
+
+        Returns
+        -------
+        stash : ShardedStash
+            The new sharded stash.
+
+        Raises
+        ------
+        ValueError
+            If this object may only access some of the shards (see
+            `shards`), which would leave out the entities of the others.
+        """
+        if list(self._shards) != list(range(self.num_shards)):
+            raise ValueError(
+                "Can't reshard from shards {} of {}; open the stash with "
+                "access to all of them.".format(self.shards, self.num_shards))
+        if os.path.exists(os.path.join(path, self.MANIFEST)):
+            raise ValueError("A sharded stash exists at '{}'".format(path))
+        kwargs = dict(self._kwargs, **kwargs)
+        dest = ShardedStash(path, num_shards=num_shards, mode='a', **kwargs)
+
+        def items():
+            for idx in self._shards:
+                stash = self.shard(idx)
+                for key in ([] if stash is None else stash.keys()):
+                    yield key, stash.get(key)
+
+        dest.add_many(items())
+        return dest
@@ -0,0 +1,265 @@
+"""Instrumentation of Stash operations.
+
+A Recorder counts and times the operations of a Stash (get, add, remove,
+keymap loads and dumps, ...) and the reads of the fields it loads, and
+tallies the bytes read and written per field. Accesses to memory-mapped
+fields are recorded as 'mapped_read' instead, apart from the bytes read:
+
+>>> stash = Stash('data.hdf5', stats=True)
+>>> ...
+>>> stash.stats()['ops']['get']
+{'count': 1000, 'total': 0.42, 'mean': 0.00042, 'p50': 0.00051, ...}
+
+Hooks, called with every operation recorded, pass these on elsewhere, e.g.
+to a metrics client:
+
+>>> recorder = Recorder(hooks=[lambda op, seconds, info: ...])
+>>> stash = Stash('data.hdf5', stats=recorder)
+
+When a Stash isn't instrumented (the default), the cost of all this is a
+single attribute check per operation.
+"""
+
+import collections
+import functools
+import math
+import timeit
+
+import biggie.core as core
+import biggie.packed as packed
+
+_timer = timeit.default_timer
+
+
+class Histogram(object):
+    """Latency histogram, with logarithmic (power of two) buckets."""
+    # Bucket `n` holds latencies in [2**(n-1), 2**n) microseconds.
+    NUM_BUCKETS = 40
+
+    def __init__(self):
+        self.buckets = [0] * self.NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        """Record a latency, in seconds."""
+        bucket = math.frexp(seconds * 1e6)[1] if seconds > 0 else 0
+        self.buckets[min(max(bucket, 0), self.NUM_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """Estimate a percentile, as the upper bound of its bucket.
+
+        Parameters
+        ----------
+        q : float
+            Percentile, in [0, 100].
+
+        Returns
+        -------
+        seconds : float or None
+            Latency below which `q` percent of those recorded fall; None if
+            none were.
+        """
+        if not self.count:
+            return None
+        rank, seen = q / 100. * self.count, 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(2. ** bucket / 1e6, self.max)
+        return self.max
+
+    def summary(self):
+        """Return the count, total, mean, extrema and percentiles."""
+        result = dict(count=self.count, total=self.total, min=self.min,
+                      max=self.max,
+                      mean=self.total / self.count if self.count else None)
+        for q in (50, 90, 99):
+            result['p{}'.format(q)] = self.percentile(q)
+        return result
+
+
+class Recorder(object):
+    """Counters, latency histograms and byte tallies of a Stash."""
+
+    def __init__(self, hooks=None):
+        """Create a recorder.
+
+        Parameters
+        ----------
+        hooks : list of callables, default=None
+            Called as `hook(op, seconds, info)` for every operation recorded,
+            where `info` is a dict, e.g. with the 'field' and 'nbytes' of
+            field reads.
+        """
+        self.hooks = list(hooks or [])
+        self._classes = dict()
+        self.reset()
+
+    def reset(self):
+        """Clear all counters."""
+        self.ops = collections.defaultdict(Histogram)
+        self.bytes_read = collections.defaultdict(int)
+        self.bytes_written = collections.defaultdict(int)
+
+    def __getstate__(self):
+        """Pickle the counters, but neither hooks nor field classes."""
+        state = self.__dict__.copy()
+        state['hooks'] = []
+        state['_classes'] = dict()
+        return state
+
+    def add_hook(self, hook):
+        """Call `hook(op, seconds, info)` for every operation recorded."""
+        self.hooks.append(hook)
+
+    def record(self, op, seconds, **info):
+        """Record an operation and its latency.
+
+        Parameters
+        ----------
+        op : str
+            Name of the operation.
+
+        seconds : float
+            Latency of the operation.
+
+        info
+            Passed on to the hooks.
+        """
+        self.ops[op].add(seconds)
+        for hook in self.hooks:
+            hook(op, seconds, info)
+
+    def read(self, field, nbytes):
+        """Tally bytes read from a field."""
+        self.bytes_read[field] += nbytes
+
+    def written(self, field, nbytes):
+        """Tally bytes written to a field."""
+        self.bytes_written[field] += nbytes
+
+    def summary(self):
+        """Return all counters as a dictionary.
+
+        Returns
+        -------
+        summary : dict
+            Latency summaries keyed by operation ('ops'; see
+            `Histogram.summary`), and bytes keyed by field ('bytes_read',
+            'bytes_written').
+        """
+        return dict(
+            ops=dict((op, hist.summary()) for op, hist in self.ops.items()),
+            bytes_read=dict(self.bytes_read),
+            bytes_written=dict(self.bytes_written))
+
+    def instrument(self, entity):
+        """Record the reads of an entity's lazy fields.
+
+        Fields are switched to subclasses of their own class (see
+        `field_class`), so uninstrumented fields pay nothing.
+
+        Parameters
+        ----------
+        entity : Entity
+            Entity, as loaded from a Stash.
+
+        Returns
+        -------
+        entity : Entity
+            The same entity.
+        """
+        for field in core._get_fields(entity):
+            if isinstance(field, core.LazyField):
+                field.__class__ = self.field_class(field.__class__)
+        return entity
+
+    def field_class(self, cls):
+        """Return the instrumented subclass of a LazyField class."""
+        if cls not in self._classes:
+            if getattr(cls, '_recorder', None) is self:
+                return cls
+            self._classes[cls] = _instrumented(cls, self)
+        return self._classes[cls]
+
+
+def _field_name(field):
+    """Return the name of a lazy field, from that of its dataset."""
+    parts = field._dataset.name.split('/')
+    return parts[-2] if isinstance(field, packed.PackedField) else parts[-1]
+
+
+def _nbytes(value):
+    return getattr(value, 'nbytes', 0)
+
+
+def _instrumented(cls, recorder):
+    """Create a subclass of a LazyField class, recording its reads."""
+
+    def record(field, start, nbytes):
+        seconds = _timer() - start
+        name = _field_name(field)
+        if getattr(field, 'mapped', False):
+            # Views of a memory map; the OS pages them in, if ever read.
+            recorder.record('mapped_read', seconds, field=name, nbytes=nbytes)
+            return
+        recorder.read(name, nbytes)
+        recorder.record('field_read', seconds, field=name, nbytes=nbytes)
+
+    # Values held in memory (e.g. memoized) are served without a read.
+    def value(self):
+        if self._value is not None:
+            return cls.value.fget(self)
+        start = _timer()
+        result = cls.value.fget(self)
+        record(self, start, _nbytes(result))
+        return result
+
+    # Slices of memory-mapped fields are taken from their value, which is
+    # recorded itself.
+    def slice(self, slidx):
+        if self._value is not None or getattr(self, 'mapped', False):
+            return cls.slice(self, slidx)
+        start = _timer()
+        result = cls.slice(self, slidx)
+        record(self, start, _nbytes(result))
+        return result
+
+    def read_direct(self, out, source_sel=None, dest_sel=None):
+        if self._value is not None or getattr(self, 'mapped', False):
+            return cls.read_direct(self, out, source_sel, dest_sel)
+        start = _timer()
+        cls.read_direct(self, out, source_sel, dest_sel)
+        dest = out if dest_sel is None else out[dest_sel]
+        record(self, start, _nbytes(dest))
+
+    # No new slots, so that fields may switch to the subclass in place.
+    return type('Instrumented' + cls.__name__, (cls,), dict(
+        __slots__=(), _recorder=recorder, value=property(value),
+        slice=slice, read_direct=read_direct))
+
+
+def timed(op):
+    """Decorate a Stash method, recording it as `op` when instrumented."""
+    def decorator(fx):
+        @functools.wraps(fx)
+        def wrapper(self, *args, **kwargs):
+            recorder = self._stats
+            if recorder is None:
+                return fx(self, *args, **kwargs)
+            start = _timer()
+            try:
+                return fx(self, *args, **kwargs)
+            finally:
+                recorder.record(op, _timer() - start)
+        return wrapper
+    return decorator
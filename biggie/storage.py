@@ -0,0 +1,180 @@
+"""Storage policies, describing how fields are laid out on disk.
+
+By default, HDF5 datasets are stored contiguously and unfiltered. A
+StoragePolicy instead chunks a field's datasets, optionally compressing and
+checksumming each chunk, trading CPU time for (often far) less I/O.
+
+Policies are given per stash or per field name:
+
+>>> stash = Stash('data.hdf5', storage={
+...     'cqt': StoragePolicy(compression='lzf', shuffle=True),
+...     None: StoragePolicy(compression='gzip')})
+
+where the policy under None applies to fields not named otherwise.
+"""
+
+import h5py
+import numpy as np
+
+
+class StoragePolicy(object):
+    """Chunking and filters for the datasets of a field."""
+    COMPRESSION = (None, 'gzip', 'lzf')
+    CHUNK_BYTES = 2 ** 16
+
+    def __init__(self, chunks=None, compression=None, compression_opts=None,
+                 shuffle=False, fletcher32=False, chunk_bytes=None):
+        """Create a storage policy.
+
+        Parameters
+        ----------
+        chunks : None, bool or tuple, default=None
+            Chunk shape; True picks one automatically (see `chunk_shape`),
+            and None does so only when filters require chunking, storing the
+            data contiguously otherwise.
+
+        compression : str, default=None
+            One of None, 'gzip' or 'lzf'.
+
+        compression_opts : int, default=None
+            Compression level for 'gzip', from 0 to 9; 4 if None.
+
+        shuffle : bool, default=False
+            Apply the byte-shuffle filter, which usually helps compression.
+
+        fletcher32 : bool, default=False
+            Checksum each chunk.
+
+        chunk_bytes : int, default=None
+            Target size of automatic chunks; `CHUNK_BYTES` if None.
+        """
+        if compression not in self.COMPRESSION:
+            raise ValueError("Unsupported compression '{}'; must be one of {}"
+                             "".format(compression, self.COMPRESSION))
+        self.chunks = chunks
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.shuffle = shuffle
+        self.fletcher32 = fletcher32
+        self.chunk_bytes = chunk_bytes or self.CHUNK_BYTES
+
+    def __repr__(self):
+        return '{}<{}>'.format(self.__class__.__name__, ", ".join(
+            '{}={}'.format(k, v) for k, v in sorted(self.__dict__.items())))
+
+    @property
+    def filtered(self):
+        """True if any filters apply."""
+        return bool(self.compression or self.shuffle or self.fletcher32)
+
+    def chunk_shape(self, shape, dtype):
+        """Return the chunk shape of a dataset, or None for contiguous.
+
+        Automatic chunks suit reading windows along the first axis (see
+        `sampler.WindowSampler`): each chunk spans the full extent of the
+        trailing axes, with as many rows as fit in `chunk_bytes`. Should a
+        single row exceed it, its largest axes are halved until it fits.
+
+        Parameters
+        ----------
+        shape : tuple
+            Shape of the dataset.
+
+        dtype : np.dtype
+            Data type of the dataset.
+
+        Returns
+        -------
+        chunks : tuple or None
+            Chunk shape.
+        """
+        if not shape or not np.prod(shape):
+            # Scalars and empty arrays can't be chunked.
+            return None
+        if self.chunks not in (None, True, False):
+            return tuple(min(c, n) for c, n in zip(self.chunks, shape))
+        if self.chunks is False or (self.chunks is None and
+                                    not self.filtered):
+            return None
+
+        chunk = [1] + list(shape[1:])
+        itemsize = np.dtype(dtype).itemsize
+        while int(np.prod(chunk)) * itemsize > self.chunk_bytes and \
+                max(chunk) > 1:
+            axis = int(np.argmax(chunk))
+            chunk[axis] = -(-chunk[axis] // 2)
+        row_bytes = int(np.prod(chunk)) * itemsize
+        chunk[0] = int(max(1, min(shape[0], self.chunk_bytes // row_bytes)))
+        return tuple(chunk)
+
+    def dataset_kwargs(self, value):
+        """Return the keyword arguments for `h5py.Group.create_dataset`.
+
+        Strings, objects and scalars are always stored as is.
+        """
+        arr = np.asarray(value)
+        chunks = None
+        if not (arr.dtype.hasobject or arr.dtype.kind in 'SU'):
+            chunks = self.chunk_shape(arr.shape, arr.dtype)
+        if chunks is None:
+            return dict()
+
+        kwargs = dict(chunks=chunks)
+        if self.compression:
+            kwargs['compression'] = self.compression
+            if self.compression_opts is not None:
+                kwargs['compression_opts'] = self.compression_opts
+        if self.shuffle:
+            kwargs['shuffle'] = True
+        if self.fletcher32:
+            kwargs['fletcher32'] = True
+        return kwargs
+
+    def dcpl(self, shape, dtype):
+        """Return a dataset creation property list, for the low-level API.
+
+        Filters are added in the same order as h5py's `create_dataset`.
+        """
+        dcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+        chunks = self.chunk_shape(shape, dtype)
+        if chunks is None:
+            return dcpl
+
+        dcpl.set_chunk(chunks)
+        if self.shuffle:
+            dcpl.set_shuffle()
+        if self.compression == 'gzip':
+            level = self.compression_opts
+            dcpl.set_deflate(4 if level is None else level)
+        elif self.compression == 'lzf':
+            dcpl.set_filter(h5py.h5z.FILTER_LZF, h5py.h5z.FLAG_OPTIONAL)
+        if self.fletcher32:
+            dcpl.set_fletcher32()
+        return dcpl
+
+
+def resolve(storage, field):
+    """Return the storage policy for a field, or None.
+
+    Parameters
+    ----------
+    storage : StoragePolicy, dict or None
+        Policy for all fields, or policies keyed by field name, where the
+        policy under None (if any) applies to all other fields. Policies
+        may also be given as dicts of `StoragePolicy` arguments.
+
+    field : str
+        Name of the field.
+
+    Returns
+    -------
+    policy : StoragePolicy or None
+        Policy of the field.
+    """
+    if isinstance(storage, dict):
+        storage = storage.get(field, storage.get(None))
+        if isinstance(storage, dict):
+            storage = StoragePolicy(**storage)
+    if storage is not None and not isinstance(storage, StoragePolicy):
+        raise ValueError("Unsupported storage policy: {}".format(storage))
+    return storage
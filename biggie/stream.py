@@ -0,0 +1,246 @@
+"""Streaming entities out of a Stash in the background.
+
+A Prefetcher reads entities ahead of the consumer, so that whatever is done
+with one entity overlaps with reading the next ones from disk:
+
+>>> for key, entity in stash.iterate(prefetch=32, workers=4):
+...     consume(entity)
+
+Reads are done either by threads, which share the stash (and h5py's global
+lock) but keep the consumer from waiting on disk, or by processes, each with
+its own read-only copy of the stash, which also read in parallel.
+
+At most `prefetch` entities are in flight (read, or being read, but not yet
+consumed) at any time, bounding memory use regardless of how far the
+consumer falls behind.
+"""
+
+import multiprocessing
+import pickle
+import threading
+import traceback
+
+from six.moves import queue
+
+
+def _fetch(stash, key, fields):
+    """Read an entity into memory, keeping only the given fields."""
+    entity = stash.get(key) if fields is None else \
+        stash.get(key, fields=fields)
+    if entity is None:
+        raise KeyError("The key '{}' does not exist.".format(key))
+    return entity.materialize()
+
+
+def _process_worker(stash, tasks, results, fields):
+    """Read the tasks given in a separate process, until a None arrives."""
+    stash = pickle.loads(stash)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        idx, key = task
+        try:
+            results.put((idx, key, _fetch(stash, key, fields), None))
+        except Exception as derp:
+            results.put((idx, key, None, "{}: {}\n{}".format(
+                derp.__class__.__name__, derp, traceback.format_exc())))
+    stash.close()
+
+
+class Prefetcher(object):
+    """Iterator over (key, entity) pairs, read in the background."""
+    BACKENDS = ('thread', 'process')
+
+    def __init__(self, stash, keys=None, prefetch=16, workers=1, fields=None,
+                 ordered=True, backend='thread'):
+        """Create a prefetching iterator; reading starts on first use.
+
+        Parameters
+        ----------
+        stash : Stash
+            Stash to read from.
+
+        keys : iterable of str, default=None
+            Keys to read; if None, all keys in the stash. Consumed lazily.
+
+        prefetch : int, default=16
+            Maximum number of entities read ahead of the consumer.
+
+        workers : int, default=1
+            Number of threads or processes reading entities.
+
+        fields : iterable of str, default=None
+            Fields to read; if None, all of them.
+
+        ordered : bool, default=True
+            If True, entities are delivered in the order of `keys`; otherwise
+            as soon as they are read.
+
+        backend : str, default='thread'
+            One of 'thread' or 'process'.
+        """
+        if backend not in self.BACKENDS:
+            raise ValueError("Unsupported backend '{}'; must be one of {}"
+                             "".format(backend, self.BACKENDS))
+        if prefetch < 1 or workers < 1:
+            raise ValueError("`prefetch` and `workers` must be positive.")
+        self.stash = stash
+        self._keys = keys
+        self.prefetch = prefetch
+        self.workers = workers
+        self.fields = None if fields is None else list(fields)
+        self.ordered = ordered
+        self.backend = backend
+
+        self._permits = threading.Semaphore(prefetch)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._num_sent = None
+        self._num_received = 0
+        self._next_idx = 0
+        self._pending = dict()
+        self._feeder = None
+        self._workers = []
+        self._tasks = None
+        self._results = None
+
+    def __iter__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    @property
+    def started(self):
+        return getattr(self, '_feeder', None) is not None
+
+    def __start__(self):
+        if self.backend == 'process':
+            # Workers read what is on disk; they also get the in-memory
+            # keymap, but not unflushed data.
+            self.stash.checkpoint()
+            stash = pickle.dumps(self.stash)
+            # Forked children inherit the state of the HDF5 library, open
+            # files included, so start fresh interpreters where possible.
+            context = multiprocessing.get_context('spawn') \
+                if hasattr(multiprocessing, 'get_context') else multiprocessing
+            self._tasks = context.Queue()
+            self._results = context.Queue()
+            for n in range(self.workers):
+                self._workers.append(context.Process(
+                    target=_process_worker,
+                    args=(stash, self._tasks, self._results, self.fields)))
+        else:
+            self._tasks = queue.Queue()
+            self._results = queue.Queue()
+            for n in range(self.workers):
+                self._workers.append(
+                    threading.Thread(target=self.__thread_worker__))
+
+        self._feeder = threading.Thread(target=self.__feed__)
+        for worker in self._workers + [self._feeder]:
+            worker.daemon = True
+            worker.start()
+
+    def __feed__(self):
+        """Hand out keys to the workers, as long as permits are available."""
+        keys = self._keys
+        if keys is None:
+            with self._lock:
+                keys = self.stash.keys()
+        count = 0
+        for key in keys:
+            self._permits.acquire()
+            if self._stop.is_set():
+                break
+            self._tasks.put((count, key))
+            count += 1
+        for n in range(self.workers):
+            self._tasks.put(None)
+        self._num_sent = count
+        # Wake up a consumer waiting for results that will never come.
+        self._results.put(None)
+
+    def __thread_worker__(self):
+        while True:
+            task = self._tasks.get()
+            if task is None or self._stop.is_set():
+                break
+            idx, key = task
+            try:
+                with self._lock:
+                    entity = _fetch(self.stash, key, self.fields)
+                self._results.put((idx, key, entity, None))
+            except Exception as derp:
+                self._results.put((idx, key, None, derp))
+
+    def __receive__(self):
+        """Return the next result from the workers, or None when done."""
+        while True:
+            if self._num_sent is not None and \
+                    self._num_received >= self._num_sent:
+                return None
+            try:
+                result = self._results.get(timeout=0.1)
+            except queue.Empty:
+                dead = [w for w in self._workers
+                        if getattr(w, 'exitcode', None)]
+                if dead:
+                    raise RuntimeError(
+                        "Worker exited unexpectedly with code {}"
+                        "".format(dead[0].exitcode))
+                continue
+            if result is not None:
+                self._num_received += 1
+                return result
+
+    def __next__(self):
+        if not self.started:
+            self.__start__()
+        elif self._stop.is_set():
+            raise StopIteration
+
+        if self.ordered and self._next_idx in self._pending:
+            result = self._pending.pop(self._next_idx)
+        else:
+            while True:
+                result = self.__receive__()
+                if result is None:
+                    self.close()
+                    raise StopIteration
+                if not self.ordered or result[0] == self._next_idx:
+                    break
+                self._pending[result[0]] = result
+
+        idx, key, entity, error = result
+        self._next_idx += 1
+        self._permits.release()
+        if error is not None:
+            self.close()
+            if isinstance(error, Exception):
+                raise error
+            raise RuntimeError("Failed reading '{}': {}".format(key, error))
+        return key, entity
+
+    next = __next__
+
+    def close(self, timeout=1.0):
+        """Stop reading and shut down the workers."""
+        if not self.started or self._stop.is_set():
+            return
+        self._stop.set()
+        # Wake up the feeder, should it be waiting on a permit.
+        self._permits.release()
+        self._feeder.join(timeout)
+        for worker in self._workers:
+            worker.join(timeout)
+            if hasattr(worker, 'terminate') and worker.is_alive():
+                worker.terminate()
+        self._pending.clear()
@@ -0,0 +1,108 @@
+import pytest
+
+import asyncio
+import numpy as np
+import tempfile as tmp
+
+import biggie
+import biggie.aio as aio
+
+
+@pytest.fixture()
+def astash():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name)
+    for idx in range(20):
+        stash.add(str(idx), biggie.Entity(x=np.arange(idx), y=idx))
+    stash._fp = fp
+    return aio.AsyncStash(stash)
+
+
+def count_gets(stash):
+    calls = []
+    get = stash.get
+
+    def counted(key, default=None, fields=None):
+        calls.append(key)
+        return get(key, default, fields)
+
+    stash.get = counted
+    return calls
+
+
+@pytest.mark.unit
+def test_AsyncStash_aget(astash):
+    async def main():
+        entity = await astash.aget('5')
+        assert isinstance(entity['x'], biggie.core.Field)
+        assert not isinstance(entity['x'], biggie.core.LazyField)
+        np.testing.assert_array_equal(entity.x, np.arange(5))
+        assert (await astash.aget('5', fields=['y'])).keys() == ['y']
+        assert await astash.aget('missing', default=3) == 3
+
+    asyncio.run(main())
+
+
+@pytest.mark.unit
+def test_AsyncStash_coalesce(astash):
+    calls = count_gets(astash.stash)
+
+    async def main():
+        entities = await asyncio.gather(
+            *[astash.aget(str(idx % 2)) for idx in range(100)])
+        assert [e.y for e in entities] == [idx % 2 for idx in range(100)]
+
+    asyncio.run(main())
+    # One read per distinct key.
+    assert sorted(calls) == ['0', '1']
+
+
+@pytest.mark.unit
+def test_AsyncStash_aget_fields():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name, stats=True)
+    stash.add('a', biggie.Entity(big=np.zeros(4096), small=3))
+    astash = aio.AsyncStash(stash)
+    calls = count_gets(stash)
+
+    async def main():
+        assert (await astash.aget('a', fields=['small'])).small == 3
+        assert await astash.aget('b', fields=['small']) is None
+        await astash.aclose()
+
+    asyncio.run(main())
+    assert calls == ['a', 'b']
+    assert 'big' not in stash.stats()['bytes_read']
+
+
+@pytest.mark.unit
+def test_AsyncStash_write(astash):
+    async def main():
+        before = asyncio.ensure_future(astash.aget('3'))
+        await asyncio.sleep(0)
+        await astash.aadd('3', biggie.Entity(y=-3), overwrite=True)
+        # Reads requested after a write never join those from before.
+        assert (await astash.aget('3')).y == -3
+        await before
+        assert await astash.aremove('4')
+        assert await astash.aget('4') is None
+        arrays = await astash.aget_many(['1', '2'], fields=['y'])
+        np.testing.assert_array_equal(arrays['y'], [1, 2])
+        await astash.aclose()
+
+    asyncio.run(main())
+
+
+@pytest.mark.unit
+def test_AsyncStash_iterate(astash):
+    async def main():
+        keys = [str(idx) for idx in range(19, -1, -1)]
+        results = [(key, entity.y) async for key, entity in
+                   astash.iterate(keys, prefetch=4)]
+        assert results == [(key, int(key)) for key in keys]
+        assert len([key async for key, entity in astash]) == 20
+        with pytest.raises(KeyError):
+            async for key, entity in astash.iterate(['1', 'missing']):
+                pass
+
+    asyncio.run(main())
@@ -0,0 +1,90 @@
+import pytest
+
+import h5py
+import pickle
+import tempfile as tmp
+
+import biggie.allocator as allocator
+import biggie.util as util
+
+
+@pytest.fixture
+def fhandle():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    fh = h5py.File(fp.name, mode='a')
+    yield fh
+    fh.close()
+
+
+@pytest.mark.unit
+def test_AddressAllocator_allocate(fhandle):
+    alloc = allocator.AddressAllocator(lambda: fhandle)
+    addrs = [alloc.allocate() for n in range(300)]
+    assert addrs == [util.uniform_hexkey(n, 3) for n in range(300)]
+    assert next(alloc) == util.uniform_hexkey(300, 3)
+    assert len(alloc) == 301
+
+
+@pytest.mark.unit
+def test_AddressAllocator_release(fhandle):
+    alloc = allocator.AddressAllocator(lambda: fhandle)
+    addrs = alloc.allocate_many(10)
+    alloc.release(addrs[3])
+    alloc.release(addrs[5])
+    assert alloc.allocate() == addrs[5]
+    assert alloc.allocate_many(2) == [addrs[3], util.uniform_hexkey(10, 3)]
+
+
+@pytest.mark.unit
+def test_AddressAllocator_persist(fhandle):
+    alloc = allocator.AddressAllocator(lambda: fhandle)
+    addrs = alloc.allocate_many(10)
+    alloc.release(addrs[7])
+    alloc.flush()
+
+    alloc = allocator.AddressAllocator(lambda: fhandle)
+    assert alloc.next_index == 10
+    assert alloc.allocate() == addrs[7]
+    assert alloc.allocate() == util.uniform_hexkey(10, 3)
+
+
+@pytest.mark.unit
+def test_AddressAllocator_used(fhandle):
+    used = [util.uniform_hexkey(n, 3) for n in (0, 1, 3, 4)]
+    alloc = allocator.AddressAllocator(lambda: fhandle, used=lambda: used)
+    assert alloc.next_index == 5
+    assert alloc.allocate_many(2) == [util.uniform_hexkey(n, 3)
+                                      for n in (2, 5)]
+
+
+@pytest.mark.unit
+def test_AddressAllocator_reserve(fhandle):
+    alloc = allocator.AddressAllocator(lambda: fhandle)
+    alloc.release(alloc.allocate())
+    first, second = alloc.reserve(5), alloc.reserve(5)
+    assert len(first) == 5
+    assert set(first).isdisjoint(second)
+    assert list(second) == [util.uniform_hexkey(n, 3) for n in range(6, 11)]
+    assert first[-1] == util.uniform_hexkey(5, 3)
+    assert list(pickle.loads(pickle.dumps(first))) == list(first)
+
+    alloc = allocator.AddressAllocator(lambda: fhandle, depth=1, width=16)
+    with pytest.raises(ValueError):
+        alloc.reserve(17)
+
+
+@pytest.mark.unit
+def test_AddressAllocator_reconcile(fhandle):
+    alloc = allocator.AddressAllocator(lambda: fhandle)
+    addrs = alloc.allocate_many(4)
+    alloc.flush()
+    hexkey = [util.uniform_hexkey(n, 3) for n in range(10)]
+    changes = [(None, hexkey[6]), (addrs[1], None), (hexkey[6], hexkey[8]),
+               (None, hexkey[1])]
+
+    alloc = allocator.AddressAllocator(lambda: fhandle)
+    alloc.reconcile(changes)
+    alloc.reconcile(changes)
+    assert alloc.next_index == 9
+    assert len(alloc) == 5
+    assert alloc.allocate_many(5) == [hexkey[n] for n in (4, 5, 6, 7, 9)]
@@ -0,0 +1,53 @@
+import pytest
+
+import json
+import os
+import tempfile as tmp
+
+import biggie.benchmark as benchmark
+
+TINY_GRID = dict(num_entities=[5], shape=[(8, 2)], dtype=['int16'])
+
+
+@pytest.mark.unit
+def test_run():
+    results = benchmark.run(grid=TINY_GRID, isolate=False)
+    assert [r['name'] for r in results['results']] == \
+        list(benchmark.SCENARIOS.keys())
+    for result in results['results']:
+        assert result['items'] > 0
+        assert result['items_per_sec'] > 0
+        latency = result['latency']
+        assert latency['min'] <= latency['p50'] <= latency['p99'] <= \
+            latency['max']
+        if benchmark.resource is not None:
+            assert result['peak_rss'] > 0
+    assert results['results'][0]['params'] == dict(
+        num_entities=5, shape=[8, 2], dtype='int16')
+    assert json.loads(json.dumps(results)) == results
+
+
+@pytest.mark.unit
+def test_compare():
+    baseline = dict(results=[
+        dict(name='a', params=dict(n=1), items_per_sec=100.),
+        dict(name='a', params=dict(n=2), items_per_sec=100.)])
+    current = dict(results=[
+        dict(name='a', params=dict(n=1), items_per_sec=80.),
+        dict(name='a', params=dict(n=2), items_per_sec=95.),
+        dict(name='b', params=dict(n=1), items_per_sec=95.)])
+    rows = benchmark.compare(baseline, current, threshold=0.1)
+    assert [(r[0], r[2]) for r in rows] == [('a[n=1]', True),
+                                           ('a[n=2]', False)]
+
+
+@pytest.mark.unit
+def test_main():
+    output = os.path.join(tmp.mkdtemp(), 'results.json')
+    assert benchmark.main(['run', '--quick', '-s', 'hexgen', '-o',
+                           output]) == 0
+    with open(output) as fp:
+        results = json.load(fp)
+    assert [r['name'] for r in results['results']] == ['uniform_hexgen']
+    assert 'h5py' in results['meta']
+    assert benchmark.main(['compare', output, output]) == 0
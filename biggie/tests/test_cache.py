@@ -0,0 +1,86 @@
+import pytest
+
+import numpy as np
+
+import biggie
+import biggie.cache as cache
+
+
+@pytest.mark.unit
+def test_entity_nbytes():
+    entity = biggie.Entity(a=np.zeros(10, dtype=np.float32),
+                           b=np.zeros(3, dtype=np.int64))
+    assert cache.entity_nbytes(entity) == 40 + 24
+
+
+@pytest.mark.unit
+def test_EntityCache_get():
+    lru = cache.EntityCache(max_items=2)
+    entity = biggie.Entity(a=np.arange(5))
+    assert lru.get('a') is None
+    lru.put('a', entity)
+    assert lru.get('a') is entity
+    assert lru.hits == 1
+    assert lru.misses == 1
+
+
+@pytest.mark.unit
+def test_EntityCache_disabled():
+    lru = cache.EntityCache(max_items=0)
+    lru.put('a', biggie.Entity(a=np.arange(5)))
+    assert not lru.enabled
+    assert len(lru) == 0
+
+
+@pytest.mark.unit
+def test_EntityCache_lru_max_items():
+    lru = cache.EntityCache(max_items=2)
+    for key in 'abc':
+        lru.put(key, biggie.Entity(x=np.arange(5)))
+        lru.get('a')
+    assert sorted(lru.keys()) == ['a', 'c']
+    assert lru.evictions == 1
+
+
+@pytest.mark.unit
+def test_EntityCache_lru_max_bytes():
+    lru = cache.EntityCache(max_bytes=100)
+    for key in 'abc':
+        lru.put(key, biggie.Entity(x=np.zeros(5, dtype=np.float64)))
+    assert sorted(lru.keys()) == ['b', 'c']
+    assert lru.nbytes == 80
+
+    # Too big to ever fit, so don't bother.
+    lru.put('d', biggie.Entity(x=np.zeros(50, dtype=np.float64)))
+    assert 'd' not in lru
+    assert lru.nbytes == 80
+
+
+@pytest.mark.unit
+def test_EntityCache_lfu():
+    lfu = cache.EntityCache(max_items=2, policy='lfu')
+    lfu.put('a', biggie.Entity(x=1))
+    lfu.put('b', biggie.Entity(x=2))
+    for n in range(3):
+        lfu.get('a')
+    lfu.get('b')
+    lfu.put('c', biggie.Entity(x=3))
+    assert sorted(lfu.keys()) == ['a', 'c']
+    lfu.put('d', biggie.Entity(x=4))
+    assert sorted(lfu.keys()) == ['a', 'd']
+
+
+@pytest.mark.unit
+def test_EntityCache_pop():
+    lfu = cache.EntityCache(max_items=2, policy='lfu')
+    entity = biggie.Entity(x=np.arange(3))
+    lfu.put('a', entity)
+    assert lfu.pop('a') is entity
+    assert lfu.pop('a') is None
+    assert lfu.nbytes == 0
+
+
+@pytest.mark.unit
+def test_EntityCache_bad_policy():
+    with pytest.raises(ValueError):
+        cache.EntityCache(policy='fifo')
@@ -2,7 +2,9 @@ import pytest
 import h5py
 import numpy as np
 import os
+import pickle
 import random
+import six
 import tempfile as tmp
 import uuid
 
@@ -75,7 +77,7 @@ def testbench_Field_slice(benchmark):
 @pytest.mark.unit
 def test_Field_from_hdf5_dataset():
     fp = tmp.NamedTemporaryFile(suffix=".hdf5")
-    fh = h5py.File(fp.name)
+    fh = h5py.File(fp.name, mode='a')
     key = 'test'
     value = np.arange(20).reshape(4, 5)
     dset = fh.create_dataset(key, data=value)
@@ -86,7 +88,7 @@ def test_Field_from_hdf5_dataset():
 @pytest.mark.unit
 def test_LazyField___init__():
     fp = tmp.NamedTemporaryFile(suffix=".hdf5")
-    fh = h5py.File(fp.name)
+    fh = h5py.File(fp.name, mode='a')
     key = 'test'
     value = np.arange(20).reshape(4, 5)
     dset = fh.create_dataset(key, data=value)
@@ -97,7 +99,7 @@ def test_LazyField___init__():
 @pytest.mark.unit
 def test_LazyField_value():
     fp = tmp.NamedTemporaryFile(suffix=".hdf5")
-    fh = h5py.File(fp.name)
+    fh = h5py.File(fp.name, mode='a')
     key = 'test'
     value = np.arange(20).reshape(4, 5)
     dset = fh.create_dataset(key, data=value)
@@ -108,7 +110,7 @@ def test_LazyField_value():
 @pytest.mark.unit
 def test_LazyField_slice():
     fp = tmp.NamedTemporaryFile(suffix=".hdf5")
-    fh = h5py.File(fp.name)
+    fh = h5py.File(fp.name, mode='a')
     key = 'test'
     value = np.arange(20).reshape(4, 5)
     dset = fh.create_dataset(key, data=value)
@@ -117,10 +119,165 @@ def test_LazyField_slice():
     np.testing.assert_array_equal(field.slice(slidx), value[slidx])
 
 
+@pytest.fixture
+def h5py_dsets():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    fh = h5py.File(fp.name, mode='a')
+    values = [np.arange(20 * (n + 1)).reshape(4, -1) for n in range(3)]
+    dsets = [fh.create_dataset(str(n), data=v) for n, v in enumerate(values)]
+    yield dsets, values
+    fh.close()
+
+
+@pytest.mark.unit
+def test_LazyField_lazy(h5py_dsets):
+    dsets, values = h5py_dsets
+    field = core.LazyField(dsets[0])
+    np.testing.assert_array_equal(field.value, values[0])
+    assert field._value is None
+
+
+@pytest.mark.unit
+def test_LazyField_memoize(h5py_dsets):
+    dsets, values = h5py_dsets
+    field = core.LazyField(dsets[0], policy='memoize')
+    np.testing.assert_array_equal(field.value, values[0])
+    assert field.value is field.value
+    np.testing.assert_array_equal(field[1:3, 2], values[0][1:3, 2])
+
+
+@pytest.mark.unit
+def test_LazyField_budget(h5py_dsets):
+    dsets, values = h5py_dsets
+    with pytest.raises(ValueError):
+        core.LazyField(dsets[0], policy='budget')
+
+    nbytes = [v.nbytes for v in values]
+    budget = core.MemoryBudget(nbytes[0] + nbytes[1])
+    fields = [core.LazyField(d, policy='budget', budget=budget)
+              for d in dsets]
+    fields[0].value
+    fields[1].value
+    assert budget.nbytes == nbytes[0] + nbytes[1]
+
+    # The least recently used value is dropped to make room.
+    fields[0].value
+    fields[2].value
+    assert fields[1]._value is None
+    assert fields[0]._value is None
+    assert budget.nbytes == nbytes[2]
+    np.testing.assert_array_equal(fields[1].value, values[1])
+
+    del fields[:]
+    assert budget.nbytes == 0
+
+
+@pytest.mark.unit
+def test_LazyField_budget_strings():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    fh = h5py.File(fp.name, mode='a')
+    text = h5py.special_dtype(vlen=six.text_type)
+    fh.create_dataset('name', data=u'\xe9' * 100, dtype=text)
+    fh.create_dataset('names', data=np.array([u'ab', u'cde'], dtype=object),
+                      dtype=text)
+    budget = core.MemoryBudget(1000)
+    name = core.LazyField(fh['name'], policy='budget', budget=budget)
+    assert name.value == u'\xe9' * 100
+    assert budget.nbytes == 200
+    names = core.LazyField(fh['names'], policy='budget', budget=budget)
+    names.value
+    assert budget.nbytes > 205
+
+    # Values that can't fit aren't kept.
+    budget = core.MemoryBudget(100)
+    name = core.LazyField(fh['name'], policy='budget', budget=budget)
+    name.value
+    assert name._value is None
+    assert budget.nbytes == 0
+    fh.close()
+
+
+@pytest.mark.unit
+def test_LazyField_getitem(h5py_dsets):
+    dsets, values = h5py_dsets
+    field = core.LazyField(dsets[2])
+    np.testing.assert_array_equal(field[1:3, 5:7], values[2][1:3, 5:7])
+    np.testing.assert_array_equal(field.slice([slice(1, 3), slice(5, 7)]),
+                                  values[2][1:3, 5:7])
+    assert field._value is None
+
+
+@pytest.mark.unit
+def test_LazyField_read_direct(h5py_dsets):
+    dsets, values = h5py_dsets
+    field = core.LazyField(dsets[0])
+    out = np.zeros((2, 4, 5), dtype=np.float32)
+    field.read_direct(out, dest_sel=np.s_[1])
+    np.testing.assert_array_equal(out[1], values[0])
+    field.read_direct(out, source_sel=np.s_[:2], dest_sel=np.s_[0, :2])
+    np.testing.assert_array_equal(out[0, :2], values[0][:2])
+
+
+@pytest.mark.unit
+def test_Field_read_direct():
+    field = core.Field(np.arange(6).reshape(2, 3))
+    out = np.zeros((3, 3), dtype=int)
+    field.read_direct(out, dest_sel=np.s_[1:])
+    np.testing.assert_array_equal(out[1:], field.value)
+    np.testing.assert_array_equal(field[:, 1], [1, 4])
+
+
+@pytest.mark.unit
+def test_Entity_from_hdf5_group_policy(h5py_dsets):
+    dsets, values = h5py_dsets
+    entity = core.Entity.from_hdf5_group(dsets[0].parent, policy='memoize')
+    np.testing.assert_array_equal(entity['1'].value, values[1])
+    assert entity['1'].policy == 'memoize'
+    assert entity['1']._value is not None
+
+
+@pytest.mark.unit
+def test_Entity_from_hdf5_group_deferred(h5py_dsets):
+    dsets, values = h5py_dsets
+    group = dsets[0].parent
+    entity = core.Entity.from_hdf5_group(group)
+    assert entity.keys() == ['0', '1', '2']
+    assert all(core._DATASET.__get__(field) is None
+               for field in core._get_fields(entity))
+    np.testing.assert_array_equal(entity['1'].value, values[1])
+    assert core._DATASET.__get__(entity['1']) is not None
+    assert core._DATASET.__get__(entity['2']) is None
+    assert entity['2'].shape == values[2].shape
+
+    # Groups of the same members share a schema.
+    assert core._get_schema(core.Entity.from_hdf5_group(group)) is \
+        core._get_schema(entity)
+
+    entity = core.Entity.from_hdf5_group(group, fields=['2', '0'])
+    assert entity.keys() == ['2', '0']
+    np.testing.assert_array_equal(entity.materialize().get('0'), values[0])
+    with pytest.raises(KeyError):
+        core.Entity.from_hdf5_group(group, fields=['0', 'nope'])
+
+
+@pytest.mark.unit
+def test_Schema_collected():
+    keys = tuple(str(uuid.uuid4()) for n in range(3))
+    entity = core.Entity(**dict(zip(keys, range(3))))
+    schema = core._get_schema(entity)
+    entity.extra = 4
+    assert core.Schema.get(schema.keys) is schema
+    assert schema.add('extra') is core._get_schema(entity)
+
+    del entity, schema
+    assert not [ks for ks in core.Schema.__TABLE__.keys()
+                if set(keys).intersection(ks)]
+
+
 @pytest.fixture
 def h5py_data():
     fp = tmp.NamedTemporaryFile(suffix=".hdf5")
-    fh = h5py.File(fp.name)
+    fh = h5py.File(fp.name, mode='a')
 
     value = np.arange(2000*200).reshape(2000, 200)
     keys = []
@@ -142,7 +299,7 @@ def testbench_h5py_slice(benchmark, h5py_data):
         return fh[key][slidx]
 
     fp, keys, value, slidx = h5py_data
-    fh = h5py.File(fp.name)
+    fh = h5py.File(fp.name, mode='a')
     exp_res = value[slidx]
     act_res = benchmark(fx, fh, keys, slidx)
     np.testing.assert_array_equal(act_res, exp_res)
@@ -152,10 +309,10 @@ def testbench_h5py_slice(benchmark, h5py_data):
 def testbench_h5py_value_slice(benchmark, h5py_data):
     def fx(fh, keys, slidx):
         key = keys[random.randint(0, len(keys) - 1)]
-        return fh[key].value[slidx]
+        return fh[key][()][slidx]
 
     fp, keys, value, slidx = h5py_data
-    fh = h5py.File(fp.name)
+    fh = h5py.File(fp.name, mode='a')
     exp_res = value[slidx]
     act_res = benchmark(fx, fh, keys, slidx)
     np.testing.assert_array_equal(act_res, exp_res)
@@ -165,10 +322,10 @@ def testbench_h5py_value_slice(benchmark, h5py_data):
 def testbench_h5py_asarray_slice(benchmark, h5py_data):
     def fx(fh, keys, slidx):
         key = keys[random.randint(0, len(keys) - 1)]
-        return np.asarray(fh[key].value)[slidx]
+        return np.asarray(fh[key][()])[slidx]
 
     fp, keys, value, slidx = h5py_data
-    fh = h5py.File(fp.name)
+    fh = h5py.File(fp.name, mode='a')
     exp_res = value[slidx]
     act_res = benchmark(fx, fh, keys, slidx)
     np.testing.assert_array_equal(act_res, exp_res)
@@ -181,7 +338,7 @@ def testbench_LazyField_slice(benchmark, h5py_data):
         return fields[idx].slice(slidx)
 
     fp, keys, value, slidx = h5py_data
-    fh = h5py.File(fp.name)
+    fh = h5py.File(fp.name, mode='a')
     exp_res = value[slidx]
     fields = [core.LazyField(fh[key]) for key in keys]
     act_res = benchmark(fx, fields, slidx)
@@ -195,7 +352,7 @@ def testbench_LazyField_slice__dataset(benchmark, h5py_data):
         return fields[idx]._dataset[slidx]
 
     fp, keys, value, slidx = h5py_data
-    fh = h5py.File(fp.name)
+    fh = h5py.File(fp.name, mode='a')
     exp_res = value[slidx]
     fields = [core.LazyField(fh[key]) for key in keys]
     act_res = benchmark(fx, fields, slidx)
@@ -293,3 +450,60 @@ def test_Entity_items(data):
     assert items['c'].tolist() == exp_items['c']
     np.testing.assert_array_equal(
         items['d'], exp_items['d'], "Failed to initialize a numpy array.")
+
+
+@pytest.mark.unit
+def test_Entity_schema():
+    x = biggie.Entity(a=0, b=1)
+    y = biggie.Entity(a=2, b=3)
+    assert x._schema is y._schema
+    assert not hasattr(x, '__dict__')
+
+    y.c = 4
+    assert y.keys() == ['a', 'b', 'c']
+    assert y._schema is biggie.Entity(a=0, b=1, c=2)._schema
+    del y['a']
+    assert y.keys() == ['b', 'c']
+    assert (y.b, y.c) == (3, 4)
+    with pytest.raises(KeyError):
+        del y['a']
+    with pytest.raises(KeyError):
+        y['a']
+    with pytest.raises(AttributeError):
+        y.a
+
+
+@pytest.mark.unit
+def test_Entity_pickle(data):
+    entity = pickle.loads(pickle.dumps(data.e))
+    assert entity.keys() == data.e.keys()
+    assert entity.b == data.b
+    np.testing.assert_array_equal(entity.d, data.d)
+    entity = pickle.loads(pickle.dumps(data.e, protocol=0))
+    assert entity.a == data.a
+
+
+@pytest.mark.benchmark(min_rounds=MIN_ROUNDS)
+def testbench_Entity_getattr(benchmark, data):
+    benchmark(getattr, data.e, 'd')
+
+
+@pytest.mark.benchmark(min_rounds=MIN_ROUNDS)
+def testbench_Entity_init(benchmark, data):
+    benchmark(core.Entity, a=data.a, b=data.b, c=data.c, d=data.d)
+
+
+@pytest.mark.benchmark(min_rounds=10)
+def testbench_Entity_nbytes(benchmark):
+    tracemalloc = pytest.importorskip('tracemalloc')
+    values = list(range(1000))
+
+    def create():
+        tracemalloc.start()
+        entities = [core.Entity(a=n, b=n, c=n, d=n) for n in values]
+        nbytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return entities, nbytes
+
+    entities, nbytes = benchmark(create)
+    benchmark.extra_info['bytes_per_entity'] = nbytes / float(len(values))
@@ -0,0 +1,224 @@
+import pytest
+
+import h5py
+import multiprocessing
+import numpy as np
+import os
+import pickle
+import tempfile as tmp
+
+import biggie
+import biggie.index as index
+
+
+@pytest.fixture
+def fhandle():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    fh = h5py.File(fp.name, mode='a')
+    yield fh
+    fh.close()
+
+
+def make_entity(idx):
+    fields = dict(x=np.arange(4) + idx, label=idx % 3,
+                  duration=idx / 2., name='entity{}'.format(idx))
+    if idx % 5 == 0:
+        del fields['duration']
+    return biggie.Entity(**fields)
+
+
+@pytest.fixture(params=['tree', 'packed'])
+def indexed(request):
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name, layout=request.param)
+    stash.add_many((str(idx), make_entity(idx)) for idx in range(30))
+    stash.create_index('label')
+    stash.create_index('duration')
+    stash._fp = fp
+    return stash
+
+
+def expected(indices, fx):
+    return sorted(str(idx) for idx in indices if fx(make_entity(idx)))
+
+
+@pytest.mark.unit
+def test_SecondaryIndex(fhandle):
+    idx = index.SecondaryIndex(lambda: fhandle)
+    assert idx.fields == []
+    assert idx.extract(dict(a=1)) == dict()
+    idx.create('a', [(0, 'x', 1), (3, 'y', np.int32(2))])
+    idx.create('b', [(3, 'y', 'two'), (5, 'z', b'three')])
+    assert idx.fields == ['a', 'b']
+    assert idx.select('a > 0') == ['x', 'y']
+    assert idx.select(lambda fields: fields['b'] != 'two') == ['z']
+
+    values = idx.extract(dict(a=np.int16(7), b='seven'))
+    with pytest.raises(ValueError):
+        idx.extract(dict(a=1.5))
+    with pytest.raises(ValueError):
+        idx.extract(dict(b=3))
+    with pytest.raises(ValueError):
+        idx.extract(dict(a=np.arange(3)))
+    idx.put(9, 'w', values)
+    idx.remove(0)
+    idx.flush()
+    assert fhandle['__INDEX__/keys'].shape == (10,)
+
+    idx = index.SecondaryIndex(lambda: fhandle)
+    assert idx.select('a >= 2') == ['y', 'w']
+    assert idx.select('b == "seven"') == ['w']
+    assert idx.row(5) == dict(b='three')
+    with pytest.raises(KeyError):
+        idx.select(lambda fields: fields['c'] == 1)
+    with pytest.raises(NameError):
+        idx.select('c == 1')
+    with pytest.raises(NameError):
+        idx.select('open("/etc/passwd")')
+
+    idx.drop('b')
+    assert 'b' not in fhandle['__INDEX__']
+    idx.drop('a')
+    assert '__INDEX__' not in fhandle
+    with pytest.raises(ValueError):
+        idx.create('c', [])
+
+
+@pytest.mark.unit
+def test_SecondaryIndex_empty_key(fhandle):
+    idx = index.SecondaryIndex(lambda: fhandle)
+    idx.create('a', [(0, '', 1), (1, 'x', 1), (2, 'y', 2)])
+    assert idx.select('a == 1') == ['', 'x']
+    idx.remove(1)
+    idx.flush()
+    assert idx.select('a == 1') == ['']
+
+    idx = index.SecondaryIndex(lambda: fhandle)
+    assert idx.select('a == 1') == ['']
+    # Files without liveness flags derive them from the keys.
+    del fhandle['__INDEX__/live']
+    idx = index.SecondaryIndex(lambda: fhandle)
+    assert idx.fields == ['a']
+    assert idx.select('a > 0') == ['y']
+
+
+@pytest.mark.unit
+def test_Stash_select(indexed):
+    assert indexed.indexes == ['duration', 'label']
+    assert sorted(indexed.select('label == 1')) == expected(
+        range(30), lambda e: e.label == 1)
+    # Entities without a field never match on it.
+    assert sorted(indexed.select('(label == 0) | (duration > 12)')) == \
+        expected(range(30), lambda e: 'duration' in e.keys() and (
+            e.label == 0 or e.duration > 12))
+    with pytest.raises(ValueError):
+        indexed.create_index('label')
+    with pytest.raises(ValueError):
+        indexed.create_index('x')
+    with pytest.raises(ValueError):
+        indexed.add('bad', biggie.Entity(label='one'))
+    assert 'bad' not in indexed.keys()
+
+    indexed.remove('4')
+    indexed.add('7', make_entity(8), overwrite=True)
+    indexed.add('30', make_entity(30))
+    with indexed.bulk_writer() as writer:
+        writer.add('31', make_entity(31))
+    keys = [str(idx) for idx in range(32) if idx != 4]
+    assert sorted(indexed.select('label == 2'), key=int) == [
+        key for key in keys if make_entity(
+            8 if key == '7' else int(key)).label == 2]
+    indexed.close()
+
+    stash = biggie.Stash(indexed._filename, mode='r')
+    assert stash.indexes == ['duration', 'label']
+    assert sorted(stash.select('label == 2')) == sorted(
+        indexed.select('label == 2'))
+    assert sorted(stash.select('duration == 4')) == ['7', '8']
+    stash.close()
+    clone = pickle.loads(pickle.dumps(stash))
+    assert sorted(clone.select('duration == 4')) == ['7', '8']
+    with pytest.raises(ValueError):
+        clone.create_index('name')
+
+
+@pytest.mark.unit
+def test_Stash_index_rejected_overwrite(indexed):
+    with pytest.raises(ValueError):
+        indexed.add('3', biggie.Entity(label='oops'), overwrite=True)
+    with pytest.raises(ValueError):
+        with indexed.bulk_writer(overwrite=True) as writer:
+            writer.add('6', biggie.Entity(label='oops'))
+    for key in ('3', '6'):
+        assert indexed.get(key).name == 'entity{}'.format(key)
+    assert sorted(indexed.select('label == 0'), key=int) == [
+        str(idx) for idx in range(0, 30, 3)]
+
+
+@pytest.mark.unit
+def test_Stash_index_compact(indexed):
+    indexed.create_index('name')
+    for idx in range(0, 30, 2):
+        indexed.remove(str(idx))
+    indexed.drop_index('duration')
+    indexed.compact(order='key')
+    assert indexed.indexes == ['label', 'name']
+    assert sorted(indexed.select('label == 0')) == expected(
+        range(1, 30, 2), lambda e: e.label == 0)
+    assert indexed.select('name == "entity13"') == ['13']
+
+
+# Helper for a spawned writer, dying without closing its stash.
+def write_and_crash(filename):
+    stash = biggie.Stash(filename, journal=True)
+    stash.add('0', make_entity(0), overwrite=True)
+    stash.remove('1')
+    stash.add('100', make_entity(100))
+    stash.flush()
+    os._exit(0)
+
+
+@pytest.mark.unit
+def test_Stash_index_journal():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name)
+    stash.add_many((str(idx), make_entity(idx + 1)) for idx in range(10))
+    stash.create_index('label')
+    stash.close()
+
+    proc = multiprocessing.get_context('spawn').Process(
+        target=write_and_crash, args=(fp.name,))
+    proc.start()
+    proc.join()
+
+    stash = biggie.Stash(fp.name, mode='r')
+    assert sorted(stash.select('label == 1'), key=int) == [
+        '3', '6', '9', '100']
+    assert sorted(stash.select('label == 0'), key=int) == [
+        '0', '2', '5', '8']
+    assert sorted(stash.select('label == 2')) == ['4', '7']
+
+
+def _scan(stash):
+    return [key for key in stash.keys() if stash.get(key).label == 1]
+
+
+@pytest.fixture(scope='module')
+def many():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name)
+    stash.add_many((str(idx), biggie.Entity(label=idx % 10))
+                   for idx in range(2000))
+    stash.create_index('label')
+    stash._fp = fp
+    return stash
+
+
+@pytest.mark.benchmark(min_rounds=5)
+def testbench_Stash_scan(benchmark, many):
+    benchmark(_scan, many)
+
+
+@pytest.mark.benchmark(min_rounds=5)
+def testbench_Stash_select(benchmark, many):
+    benchmark(many.select, 'label == 1')
@@ -0,0 +1,87 @@
+import pytest
+
+import multiprocessing
+import numpy as np
+import tempfile as tmp
+
+from six.moves import queue
+
+import biggie
+import biggie.ingest as ingest
+
+
+def make_entity(idx):
+    return biggie.Entity(big=np.ones((64, 128)) * idx, small=np.arange(idx),
+                         label=idx, name='entity{}'.format(idx))
+
+
+def check_stash(filename, indices):
+    stash = biggie.Stash(filename, mode='r')
+    assert sorted(stash.keys(), key=int) == [str(idx) for idx in indices]
+    for idx in indices:
+        entity = stash.get(str(idx))
+        expected = make_entity(idx)
+        for field in expected.keys():
+            np.testing.assert_array_equal(entity[field].value,
+                                          expected[field].value)
+
+
+@pytest.mark.unit
+def test_Ingestor():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    reports = []
+    with ingest.Ingestor(fp.name, batch_size=8, callback=reports.append,
+                         max_pending=4) as ingestor:
+        for idx in range(30):
+            ingestor.send(idx, make_entity(idx))
+        ingestor.send(3, make_entity(3))
+    progress = ingestor.progress()
+
+    assert progress['done']
+    assert progress['count'] == 30
+    assert progress['failures'] == 1
+    assert progress['failed'][0][0] == '3'
+    assert progress['nbytes'] > 30 * 64 * 128 * 8
+    assert progress['commits'] >= 4
+    assert reports[-1] == progress
+    check_stash(fp.name, range(30))
+
+
+@pytest.mark.unit
+def test_Producer_backpressure():
+    messages = multiprocessing.Queue(1)
+    producer = ingest.Producer(messages, shm_threshold=None)
+    producer.send('a', biggie.Entity(x=np.arange(3)), timeout=0.1)
+    with pytest.raises(queue.Full):
+        producer.send('b', biggie.Entity(x=np.arange(3)), timeout=0.1)
+    key, fields = messages.get()
+    assert key == 'a'
+    np.testing.assert_array_equal(dict(fields)['x'], np.arange(3))
+
+
+# Helpers for spawned producers.
+PRODUCER = None
+
+
+def init_producer(producer):
+    global PRODUCER
+    PRODUCER = producer
+
+
+def produce(idx):
+    PRODUCER.send(idx, make_entity(idx))
+    return idx
+
+
+@pytest.mark.unit
+def test_Ingestor_producers():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    with ingest.Ingestor(fp.name, batch_size=16, max_pending=8,
+                         overwrite=True) as ingestor:
+        pool = multiprocessing.get_context('spawn').Pool(
+            3, initializer=init_producer, initargs=(ingestor.producer,))
+        assert pool.map(produce, range(40)) == list(range(40))
+        pool.close()
+        pool.join()
+    assert ingestor.progress()['count'] == 40
+    check_stash(fp.name, range(40))
@@ -0,0 +1,171 @@
+import pytest
+
+import h5py
+import json
+import random
+import tempfile as tmp
+
+import biggie.keymap as keymap
+
+
+@pytest.fixture
+def fhandle():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    fh = h5py.File(fp.name, mode='a')
+    yield fh
+    fh.close()
+
+
+@pytest.fixture
+def small_blocks(monkeypatch):
+    monkeypatch.setattr(keymap.Keymap, 'BLOCK', 4)
+    monkeypatch.setattr(keymap.Keymap, 'MIN_TAIL', 8)
+
+
+@pytest.mark.unit
+def test_Keymap_empty(fhandle):
+    kmap = keymap.Keymap(lambda: fhandle)
+    assert len(kmap) == 0
+    assert 'a' not in kmap
+    with pytest.raises(KeyError):
+        kmap['a']
+    kmap.flush()
+    kmap.flush()
+    assert len(keymap.Keymap(lambda: fhandle)) == 0
+
+
+@pytest.mark.unit
+def test_Keymap_setitem_getitem(fhandle):
+    kmap = keymap.Keymap(lambda: fhandle)
+    kmap['b'] = '00/00/01'
+    kmap['a'] = '00/00/00'
+    assert kmap['a'] == '00/00/00'
+    assert len(kmap) == 2
+    assert list(kmap) == ['a', 'b']
+    kmap.flush()
+
+    kmap = keymap.Keymap(lambda: fhandle)
+    assert kmap['b'] == '00/00/01'
+    assert kmap == dict(a='00/00/00', b='00/00/01')
+
+
+@pytest.mark.unit
+def test_Keymap_delitem(fhandle):
+    kmap = keymap.Keymap(lambda: fhandle)
+    kmap.update(a='x', b='y', c='z')
+    kmap.flush()
+    del kmap['b']
+    with pytest.raises(KeyError):
+        del kmap['b']
+    assert kmap.pop('c') == 'z'
+    assert len(kmap) == 1
+    kmap.flush()
+
+    kmap = keymap.Keymap(lambda: fhandle)
+    assert kmap.items() == [('a', 'x')]
+    assert 'b' not in kmap
+
+
+@pytest.mark.unit
+def test_Keymap_append(fhandle, small_blocks):
+    kmap = keymap.Keymap(lambda: fhandle)
+    for n in range(10):
+        kmap['{:03d}'.format(n)] = str(n)
+    kmap.flush()
+    for n in range(10, 20):
+        kmap['{:03d}'.format(n)] = str(n)
+    kmap.flush()
+
+    grp = fhandle['__KEYINDEX__']
+    assert grp['keys'].shape == (20,)
+    assert grp['tail_keys'].shape == (0,)
+    assert grp['fences'][()].tolist() == [b'000', b'004', b'008',
+                                          b'012', b'016']
+    kmap = keymap.Keymap(lambda: fhandle)
+    assert all(kmap['{:03d}'.format(n)] == str(n) for n in range(20))
+
+
+@pytest.mark.unit
+def test_Keymap_random_ops(fhandle, small_blocks):
+    rng = random.Random(123)
+    kmap = keymap.Keymap(lambda: fhandle)
+    expected = dict()
+    for n in range(1000):
+        key = 'key{}'.format(rng.randint(0, 100))
+        if rng.random() < 0.3 and key in expected:
+            del kmap[key]
+            del expected[key]
+        else:
+            kmap[key] = expected[key] = str(rng.randint(0, 10 ** 6))
+        if rng.random() < 0.1:
+            kmap.flush()
+            kmap = keymap.Keymap(lambda: fhandle)
+        assert len(kmap) == len(expected)
+
+    assert kmap.items() == sorted(expected.items())
+    for key in ['key{}'.format(n) for n in range(110)]:
+        assert (key in kmap) == (key in expected)
+        assert kmap.get(key) == expected.get(key)
+
+
+@pytest.mark.unit
+def test_Keymap_legacy(fhandle):
+    fhandle['legacy'] = json.dumps(dict(a='00/00/00', b='00/00/01'))
+    kmap = keymap.Keymap(lambda: fhandle, legacy_name='legacy')
+    assert kmap == dict(a='00/00/00', b='00/00/01')
+    kmap.flush()
+    assert 'legacy' not in fhandle
+    assert keymap.Keymap(lambda: fhandle)['b'] == '00/00/01'
+
+
+@pytest.mark.unit
+def test_Keymap_journal(fhandle, small_blocks):
+    kmap = keymap.Keymap(lambda: fhandle, journal=True)
+    kmap.update(a='x', b='y')
+    # Syncing before the first flush flushes.
+    kmap.sync()
+    assert 'journal_keys' not in fhandle['__KEYINDEX__']
+
+    rng = random.Random(7)
+    expected = dict(a='x', b='y')
+    for n in range(200):
+        key = 'key{}'.format(rng.randint(0, 30))
+        if rng.random() < 0.3 and key in expected:
+            del kmap[key]
+            del expected[key]
+        else:
+            kmap[key] = expected[key] = str(n)
+        if rng.random() < 0.2:
+            kmap.sync()
+    kmap.sync()
+    grp = fhandle['__KEYINDEX__']
+    assert grp['journal_keys'].shape == grp['journal_addrs'].shape
+    assert grp['journal_keys'].shape[0] == 200
+    assert grp['tail_keys'].shape == (0,)
+
+    # Unsynced changes are lost; synced ones are replayed.
+    kmap['lost'] = 'z'
+    kmap = keymap.Keymap(lambda: fhandle)
+    assert kmap.items() == sorted(expected.items())
+    assert len(kmap.recovered) == 200
+    assert kmap.recovered[0][1:] == (None, '0')
+
+    kmap.flush()
+    assert 'journal_keys' not in grp
+    kmap = keymap.Keymap(lambda: fhandle)
+    assert kmap.recovered == []
+    assert kmap.items() == sorted(expected.items())
+
+
+@pytest.mark.unit
+def test_Keymap_journal_torn(fhandle):
+    kmap = keymap.Keymap(lambda: fhandle, journal=True)
+    kmap['a'] = 'x'
+    kmap.flush()
+    kmap['b'] = 'y'
+    kmap.sync()
+    # A sync cut short between the keys and the addresses.
+    grp = fhandle['__KEYINDEX__']
+    grp['journal_keys'].resize((3,))
+    grp['journal_keys'][2] = b'c'
+    assert keymap.Keymap(lambda: fhandle) == dict(a='x', b='y')
@@ -0,0 +1,130 @@
+import pytest
+
+import numpy as np
+import pickle
+import tempfile as tmp
+
+import biggie
+import biggie.mapped as mapped
+import biggie.storage as storage
+import biggie.util as util
+
+
+@pytest.fixture(scope='module')
+def mapped_data():
+    class Data(object):
+        fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+        values = dict()
+
+    stash = biggie.Stash(Data.fp.name, storage={
+        'packed': storage.StoragePolicy(compression='gzip')})
+    data_gen = util.random_ndarray_generator((128, 64), max_items=10)
+    for idx, (key, value) in enumerate(data_gen):
+        Data.values[str(idx)] = value
+        stash.add(str(idx), biggie.Entity(
+            data=value, label=idx, ints=np.arange(idx + 1, dtype='>i4'),
+            packed=value[:4], name='entity{}'.format(idx)))
+    stash.add('empty', biggie.Entity(data=np.zeros((0, 3))))
+    stash.close()
+    return Data
+
+
+@pytest.mark.unit
+def test_Stash_mmap(mapped_data):
+    stash = biggie.Stash(mapped_data.fp.name, mode='r', mmap=True)
+    entity = stash.get('3')
+    value = mapped_data.values['3']
+    for field in ['data', 'label', 'ints']:
+        assert entity[field].mapped
+    for field in ['packed', 'name']:
+        assert not entity[field].mapped
+
+    np.testing.assert_array_equal(entity['data'].value, value)
+    np.testing.assert_array_equal(entity['packed'].value, value[:4])
+    np.testing.assert_array_equal(entity['ints'].value, np.arange(4))
+    assert entity['label'].value == 3
+    assert entity['name'].value == 'entity3'
+    assert entity['data'].shape == (128, 64)
+    assert entity['data'].dtype == np.float64
+    assert stash.get('empty')['data'].shape == (0, 3)
+    assert not stash.get('empty')['data'].mapped
+
+    # Views of the same pages, which can't be written to.
+    assert np.shares_memory(entity['data'].value,
+                            stash.get('3')['data'].value)
+    assert not entity['data'].value.flags.writeable
+    with pytest.raises(ValueError):
+        entity['data'].value[0, 0] = 1
+
+    np.testing.assert_array_equal(entity['data'][2:5, 3], value[2:5, 3])
+    out = np.zeros((2, 4, 64))
+    entity['data'].read_direct(out, (slice(4, 8),), 1)
+    np.testing.assert_array_equal(out[1], value[4:8])
+
+
+@pytest.mark.unit
+def test_Stash_mmap_fields(mapped_data):
+    stash = biggie.Stash(mapped_data.fp.name, mode='r', mmap=True,
+                         cache_size=False)
+    entity = stash.get('3')
+    assert sorted(entity.keys()) == ['data', 'ints', 'label', 'name',
+                                     'packed']
+    # Datasets are opened (and mapped) as their fields are first used.
+    assert all(biggie.core._DATASET.__get__(field) is None
+               for field in biggie.core._get_fields(entity))
+    entity = stash.get('3', fields=['label', 'data'])
+    assert entity.keys() == ['label', 'data']
+    assert isinstance(entity['data'], mapped.MappedField)
+    assert entity.label == 3
+    assert biggie.core._DATASET.__get__(entity['data']) is None
+    np.testing.assert_array_equal(entity.data, mapped_data.values['3'])
+    with pytest.raises(KeyError):
+        stash.get('3', fields=['missing'])
+
+
+@pytest.mark.unit
+def test_Stash_mmap_writable(mapped_data):
+    with pytest.raises(ValueError):
+        biggie.Stash(mapped_data.fp.name, mmap=True)
+
+
+@pytest.mark.unit
+def test_Stash_mmap_pickle(mapped_data):
+    stash = biggie.Stash(mapped_data.fp.name, mode='r', mmap=True)
+    stash.get('1')['data'].value
+    stash.close()
+    clone = pickle.loads(pickle.dumps(stash))
+    np.testing.assert_array_equal(clone.get('1')['data'].value,
+                                  mapped_data.values['1'])
+
+
+@pytest.mark.unit
+def test_FileMap_view():
+    fp = tmp.NamedTemporaryFile(suffix=".bin")
+    fp.write(np.arange(10, dtype=np.int32).tobytes())
+    fp.flush()
+    filemap = mapped.FileMap(fp.name)
+    np.testing.assert_array_equal(filemap.view(8, (2, 2), np.int32),
+                                  [[2, 3], [4, 5]])
+    with pytest.raises(ValueError):
+        filemap.view(32, (4,), np.int32)
+
+    # Growing files are remapped.
+    fp.write(np.arange(10, 20, dtype=np.int32).tobytes())
+    fp.flush()
+    np.testing.assert_array_equal(filemap.view(32, (4,), np.int32),
+                                  [8, 9, 10, 11])
+
+
+@pytest.mark.benchmark(min_rounds=100)
+def testbench_Stash_get_value(benchmark, mapped_data):
+    stash = biggie.Stash(mapped_data.fp.name, mode='r')
+    field = stash.get('3')['data']
+    benchmark(lambda: field.value.sum())
+
+
+@pytest.mark.benchmark(min_rounds=100)
+def testbench_Stash_get_value_mmap(benchmark, mapped_data):
+    stash = biggie.Stash(mapped_data.fp.name, mode='r', mmap=True)
+    field = stash.get('3')['data']
+    benchmark(lambda: field.value.sum())
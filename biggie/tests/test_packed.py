@@ -0,0 +1,236 @@
+import pytest
+
+import h5py
+import numpy as np
+import pickle
+import tempfile as tmp
+
+import biggie
+import biggie.packed as packed
+import biggie.sampler as sampler
+import biggie.util as util
+
+
+def make_entity(idx):
+    return biggie.Entity(x=np.arange(idx % 5 + 1, dtype=np.float32) + idx,
+                         y=np.ones((idx % 3 + 1, 2)) * idx, label=idx,
+                         name='entity{}'.format(idx))
+
+
+def check_entity(entity, idx):
+    expected = make_entity(idx)
+    assert sorted(entity.keys()) == sorted(expected.keys())
+    for key in expected.keys():
+        np.testing.assert_array_equal(entity[key].value, expected[key].value)
+
+
+@pytest.fixture()
+def packed_file():
+    return tmp.NamedTemporaryFile(suffix=".hdf5")
+
+
+@pytest.mark.unit
+def test_Stash_packed(packed_file):
+    packed_stash = biggie.Stash(packed_file.name, layout='packed')
+    for idx in range(10):
+        packed_stash.add(str(idx), make_entity(idx))
+    # Buffered, but readable.
+    check_entity(packed_stash.get('3'), 3)
+    packed_stash.close()
+
+    fh = h5py.File(packed_file.name, mode='r')
+    assert sorted(fh[biggie.Stash.__PACKED__].keys()) == \
+        ['keys', 'label', 'name', 'x', 'y']
+    assert fh[biggie.Stash.__PACKED__]['x/data'].shape == (sum(
+        idx % 5 + 1 for idx in range(10)),)
+    fh.close()
+
+    stash = biggie.Stash(packed_file.name, mode='r')
+    assert stash.layout == 'packed'
+    assert len(stash) == 10
+    for idx in range(10):
+        entity = stash.get(str(idx))
+        assert isinstance(entity['x'], packed.PackedField)
+        check_entity(entity, idx)
+
+
+@pytest.mark.unit
+def test_Stash_packed_remove(packed_file):
+    packed_stash = biggie.Stash(packed_file.name, layout='packed')
+    packed_stash.add_many((str(idx), make_entity(idx)) for idx in range(10))
+    packed_stash.remove('4')
+    packed_stash.remove('5')
+    packed_stash.close()
+
+    stash = biggie.Stash(packed_file.name)
+    assert '4' not in stash.keys()
+    stash.add('4', make_entity(12))
+    stash.add('6', biggie.Entity(label=3), overwrite=True)
+    stash.close()
+
+    stash = biggie.Stash(packed_file.name, mode='r')
+    check_entity(stash.get('4'), 12)
+    assert stash.get('6').keys() == ['label']
+    check_entity(stash.get('7'), 7)
+    assert stash.get('5') is None
+
+
+@pytest.mark.unit
+def test_Stash_packed_schema(packed_file):
+    packed_stash = biggie.Stash(packed_file.name, layout='packed')
+    packed_stash.add('a', biggie.Entity(y=np.ones((3, 2))))
+    with pytest.raises(ValueError):
+        packed_stash.add('b', biggie.Entity(y=np.ones((3, 3))))
+    with pytest.raises(ValueError):
+        packed_stash.add('b', biggie.Entity(y=3))
+    with pytest.raises(ValueError):
+        packed_stash.add('b', biggie.Entity(s=np.array(['a', 'b'])))
+    # Rejected overwrites keep the old entity.
+    with pytest.raises(ValueError):
+        packed_stash.add('a', biggie.Entity(y=3), overwrite=True)
+    assert list(packed_stash.keys()) == ['a']
+    assert packed_stash.get('a').y.shape == (3, 2)
+    assert len(packed_stash.agu) == 1
+    packed_stash.close()
+
+
+@pytest.mark.unit
+def test_Stash_layout_mismatch(packed_file):
+    packed_stash = biggie.Stash(packed_file.name, layout='packed')
+    packed_stash.close()
+    with pytest.raises(ValueError):
+        biggie.Stash(packed_file.name, layout='tree')
+    with pytest.raises(ValueError):
+        biggie.Stash(packed_file.name, layout='columns')
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name)
+    stash.add('a', biggie.Entity(x=1))
+    stash.close()
+    with pytest.raises(ValueError):
+        biggie.Stash(fp.name, layout='packed')
+    assert biggie.Stash(fp.name).layout == 'tree'
+
+
+@pytest.mark.unit
+def test_PackedField_slice(packed_file):
+    packed_stash = biggie.Stash(packed_file.name, layout='packed')
+    value = np.arange(60).reshape(10, 6)
+    packed_stash.add('a', biggie.Entity(pad=np.zeros((3, 6))))
+    packed_stash.add('b', biggie.Entity(pad=value))
+    packed_stash.close()
+    stash = biggie.Stash(packed_file.name, mode='r')
+    field = stash.get('b')['pad']
+    assert field.shape == (10, 6)
+    for sel in [(slice(2, 5),), (slice(2, 5), slice(1, 3)), 3, -1,
+                (Ellipsis, 2), (slice(None, None, 3),), [slice(8, 20)],
+                (slice(None, None, -1),)]:
+        np.testing.assert_array_equal(field[sel], value[tuple(sel)
+                                                         if isinstance(
+                                                             sel, list)
+                                                         else sel])
+    with pytest.raises(IndexError):
+        field[10]
+
+    out = np.zeros((2, 4, 6))
+    field.read_direct(out, (slice(4, 8),), 1)
+    np.testing.assert_array_equal(out[1], value[4:8])
+
+
+@pytest.mark.unit
+def test_Stash_packed_batches(packed_file):
+    packed_stash = biggie.Stash(packed_file.name, layout='packed')
+    values = dict()
+    data_gen = util.random_ndarray_generator((16, 3), max_items=20)
+    for key, value in data_gen:
+        values[str(key)] = value
+    packed_stash.add_many((k, biggie.Entity(data=v))
+                          for k, v in values.items())
+    keys = sorted(values.keys())
+    arrays = packed_stash.get_many(keys)
+    np.testing.assert_array_equal(arrays['data'], [values[k] for k in keys])
+
+    windows = sampler.WindowSampler(packed_stash, 'data', 4, seed=1)
+    draws = windows.draw(10)
+    batch = windows.read(draws)
+    for idx, (key, offset) in enumerate(draws):
+        np.testing.assert_array_equal(batch['data'][idx],
+                                      values[key][offset:offset + 4])
+
+
+@pytest.mark.unit
+def test_Stash_packed_pickle(packed_file):
+    packed_stash = biggie.Stash(packed_file.name, layout='packed')
+    packed_stash.add('a', make_entity(1))
+    packed_stash.add('b', make_entity(2))
+    packed_stash.close()
+    clone = pickle.loads(pickle.dumps(packed_stash))
+    check_entity(clone.get('a'), 1)
+    check_entity(clone.get('b'), 2)
+
+
+@pytest.mark.unit
+def test_Stash_packed_compact(packed_file):
+    packed_stash = biggie.Stash(packed_file.name, layout='packed')
+    packed_stash.add_many((str(idx), make_entity(idx)) for idx in range(50))
+    packed_stash.close()
+    for idx in range(0, 50, 3):
+        packed_stash.remove(str(idx))
+    packed_stash.add('4', make_entity(4), overwrite=True)
+
+    packed_stash.compact(order='key')
+    assert packed_stash.layout == 'packed'
+    assert packed_stash.agu.next_index == len(packed_stash)
+    packed_stash.close()
+
+    stash = biggie.Stash(packed_file.name, mode='r')
+    keys = [str(idx) for idx in range(50) if idx % 3]
+    assert sorted(stash.keys()) == sorted(keys)
+    for key in keys:
+        check_entity(stash.get(key), int(key))
+    assert stash._packed.__field_index__('x')[1].tolist() == [
+        int(key) % 5 + 1 for key in sorted(keys)]
+
+
+@pytest.mark.unit
+def test_Stash_packed_large_rows(packed_file):
+    packed_stash = biggie.Stash(packed_file.name, layout='packed')
+    for idx in range(2):
+        packed_stash.add(str(idx), biggie.Entity(x=np.ones((2, 512, 512)) *
+                                                 idx))
+    packed_stash.close()
+
+    fh = h5py.File(packed_file.name, mode='r')
+    data = fh[biggie.Stash.__PACKED__]['x/data']
+    assert np.prod(data.chunks) * data.dtype.itemsize <= \
+        packed.PackedStore.CHUNK_BYTES
+    fh.close()
+
+    stash = biggie.Stash(packed_file.name, mode='r')
+    for idx in range(2):
+        np.testing.assert_array_equal(stash.get(str(idx))['x'].value,
+                                      np.ones((2, 512, 512)) * idx)
+
+
+@pytest.mark.unit
+def test_Stash_packed_failed_flush(packed_file, monkeypatch):
+    packed_stash = biggie.Stash(packed_file.name, layout='packed')
+    for idx in range(5):
+        packed_stash.add(str(idx), make_entity(idx))
+    store = packed_stash._packed
+    create = store.__create__
+
+    def fail_once(grp, field):
+        monkeypatch.setattr(store, '__create__', create)
+        create(grp, field)
+        raise MemoryError("Unable to allocate")
+
+    monkeypatch.setattr(store, '__create__', fail_once)
+    with pytest.raises(MemoryError):
+        packed_stash.flush()
+    assert len(store._pending) == 5
+    check_entity(packed_stash.get('3'), 3)
+
+    packed_stash.close()
+    stash = biggie.Stash(packed_file.name, mode='r')
+    for idx in range(5):
+        check_entity(stash.get(str(idx)), idx)
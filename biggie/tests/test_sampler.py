@@ -0,0 +1,97 @@
+import pytest
+
+import numpy as np
+import tempfile as tmp
+
+import biggie
+import biggie.sampler as sampler
+
+
+@pytest.fixture(scope='module')
+def window_data():
+    class Data(object):
+        fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+        values = dict()
+
+    stash = biggie.Stash(Data.fp.name)
+    rng = np.random.RandomState(123)
+    for idx, length in enumerate([3, 10, 40, 100]):
+        key = 'entity{}'.format(idx)
+        Data.values[key] = rng.normal(size=(length, 5))
+        stash.add(key, biggie.Entity(x=Data.values[key],
+                                     y=np.arange(length), label=idx))
+    stash.close()
+    return Data
+
+
+@pytest.mark.unit
+def test_WindowSampler(window_data):
+    stash = biggie.Stash(window_data.fp.name, mode='r')
+    windows = sampler.WindowSampler(stash, 'x', length=8, seed=1)
+    assert sorted(windows.keys) == ['entity1', 'entity2', 'entity3']
+    assert len(windows) == 3 + 33 + 93
+
+    draws = windows.draw(50)
+    batch = windows.read(draws)
+    assert batch['x'].shape == (50, 8, 5)
+    for idx, (key, offset) in enumerate(draws):
+        assert 0 <= offset <= len(window_data.values[key]) - 8
+        np.testing.assert_array_equal(
+            batch['x'][idx], window_data.values[key][offset:offset + 8])
+
+
+@pytest.mark.unit
+def test_WindowSampler_weighted(window_data):
+    stash = biggie.Stash(window_data.fp.name, mode='r')
+    counts = dict()
+    for weighted in True, False:
+        windows = sampler.WindowSampler(
+            stash, 'x', length=8, seed=1, weighted=weighted)
+        keys = [key for key, offset in windows.draw(3000)]
+        counts[weighted] = keys.count('entity1') / 3000.0
+    assert abs(counts[True] - 3 / 129.0) < 0.02
+    assert abs(counts[False] - 1 / 3.0) < 0.05
+
+
+@pytest.mark.unit
+def test_WindowSampler_fields(window_data):
+    stash = biggie.Stash(window_data.fp.name, mode='r', cache_size=2)
+    stash.get('entity2')
+    windows = sampler.WindowSampler(stash, ['x', 'y'], length=4,
+                                    keys=['entity1', 'entity2'], seed=2)
+    draws = windows.draw(20)
+    out = dict(x=np.zeros((20, 4, 5)), y=np.zeros((20, 4), dtype=int))
+    batch = windows.read(draws, out=out)
+    assert batch['x'] is out['x']
+    for idx, (key, offset) in enumerate(draws):
+        np.testing.assert_array_equal(batch['y'][idx],
+                                      np.arange(offset, offset + 4))
+
+
+@pytest.mark.unit
+def test_WindowSampler_axis(window_data):
+    stash = biggie.Stash(window_data.fp.name, mode='r')
+    windows = sampler.WindowSampler(stash, 'x', length=2, axis=1, seed=3,
+                                    keys=['entity2', 'entity3'])
+    with pytest.raises(ValueError):
+        # Windows of entities of different lengths don't stack.
+        windows.sample(20)
+    windows.refresh(['entity3'])
+    batches = list(windows.batches(10, max_batches=2))
+    assert batches[0]['x'].shape == (10, 100, 2)
+    assert batches[0]['x'] is batches[1]['x']
+
+
+@pytest.mark.unit
+def test_WindowSampler_too_long(window_data):
+    stash = biggie.Stash(window_data.fp.name, mode='r')
+    with pytest.raises(ValueError):
+        sampler.WindowSampler(stash, 'x', length=101)
+
+
+@pytest.mark.benchmark(min_rounds=10)
+def testbench_WindowSampler_sample(benchmark, window_data):
+    stash = biggie.Stash(window_data.fp.name, mode='r')
+    windows = sampler.WindowSampler(stash, 'x', length=8, seed=1)
+    out = windows.sample(64)
+    benchmark(windows.sample, 64, out=out)
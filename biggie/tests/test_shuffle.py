@@ -0,0 +1,106 @@
+import pytest
+
+import numpy as np
+import tempfile as tmp
+
+import biggie
+import biggie.shuffle as shuffle
+import biggie.stream as stream
+
+
+@pytest.fixture(scope='module')
+def stash():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name)
+    stash.add_many((str(idx), biggie.Entity(x=np.arange(3) + idx, y=idx))
+                   for idx in range(500))
+    stash._fp = fp
+    return stash
+
+
+@pytest.mark.unit
+def test_EpochShuffler_schedule(stash):
+    shuffler = shuffle.EpochShuffler(stash, block_size=10, buffer_size=50,
+                                     seed=3)
+    order, reads, num_read = shuffler.schedule()
+    assert sorted(order) == sorted(reads) == sorted(stash.keys())
+    assert order == shuffler.schedule(0)[0]
+    assert order != shuffler.schedule(1)[0]
+    assert order == shuffle.EpochShuffler(
+        stash, block_size=10, buffer_size=50, seed=3).schedule()[0]
+
+    # Reads are sequential within blocks.
+    rows = [int(key) for key in reads]
+    assert sum(b - a != 1 for a, b in zip(rows, rows[1:])) == 49
+    # Nothing is delivered before it's read, nor held longer than the buffer.
+    position = dict((key, n) for n, key in enumerate(reads))
+    for key, count in zip(order, num_read):
+        assert position[key] < count
+    assert np.all(np.diff(num_read) >= 0)
+    assert num_read[0] == 50
+    # Reasonably mixed: entities stray far from their position in the file.
+    assert abs(np.corrcoef(np.arange(500), [int(k) for k in order])[0, 1]) \
+        < 0.5
+
+
+@pytest.mark.unit
+def test_EpochShuffler_iter(stash):
+    shuffler = shuffle.EpochShuffler(stash, block_size=16, buffer_size=32,
+                                     seed=0, fields=['y'])
+    assert len(shuffler) == 500
+    first = [(key, entity.y) for key, entity in shuffler]
+    assert [key for key, y in first] == shuffler.schedule(0)[0]
+    assert all(int(key) == y for key, y in first)
+    assert shuffler.state() == dict(seed=0, epoch=1, position=0,
+                                    num_keys=500)
+    second = [key for key, entity in shuffler]
+    assert sorted(second) == sorted(key for key, y in first)
+    assert second != [key for key, y in first]
+
+
+@pytest.mark.unit
+def test_EpochShuffler_resume(stash):
+    shuffler = shuffle.EpochShuffler(stash, block_size=8, buffer_size=64)
+    expected = shuffler.schedule()[0]
+    delivered = []
+    for key, entity in shuffler:
+        delivered.append(key)
+        if len(delivered) == 123:
+            break
+    state = shuffler.state()
+    assert state['position'] == 123
+
+    resumed = shuffle.EpochShuffler(stash, block_size=8, buffer_size=64)
+    resumed.load_state(state)
+    for key, entity in resumed:
+        assert entity.x[0] == int(key)
+        delivered.append(key)
+    assert delivered == expected
+    assert resumed.state()['epoch'] == 1
+
+    with pytest.raises(ValueError):
+        shuffle.EpochShuffler(stash, keys=['1', '2']).load_state(state)
+    with pytest.raises(ValueError):
+        shuffle.EpochShuffler(stash, block_size=0)
+
+
+def _random_epoch(stash, keys, rng):
+    for key in rng.permutation(keys):
+        stream._fetch(stash, key, None).x
+
+
+def _shuffled_epoch(shuffler):
+    for key, entity in shuffler:
+        entity.x
+
+
+@pytest.mark.benchmark(min_rounds=5)
+def testbench_random_epoch(benchmark, stash):
+    benchmark(_random_epoch, stash, list(stash.keys()),
+              np.random.RandomState(0))
+
+
+@pytest.mark.benchmark(min_rounds=5)
+def testbench_EpochShuffler(benchmark, stash):
+    benchmark(_shuffled_epoch, shuffle.EpochShuffler(
+        stash, block_size=32, buffer_size=128, seed=0))
@@ -4,11 +4,15 @@ import glob
 import h5py
 from joblib import Parallel, delayed
 import json
+import multiprocessing
 import numpy as np
 import os
+import pickle
+import shutil
 import tempfile as tmp
 
 import biggie
+import biggie.storage as storage
 import biggie.util as util
 
 
@@ -22,7 +26,7 @@ def test_Stash__init__():
 @pytest.mark.unit
 def test_Stash___load_keymap__():
     fp = tmp.NamedTemporaryFile(suffix=".hdf5")
-    fh = h5py.File(fp.name)
+    fh = h5py.File(fp.name, mode='a')
     keymap = dict(test='00')
     fh[biggie.Stash.__KEYMAP__] = json.dumps(keymap)
 
@@ -30,17 +34,36 @@ def test_Stash___load_keymap__():
     assert fh._keymap == keymap
 
 
+@pytest.mark.unit
+def test_Stash___load_keymap___migrate():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    fh = h5py.File(fp.name, mode='a')
+    keymap = dict(test='00')
+    fh[biggie.Stash.__KEYMAP__] = json.dumps(keymap)
+    fh.close()
+
+    stash = biggie.Stash(fp.name)
+    stash.close()
+    fh = h5py.File(fp.name, mode='a')
+    assert biggie.Stash.__KEYMAP__ not in fh
+    assert biggie.Stash.__KEYINDEX__ in fh
+
+    stash = biggie.Stash(fp.name)
+    assert stash._keymap == keymap
+
+
 @pytest.mark.unit
 def test_Stash___dump_keymap__():
     fp = tmp.NamedTemporaryFile(suffix=".hdf5")
     stash = biggie.Stash(fp.name)
     keymap = dict(test='00')
-    stash._keymap = keymap
+    stash._keymap.update(keymap)
     stash.close()
 
-    fh = h5py.File(fp.name)
-    dset = fh.get(biggie.Stash.__KEYMAP__)
-    assert dset.value == json.dumps(keymap)
+    fh = h5py.File(fp.name, mode='a')
+    grp = fh.get(biggie.Stash.__KEYINDEX__)
+    assert grp['keys'][()].tolist() == [b'test']
+    assert grp['addrs'][()].tolist() == [b'00']
 
 
 @pytest.mark.unit
@@ -122,6 +145,40 @@ def test_Stash_cache(data):
         "Failed to cache entity")
 
 
+@pytest.mark.unit
+def test_Stash_cache_hits():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name, cache_size=2)
+    for key, value in util.random_ndarray_generator((4, 4), max_items=3):
+        stash.add(key, biggie.Entity(data=value))
+
+    keys = sorted(stash.keys())
+    for key in keys + keys[:1]:
+        stash.get(key)
+    info = stash.cache_info()
+    assert info['misses'] == 4
+    assert info['hits'] == 0
+    assert info['items'] == 2
+
+    stash.get(keys[0])
+    assert stash.cache_info()['hits'] == 1
+    assert isinstance(stash.get(keys[0])['data'], biggie.core.Field)
+
+
+@pytest.mark.unit
+def test_Stash_cache_invalidate():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name, cache_size=10)
+    stash.add('a', biggie.Entity(x=np.arange(3)))
+    stash.get('a')
+    stash.add('a', biggie.Entity(x=np.arange(5)), overwrite=True)
+    np.testing.assert_array_equal(stash.get('a').x, np.arange(5))
+
+    stash.remove('a')
+    assert 'a' not in stash.__local__
+    assert stash.get('a') is None
+
+
 # Helper function
 def touch_one(stash, keys=None, key=None):
     key = np.random.choice(list(keys)) if keys else key
@@ -154,13 +211,84 @@ def test_Stash_parallel_read():
     # serialize. Else, `stash._agu = None`.See Issue-#1
     stash.close()
 
-    stash = biggie.Stash(fp.name, cache_size=0, keep_open=False)
+    stash = biggie.Stash(fp.name, mode='r', cache_size=0, keep_open=False)
     pool = Parallel(n_jobs=4)
     fx = delayed(touch_one)
     res = pool(fx(stash, key=key) for key in stash.keys())
     assert all(res)
 
 
+@pytest.mark.unit
+def test_Stash_handle_reuse(data):
+    stash = biggie.Stash(data.fp.name, keep_open=False)
+    opens = stash._handle_opens
+    for n in range(5):
+        stash.get(data.key).d
+    assert stash._handle_opens == opens + 1
+
+
+@pytest.mark.unit
+def test_Stash_pickle(data):
+    stash = biggie.Stash(data.fp.name, cache_size=5)
+    stash.get(data.key)
+    clone = pickle.loads(pickle.dumps(stash))
+    stash.close()
+    assert clone._mode == 'r'
+    assert len(clone.__local__) == 0
+    np.testing.assert_array_equal(clone.get(data.key).d, data.entity.d)
+    clone.close()
+
+
+# Helper for forked workers, which inherit this stash.
+FORKED_STASH = None
+
+
+def read_forked(key):
+    opens = FORKED_STASH._handle_opens
+    value = FORKED_STASH.get(key).data.sum()
+    FORKED_STASH.get(key).data
+    return value, os.getpid(), FORKED_STASH._handle_opens - opens
+
+
+@pytest.mark.unit
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="Requires fork.")
+def test_Stash_fork():
+    global FORKED_STASH
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name)
+    data_gen = util.random_ndarray_generator((8, 8), max_items=20)
+    expected = dict()
+    for key, value in data_gen:
+        stash.add(key, biggie.Entity(data=value))
+        expected[str(key)] = value.sum()
+    stash.close()
+
+    FORKED_STASH = biggie.Stash(fp.name, mode='r')
+    FORKED_STASH.get(str(key)).data
+    pool = multiprocessing.get_context('fork').Pool(2)
+    res = pool.map(read_forked, list(expected.keys()), chunksize=1)
+    pool.close()
+    pool.join()
+
+    assert [r[0] for r in res] == list(expected.values())
+    # Each worker opens its own handle once, on first use.
+    assert sum(r[2] for r in res) == len(set(r[1] for r in res))
+
+
+@pytest.mark.unit
+def test_Stash_swmr():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    fh = h5py.File(fp.name, mode='w', libver='latest')
+    fh.close()
+    stash = biggie.Stash(fp.name)
+    stash.add('a', biggie.Entity(x=np.arange(3)))
+    stash.close()
+
+    stash = biggie.Stash(fp.name, mode='r', swmr=True)
+    assert stash._fhandle.swmr_mode
+    np.testing.assert_array_equal(stash.get('a').x, np.arange(3))
+
+
 # Helper function
 def process_one(stash_in, key, stash_out):
     entity = stash_in.get(key)
@@ -194,3 +322,637 @@ def test_Stash_parallel_write():
     np.testing.assert_array_equal(
         stash_in.get(some_key).data * 2,
         stash_out.get(some_key).data)
+
+
+@pytest.fixture(scope='module')
+def batch_data():
+    class Data(object):
+        fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+        values = dict()
+
+    stash = biggie.Stash(Data.fp.name)
+    data_gen = util.random_ndarray_generator((8, 4), max_items=20)
+    for idx, (key, value) in enumerate(data_gen):
+        key = str(key)
+        Data.values[key] = value
+        stash.add(key, biggie.Entity(data=value, label=idx))
+    stash.close()
+    return Data
+
+
+@pytest.mark.unit
+def test_Stash_get_many(batch_data):
+    stash = biggie.Stash(batch_data.fp.name)
+    keys = list(stash.keys())[::-3]
+    arrays = stash.get_many(keys)
+    assert sorted(arrays.keys()) == ['data', 'label']
+    assert arrays['data'].shape == (len(keys), 8, 4)
+    np.testing.assert_array_equal(
+        arrays['data'], np.array([batch_data.values[k] for k in keys]))
+    np.testing.assert_array_equal(
+        arrays['label'], [stash.get(k).label for k in keys])
+
+
+@pytest.mark.unit
+def test_Stash_get_many_fields(batch_data):
+    stash = biggie.Stash(batch_data.fp.name, cache_size=5)
+    keys = list(stash.keys())[:10]
+    stash.get(keys[2])
+    arrays = stash.get_many(keys, fields=['data'])
+    assert list(arrays.keys()) == ['data']
+    np.testing.assert_array_equal(
+        arrays['data'], np.array([batch_data.values[k] for k in keys]))
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('layout', ['tree', 'packed'])
+def test_Stash_get_many_strings(layout):
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name, layout=layout)
+    stash.add_many((key, biggie.Entity(name='n' + key, y=int(key)))
+                   for key in ('1', '2'))
+    stash.close()
+
+    stash2 = biggie.Stash(fp.name, mode='r', cache_size=False)
+    arrays = stash2.get_many(['1', '2'])
+    assert arrays['name'].tolist() == ['n1', 'n2']
+    assert arrays['name'].tolist() == [stash2.get(key).name
+                                       for key in ('1', '2')]
+    stash2.close()
+
+
+@pytest.mark.unit
+def test_Stash_read_into(batch_data):
+    stash = biggie.Stash(batch_data.fp.name)
+    keys = list(stash.keys())[:4]
+    out = dict(data=np.zeros((4, 8, 4)))
+    stash.read_into(keys, out)
+    np.testing.assert_array_equal(
+        out['data'], np.array([batch_data.values[k] for k in keys]))
+
+    with pytest.raises(ValueError):
+        stash.read_into(keys, dict(data=np.zeros((4, 2, 4))))
+
+
+@pytest.mark.unit
+def test_Stash_read_into_order(monkeypatch):
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name, cache_size=False)
+    stash.add_many((str(idx), biggie.Entity(x=np.arange(2) + idx))
+                   for idx in range(300))
+    opened = []
+    h5g_open = h5py.h5g.open
+
+    def spy(loc, name, *args):
+        opened.append(name.decode('utf-8'))
+        return h5g_open(loc, name, *args)
+
+    monkeypatch.setattr(h5py.h5g, 'open', spy)
+    keys = ['299', '1', '256', '0']
+    arrays = stash.get_many(keys)
+    np.testing.assert_array_equal(arrays['x'][:, 0], [299, 1, 256, 0])
+    # Rows, i.e. the order of allocation, rather than address strings.
+    assert opened == [stash._keymap[key] for key in ['0', '1', '256', '299']]
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('layout', ['tree', 'packed'])
+@pytest.mark.parametrize('cache_size', [False, 5])
+def test_Stash_get_fields(layout, cache_size):
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name, layout=layout, cache_size=cache_size)
+    stash.add('a', biggie.Entity(x=np.arange(3), y=2, z='zed'))
+    # Packed entities are still pending here.
+    entity = stash.get('a', fields=['z', 'x'])
+    assert entity.keys() == ['z', 'x']
+    assert entity.z == 'zed'
+    stash.close()
+
+    stash2 = biggie.Stash(fp.name, layout=layout, cache_size=cache_size)
+    assert stash2.get('b', fields=['x']) is None
+    entity = stash2.get('a', fields=('y',))
+    assert entity.keys() == ['y']
+    assert entity.y == 2
+    with pytest.raises(KeyError):
+        stash2.get('a', fields=['x', 'w'])
+    # Full entities are unaffected by earlier projections, cached or not.
+    assert sorted(stash2.get('a').keys()) == ['x', 'y', 'z']
+    np.testing.assert_array_equal(
+        stash2.get('a', fields=['x']).x, np.arange(3))
+    stash2.close()
+
+
+@pytest.fixture(scope='module')
+def wide_data():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name)
+    stash.add_many(
+        (str(idx), biggie.Entity(**dict(('f{}'.format(n), np.arange(4) + n)
+                                        for n in range(40))))
+        for idx in range(50))
+    stash.close()
+    return fp
+
+
+def _get_field(stash, keys, fields=None):
+    return [stash.get(key, fields=fields).f7 for key in keys]
+
+
+@pytest.mark.benchmark(min_rounds=20)
+def testbench_Stash_get_wide(benchmark, wide_data):
+    stash = biggie.Stash(wide_data.name)
+    benchmark(_get_field, stash, list(stash.keys()))
+
+
+@pytest.mark.benchmark(min_rounds=20)
+def testbench_Stash_get_wide_fields(benchmark, wide_data):
+    stash = biggie.Stash(wide_data.name)
+    benchmark(_get_field, stash, list(stash.keys()), ['f7'])
+
+
+@pytest.mark.benchmark(min_rounds=100)
+def testbench_Stash_get_unpack(benchmark, batch_data):
+    stash = biggie.Stash(batch_data.fp.name)
+    keys = list(stash.keys())
+
+    def fx(keys):
+        return util.unpack_entity_list([stash.get(k) for k in keys])
+
+    benchmark(fx, keys)
+
+
+@pytest.mark.benchmark(min_rounds=100)
+def testbench_Stash_get_many(benchmark, batch_data):
+    stash = biggie.Stash(batch_data.fp.name)
+    benchmark(stash.get_many, list(stash.keys()))
+
+
+@pytest.mark.unit
+def test_Stash_add_many():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name)
+    stash.add('a', biggie.Entity(x=1))
+    data_gen = util.random_ndarray_generator((3, 2), max_items=50)
+    items = [(str(k), biggie.Entity(data=v, label=n, name='x'))
+             for n, (k, v) in enumerate(data_gen)]
+    assert stash.add_many(items) == len(items)
+    assert len(stash) == len(items) + 1
+
+    with pytest.raises(ValueError):
+        stash.add_many([('a', biggie.Entity(x=2))])
+    stash.add_many([('a', biggie.Entity(x=2))], overwrite=True)
+    stash.close()
+
+    stash = biggie.Stash(fp.name)
+    assert len(stash) == len(items) + 1
+    assert stash.get('a').x == 2
+    key, entity = items[7]
+    np.testing.assert_array_equal(stash.get(key).data, entity.data)
+    assert stash.get(key).label == 7
+    assert stash.get(key).name == 'x'
+
+
+@pytest.mark.unit
+def test_Stash_bulk_writer():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name)
+    with stash.bulk_writer(overwrite=True, block_size=2) as writer:
+        for n in range(5):
+            writer.add(str(n), biggie.Entity(x=np.arange(n + 1)))
+        writer.add('0', biggie.Entity(x=np.arange(10)))
+        assert len(stash) == 0
+
+    assert writer.count == 6
+    assert len(stash) == 5
+    assert len(set(stash.__addrs__())) == 5
+    np.testing.assert_array_equal(stash.get('0').x, np.arange(10))
+
+
+def _ingest_items(num_items=500):
+    data_gen = util.random_ndarray_generator((16, 16), max_items=num_items)
+    return [(str(k), biggie.Entity(data=v)) for k, v in data_gen]
+
+
+@pytest.mark.benchmark(min_rounds=5)
+def testbench_Stash_add_loop(benchmark):
+    items = _ingest_items()
+
+    def fx():
+        fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+        stash = biggie.Stash(fp.name)
+        for key, entity in items:
+            stash.add(key, entity)
+        stash.close()
+
+    benchmark(fx)
+    benchmark.extra_info['entities_per_sec'] = \
+        len(items) / benchmark.stats.stats.mean
+
+
+@pytest.mark.benchmark(min_rounds=5)
+def testbench_Stash_add_many(benchmark):
+    items = _ingest_items()
+
+    def fx():
+        fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+        stash = biggie.Stash(fp.name)
+        stash.add_many(items)
+        stash.close()
+
+    benchmark(fx)
+    benchmark.extra_info['entities_per_sec'] = \
+        len(items) / benchmark.stats.stats.mean
+
+
+@pytest.mark.unit
+def test_Stash_add_reopen():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name)
+    for n in range(5):
+        stash.add(str(n), biggie.Entity(x=n))
+    stash.remove('2')
+    stash.close()
+
+    stash = biggie.Stash(fp.name)
+    assert stash.agu.next_index == 5
+    stash.add('5', biggie.Entity(x=5))
+    stash.add('6', biggie.Entity(x=6))
+    assert stash._keymap['5'] == util.uniform_hexkey(2, 3)
+    assert stash._keymap['6'] == util.uniform_hexkey(5, 3)
+    assert [stash.get(str(n)).x for n in (0, 5, 6)] == [0, 5, 6]
+
+
+@pytest.mark.unit
+def test_Stash_field_policy(data):
+    stash = biggie.Stash(data.fp.name, field_policy='budget',
+                         field_budget=1000)
+    entity = stash.get(data.key)
+    np.testing.assert_array_equal(entity.d, data.entity.d)
+    assert entity['d']._value is not None
+    assert stash._field_budget.nbytes > 0
+
+
+@pytest.mark.unit
+def test_Stash_compact():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name, cache_size=10)
+    stash.add_many((str(idx), biggie.Entity(x=np.ones(4096) * idx, y=idx))
+                   for idx in range(20))
+    for idx in range(0, 20, 2):
+        stash.remove(str(idx))
+    for idx in range(1, 20, 4):
+        stash.add(str(idx), biggie.Entity(x=np.ones(4096) * -idx, y=-idx),
+                  overwrite=True)
+    stash.get('3')
+    keys = sorted(stash.keys())
+    by_addr = sorted(keys, key=lambda key: stash._keymap[key])
+
+    assert stash.compact() > 10 * 4096 * 8
+    assert sorted(stash.keys()) == keys
+    for key in keys:
+        sign = -1 if int(key) % 4 == 1 else 1
+        assert stash.get(key).y == sign * int(key)
+        assert stash.get(key).x[0] == sign * int(key)
+    # Addresses are contiguous, in the order of the old ones.
+    assert stash.agu.next_index == len(keys)
+    assert sorted(keys, key=lambda key: stash._keymap[key]) == by_addr
+    stash.add('new', biggie.Entity(y=0))
+    stash.close()
+
+    stash = biggie.Stash(fp.name, mode='r')
+    assert len(stash) == len(keys) + 1
+    assert glob.glob(fp.name + '.compact-*') == []
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('mode', ['w', 'w-'])
+def test_Stash_compact_created(mode):
+    tmpdir = tmp.mkdtemp()
+    fname = os.path.join(tmpdir, 'created.hdf5')
+    stash = biggie.Stash(fname, mode=mode)
+    stash.add_many((str(idx), biggie.Entity(x=np.ones(1024) * idx))
+                   for idx in range(10))
+    for idx in range(0, 10, 2):
+        stash.remove(str(idx))
+    assert stash.compact() > 0
+    assert len(stash) == 5
+    assert stash.get('3').x[0] == 3
+    stash.close()
+
+    stash2 = biggie.Stash(fname, mode='r')
+    assert sorted(stash2.keys()) == ['1', '3', '5', '7', '9']
+    stash2.close()
+    shutil.rmtree(tmpdir)
+
+
+# Helper for a spawned writer, dying without closing its stash.
+def write_and_crash(filename):
+    stash = biggie.Stash(filename, journal=True)
+    with stash.bulk_writer(block_size=8) as writer:
+        for idx in range(20):
+            writer.add(str(idx), biggie.Entity(x=np.ones(4) * idx))
+            if idx % 6 == 5:
+                writer.commit()
+    stash.remove('3')
+    stash.add('4', biggie.Entity(x=np.zeros(4)), overwrite=True)
+    stash.flush()
+    os._exit(0)
+
+
+@pytest.mark.unit
+def test_Stash_journal():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name)
+    stash.add('first', biggie.Entity(x=np.ones(4)))
+    stash.close()
+
+    proc = multiprocessing.get_context('spawn').Process(
+        target=write_and_crash, args=(fp.name,))
+    proc.start()
+    proc.join()
+    assert proc.exitcode == 0
+    fh = h5py.File(fp.name, mode='r')
+    assert fh[biggie.Stash.__KEYINDEX__]['journal_keys'].shape[0] > 20
+    fh.close()
+
+    stash = biggie.Stash(fp.name, mode='r')
+    keys = ['first'] + [str(idx) for idx in range(20) if idx != 3]
+    assert sorted(stash.keys()) == sorted(keys)
+    stash.close()
+    stash = biggie.Stash(fp.name)
+    assert sorted(stash.keys()) == sorted(keys)
+    assert stash.get('4').x.sum() == 0
+    assert stash.get('19').x.sum() == 4 * 19
+    # Addresses in use aren't handed out again.
+    used = set(stash._keymap.values())
+    assert stash.agu.next_index >= 21
+    assert not used.intersection(stash.agu.allocate_many(stash.agu.next_index))
+    stash.close()
+
+    fh = h5py.File(fp.name, mode='r')
+    assert 'journal_keys' not in fh[biggie.Stash.__KEYINDEX__]
+    fh.close()
+
+
+@pytest.mark.unit
+def test_Stash_repack():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(
+        fp.name, storage=storage.StoragePolicy(compression='gzip'))
+    for idx in range(10):
+        stash.add(str(idx), biggie.Entity(x=np.arange(100) + idx, y=idx))
+
+    with pytest.raises(ValueError):
+        stash.repack(fp.name)
+    dest = os.path.join(tmp.mkdtemp(), 'repacked.hdf5')
+    copy = stash.repack(dest, order=['7', '2', '7'], cache_size=5)
+    addrs = [copy._keymap[key] for key in ['7', '2', '0', '1', '3']]
+    assert addrs == sorted(addrs)
+    for idx in range(10):
+        np.testing.assert_array_equal(copy.get(str(idx)).x,
+                                      np.arange(100) + idx)
+    assert copy._fhandle[addrs[0]]['x'].compression == 'gzip'
+    copy.close()
+    os.remove(dest)
+
+    copy = stash.repack(dest, order='key')
+    assert list(copy.keys()) == sorted(
+        copy.keys(), key=lambda key: copy._keymap[key])
+    copy.close()
+    os.remove(dest)
+    for order in ['bogus', ['missing']]:
+        with pytest.raises((ValueError, KeyError)):
+            stash.repack(dest, order=order)
+
+    copy = stash.repack(dest, order=['7', '2'], layout='packed')
+    assert copy.layout == 'packed'
+    addrs = [copy._keymap[key] for key in ['7', '2', '0', '1', '3']]
+    assert addrs == sorted(addrs, key=copy.__row__)
+    for idx in range(10):
+        np.testing.assert_array_equal(copy.get(str(idx)).x,
+                                      np.arange(100) + idx)
+    copy.close()
+    os.remove(dest)
+    with pytest.raises(ValueError):
+        stash.repack(dest, layout='bogus')
+    assert not os.path.exists(dest)
+    with pytest.raises(ValueError):
+        biggie.Stash(fp.name, mode='r').compact()
+
+
+def make_stash(keys, offset=0, **kwargs):
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name, **kwargs)
+    stash.add_many((key, biggie.Entity(x=np.arange(10) + int(key) + offset,
+                                       name='n' + key)) for key in keys)
+    stash._fp = fp
+    return stash
+
+
+@pytest.mark.unit
+def test_Stash_merge():
+    src = make_stash([str(n) for n in range(10)], offset=100,
+                     storage=storage.StoragePolicy(compression='gzip'))
+    dst = make_stash([str(n) for n in range(5, 15)])
+    with pytest.raises(ValueError):
+        dst.merge(src)
+    with pytest.raises(KeyError):
+        dst.merge(src, keys=['missing'])
+    names = []
+    dst._fhandle.visit(names.append)
+    with pytest.raises(ValueError):
+        dst.merge(src, keys={'1': 'z', '2': 'z'})
+    after = []
+    dst._fhandle.visit(after.append)
+    assert after == names
+    assert len(dst) == 10
+
+    assert dst.merge(src, on_conflict='skip') == 5
+    assert sorted(dst.keys(), key=int) == [str(n) for n in range(15)]
+    assert dst.get('3').x[0] == 103
+    assert dst.get('7').x[0] == 7
+    assert dst._fhandle[dst._keymap['3']]['x'].compression == 'gzip'
+
+    assert dst.merge(src, keys=['7', '8'], on_conflict='overwrite') == 2
+    assert dst.get('7').x[0] == 107
+    assert dst.merge(src, keys={'1': 'one', '2': 'two'}) == 2
+    assert dst.get('one').x[0] == 101
+    assert dst._fhandle[dst._keymap['two']].attrs['key'] == 'two'
+    assert len(dst) == 17
+    dst.close()
+
+    reader = biggie.Stash(dst._filename, mode='r')
+    assert len(reader) == 17
+    assert reader.get('two').name == 'n2'
+    assert src.get('2').x[0] == 102
+
+
+@pytest.mark.unit
+def test_Stash_merge_link():
+    src = make_stash([str(n) for n in range(5)], offset=100)
+    dst = make_stash(['9'])
+    with pytest.raises(ValueError):
+        dst.merge(src, keys={'1': 'one'}, link=True)
+    assert dst.merge(src, link=True) == 5
+    link = dst._fhandle.get(dst._keymap['3'], getlink=True)
+    assert isinstance(link, h5py.ExternalLink)
+    assert dst.get('3').x[0] == 103
+    assert dst.remove('3')
+    src.close()
+    dst.close()
+
+    reader = biggie.Stash(src._filename, mode='r')
+    assert reader.get('3').x[0] == 103
+    reader.close()
+    reader = biggie.Stash(dst._filename, mode='r', mmap=True)
+    assert sorted(reader.keys()) == ['0', '1', '2', '4', '9']
+    assert reader.get('4').x[0] == 104
+    assert reader.get('9').x[0] == 9
+
+
+@pytest.mark.unit
+def test_Stash_merge_link_readonly():
+    src = make_stash(['1', '2'], offset=100)
+    src.close()
+    ro_src = biggie.Stash(src._filename, mode='r')
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    dst = biggie.Stash(fp.name, cache_size=False)
+    assert dst.merge(ro_src, link=True) == 2
+    # Unresolvable while the source is open read-only in this process.
+    with pytest.raises(IOError):
+        dst.get('1')
+    ro_src.close()
+    assert dst.get('1').x[0] == 101
+    dst.close()
+
+
+@pytest.mark.unit
+def test_Stash_merge_packed():
+    src = make_stash(['1', '2'], offset=100)
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    dst = biggie.Stash(fp.name, layout='packed')
+    dst.add('1', biggie.Entity(x=np.zeros(10), name='zero'))
+    assert dst.merge(src, on_conflict='overwrite') == 2
+    assert dst.get('1').x[0] == 101
+    with pytest.raises(ValueError):
+        dst.merge(src, link=True, on_conflict='skip')
+    dst.close()
+
+
+@pytest.fixture()
+def merge_data():
+    keys = [str(n) for n in range(500)]
+    return make_stash(keys), make_stash(keys, offset=1000)
+
+
+def _add_loop(src, dst):
+    for key in src.keys():
+        dst.add(key, src.get(key), overwrite=True)
+
+
+@pytest.mark.benchmark(min_rounds=5)
+def testbench_Stash_merge_add_loop(benchmark, merge_data):
+    src, dst = merge_data
+    benchmark(_add_loop, src, dst)
+
+
+@pytest.mark.benchmark(min_rounds=5)
+def testbench_Stash_merge(benchmark, merge_data):
+    src, dst = merge_data
+    benchmark(dst.merge, src, on_conflict='overwrite')
+
+
+@pytest.mark.unit
+def test_shard_index():
+    assert biggie.sources.shard_index('abc', 7) == \
+        biggie.sources.shard_index(u'abc', 7)
+    counts = np.bincount([biggie.sources.shard_index(str(n), 4)
+                          for n in range(1000)], minlength=4)
+    assert counts.min() > 200
+
+
+@pytest.mark.unit
+def test_ShardedStash():
+    path = os.path.join(tmp.mkdtemp(), 'sharded')
+    with pytest.raises(ValueError):
+        biggie.ShardedStash(path)
+    stash = biggie.ShardedStash(path, num_shards=3)
+    for n in range(20):
+        stash.add(str(n), biggie.Entity(x=np.arange(n)))
+    assert stash.add_many((str(n), biggie.Entity(x=np.arange(n)))
+                          for n in range(20, 40)) == 20
+    stash.remove('3')
+    with pytest.raises(KeyError):
+        stash.remove('3')
+    assert len(stash) == 39
+    stash.close()
+
+    with open(os.path.join(path, stash.MANIFEST)) as fp:
+        assert json.load(fp)['num_shards'] == 3
+    with pytest.raises(ValueError):
+        biggie.ShardedStash(path, num_shards=4)
+
+    stash = biggie.ShardedStash(path, mode='r')
+    assert sorted(stash.keys(), key=int) == \
+        [str(n) for n in range(40) if n != 3]
+    np.testing.assert_array_equal(stash.get('17').x, np.arange(17))
+    assert stash.get('3') is None
+    for idx in range(3):
+        shard = stash.shard(idx)
+        assert all(stash.shard_of(key) == idx for key in shard.keys())
+
+    clone = pickle.loads(pickle.dumps(stash))
+    np.testing.assert_array_equal(clone.get('21').x, np.arange(21))
+
+
+@pytest.mark.unit
+def test_ShardedStash_reshard():
+    path = tmp.mkdtemp()
+    stash = biggie.ShardedStash(os.path.join(path, 'a'), num_shards=2)
+    stash.add_many((str(n), biggie.Entity(x=np.arange(n), y=n))
+                   for n in range(30))
+    dest = stash.reshard(os.path.join(path, 'b'), 5)
+    assert dest.num_shards == 5
+    assert sorted(dest.keys()) == sorted(stash.keys())
+    for key in stash.keys():
+        np.testing.assert_array_equal(dest.get(key).x, stash.get(key).x)
+        assert dest.shard_of(key) in [
+            idx for idx in range(5) if key in dest.shard(idx).keys()]
+    with pytest.raises(ValueError):
+        stash.reshard(os.path.join(path, 'b'), 5)
+
+    # Views of some of the shards would silently drop the others.
+    view = biggie.ShardedStash(os.path.join(path, 'a'), shards=[0])
+    with pytest.raises(ValueError):
+        view.reshard(os.path.join(path, 'c'), 5)
+    assert not os.path.exists(os.path.join(path, 'c'))
+
+
+# Helper for spawned writers, each filling its own shard.
+def write_shard(path, idx, num_items):
+    stash = biggie.ShardedStash(path, shards=[idx])
+    count = 0
+    for n in range(num_items):
+        if stash.shard_of(str(n)) == idx:
+            stash.add(str(n), biggie.Entity(x=np.ones(4) * n))
+            count += 1
+    with pytest.raises(ValueError):
+        stash.get(str([n for n in range(num_items)
+                       if stash.shard_of(str(n)) != idx][0]))
+    stash.close()
+    return count
+
+
+@pytest.mark.unit
+def test_ShardedStash_parallel_write():
+    path = tmp.mkdtemp()
+    biggie.ShardedStash(path, num_shards=3)
+    pool = multiprocessing.get_context('spawn').Pool(3)
+    counts = pool.starmap(write_shard, [(path, idx, 60) for idx in range(3)])
+    pool.close()
+    pool.join()
+
+    stash = biggie.ShardedStash(path, mode='r')
+    assert sum(counts) == len(stash) == 60
+    for n in range(60):
+        np.testing.assert_array_equal(stash.get(str(n)).x, np.ones(4) * n)
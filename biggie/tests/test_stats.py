@@ -0,0 +1,156 @@
+import pytest
+
+import numpy as np
+import pickle
+import tempfile as tmp
+
+import biggie
+import biggie.stats as stats
+
+
+@pytest.mark.unit
+def test_Histogram():
+    hist = stats.Histogram()
+    assert hist.percentile(50) is None
+    for seconds in [1e-6] * 90 + [1e-3] * 9 + [1.0]:
+        hist.add(seconds)
+    summary = hist.summary()
+    assert summary['count'] == 100
+    assert summary['min'] == 1e-6 and summary['max'] == 1.0
+    assert summary['total'] == pytest.approx(1.0 + 9e-3 + 90e-6)
+    assert 1e-6 <= summary['p50'] <= 2e-6
+    assert 1e-3 <= summary['p99'] <= 2e-3
+    assert hist.percentile(100) == 1.0
+    hist.add(0.0)
+    assert hist.buckets[0] == 1
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('layout', ['tree', 'packed'])
+def test_Stash_stats(layout):
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    calls = []
+    recorder = stats.Recorder(hooks=[
+        lambda op, seconds, info: calls.append((op, info))])
+    stash = biggie.Stash(fp.name, stats=recorder, layout=layout)
+    assert stash.recorder is recorder
+    for idx in range(10):
+        stash.add(str(idx), biggie.Entity(x=np.ones(8), y=idx))
+    stash.add_many((str(idx), biggie.Entity(x=np.ones(8), y=idx))
+                   for idx in range(10, 20))
+    stash.remove('3')
+    assert stash.get('4').x.sum() == 8
+    stash.get_many(['5', '6'], fields=['x'])
+    stash.get('4')['x'][2:4]
+
+    result = stash.stats()
+    ops = result['ops']
+    # Packed stashes add in bulk one entity at a time.
+    assert ops['add']['count'] == (20 if layout == 'packed' else 10)
+    assert ops['add_many']['count'] == 1
+    assert ops['remove']['count'] == 1
+    assert ops['get']['count'] == 2
+    assert ops['get_many']['count'] == 1
+    assert ops['keymap_load']['count'] == 1
+    assert ops['keymap_dump']['count'] >= 1
+    assert ops['get']['mean'] > 0
+    assert result['bytes_written']['x'] == 20 * 64
+    assert result['bytes_read']['x'] == 64 + 2 * 64 + 16
+    assert 'y' not in result['bytes_read']
+    assert result['handle_opens'] == 1
+    assert result['cache']['hits'] == 0
+
+    reads = [info for op, info in calls if op == 'field_read']
+    assert reads[0] == dict(field='x', nbytes=64)
+    assert [op for op, info in calls].count('remove') == 1
+
+
+@pytest.mark.unit
+def test_Stash_stats_memoized():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name, stats=True, cache_size=False,
+                         field_policy='memoize')
+    stash.add('a', biggie.Entity(x=np.ones(1000)))
+    entity = stash.get('a')
+    for _ in range(10):
+        assert entity.x.sum() == 1000
+    assert entity['x'][:10].sum() == 10
+    result = stash.stats()
+    assert result['bytes_read']['x'] == 8000
+    assert result['ops']['field_read']['count'] == 1
+
+
+@pytest.mark.unit
+def test_Stash_stats_mapped():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name)
+    stash.add('a', biggie.Entity(x=np.ones(1000)))
+    stash.close()
+    mapped = biggie.Stash(fp.name, mode='r', mmap=True, stats=True,
+                          cache_size=False)
+    entity = mapped.get('a')
+    assert entity['x'].mapped
+    for _ in range(3):
+        assert entity.x.sum() == 1000
+    assert entity['x'][:10].sum() == 10
+    result = mapped.stats()
+    assert 'x' not in result['bytes_read']
+    assert 'field_read' not in result['ops']
+    assert result['ops']['mapped_read']['count'] == 4
+
+
+@pytest.mark.unit
+def test_Stash_stats_off():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name, cache_size=5)
+    stash.add('a', biggie.Entity(x=np.ones(8)))
+    stash.get('a')
+    stash.get('a')
+    assert stash.recorder is None
+    assert type(stash.get('a')['x']) is biggie.core.Field
+    result = stash.stats()
+    assert sorted(result.keys()) == ['cache', 'handle_opens']
+    assert result['cache']['hit_rate'] == pytest.approx(2 / 3.)
+
+
+@pytest.mark.unit
+def test_Stash_stats_pickle():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name, stats=stats.Recorder(hooks=[print]))
+    stash.add('a', biggie.Entity(x=np.ones(8)))
+    stash.close()
+    clone = pickle.loads(pickle.dumps(stash))
+    assert clone.recorder is not None
+    assert clone.recorder.hooks == []
+    clone.get('a').x
+    assert clone.stats()['ops']['get']['count'] == 1
+
+
+@pytest.mark.unit
+def test_Recorder_field_class():
+    recorder = stats.Recorder()
+    cls = recorder.field_class(biggie.core.LazyField)
+    assert issubclass(cls, biggie.core.LazyField)
+    assert recorder.field_class(biggie.core.LazyField) is cls
+    assert recorder.field_class(cls) is cls
+    assert stats.Recorder().field_class(biggie.core.LazyField) is not cls
+
+
+def _get_value(stash):
+    return stash.get('a').x
+
+
+@pytest.mark.benchmark(min_rounds=200)
+def testbench_Stash_get(benchmark):
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name)
+    stash.add('a', biggie.Entity(x=np.ones(8)))
+    benchmark(_get_value, stash)
+
+
+@pytest.mark.benchmark(min_rounds=200)
+def testbench_Stash_get_stats(benchmark):
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name, stats=True)
+    stash.add('a', biggie.Entity(x=np.ones(8)))
+    benchmark(_get_value, stash)
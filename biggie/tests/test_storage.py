@@ -0,0 +1,88 @@
+import pytest
+
+import numpy as np
+import tempfile as tmp
+
+import biggie
+import biggie.storage as storage
+
+
+@pytest.mark.unit
+def test_StoragePolicy_chunk_shape():
+    policy = storage.StoragePolicy(chunks=True, chunk_bytes=1024)
+    assert policy.chunk_shape((1000, 16), np.float32) == (16, 16)
+    assert policy.chunk_shape((10, 16), np.float32) == (10, 16)
+    assert policy.chunk_shape((100, 1000), np.float64) == (1, 125)
+    assert policy.chunk_shape((), np.float64) is None
+    assert policy.chunk_shape((0, 3), np.float64) is None
+
+    assert storage.StoragePolicy().chunk_shape((1000, 16), np.float32) is None
+    policy = storage.StoragePolicy(compression='gzip', chunk_bytes=1024)
+    assert policy.chunk_shape((1000, 16), np.float32) == (16, 16)
+    policy = storage.StoragePolicy(chunks=(4, 100))
+    assert policy.chunk_shape((1000, 16), np.float32) == (4, 16)
+
+
+@pytest.mark.unit
+def test_StoragePolicy_bad_compression():
+    with pytest.raises(ValueError):
+        storage.StoragePolicy(compression='zstd')
+
+
+@pytest.mark.unit
+def test_resolve():
+    gzip = storage.StoragePolicy(compression='gzip')
+    assert storage.resolve(None, 'x') is None
+    assert storage.resolve(gzip, 'x') is gzip
+    policies = {'x': gzip, None: dict(compression='lzf')}
+    assert storage.resolve(policies, 'x') is gzip
+    assert storage.resolve(policies, 'y').compression == 'lzf'
+    assert storage.resolve({'x': gzip}, 'y') is None
+    with pytest.raises(ValueError):
+        storage.resolve({'x': 'gzip'}, 'x')
+
+
+def check_dataset(stash, key, field, **expected):
+    dset = stash._fhandle[stash._keymap[key]][field]
+    for name, value in expected.items():
+        assert getattr(dset, name) == value, name
+    return dset
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('bulk', [False, True])
+def test_Stash_storage(bulk):
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    policies = {
+        'x': storage.StoragePolicy(compression='gzip', compression_opts=9,
+                                   shuffle=True, fletcher32=True),
+        None: storage.StoragePolicy(compression='lzf', chunk_bytes=1024)}
+    stash = biggie.Stash(fp.name, storage=policies)
+    value = np.arange(4000, dtype=np.float32).reshape(250, 16)
+    entity = biggie.Entity(x=value, y=value, z=1, s='abc')
+    if bulk:
+        stash.add_many([('a', entity)])
+    else:
+        stash.add('a', entity)
+    stash.add('b', entity, storage=None)
+    stash.add('c', entity, storage=storage.StoragePolicy())
+    stash.close()
+
+    stash = biggie.Stash(fp.name, mode='r')
+    dset = check_dataset(stash, 'a', 'x', compression='gzip',
+                         compression_opts=9, shuffle=True, fletcher32=True)
+    np.testing.assert_array_equal(dset[()], value)
+    check_dataset(stash, 'a', 'y', compression='lzf', chunks=(16, 16))
+    check_dataset(stash, 'a', 'z', chunks=None)
+    check_dataset(stash, 'b', 'y', compression='lzf')
+    check_dataset(stash, 'c', 'y', compression=None, chunks=None)
+    assert stash.get('a').s == 'abc'
+    np.testing.assert_array_equal(stash.get('a').y, value)
+
+
+@pytest.mark.unit
+def test_Stash_rdcc():
+    fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+    stash = biggie.Stash(fp.name, rdcc_nbytes=2 ** 24, rdcc_nslots=10007)
+    cache = stash._fhandle.id.get_access_plist().get_cache()
+    assert cache[1:3] == (10007, 2 ** 24)
@@ -0,0 +1,93 @@
+import pytest
+
+import numpy as np
+import tempfile as tmp
+import time
+
+import biggie
+import biggie.stream as stream
+import biggie.util as util
+
+
+@pytest.fixture(scope='module')
+def stream_data():
+    class Data(object):
+        fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+        values = dict()
+
+    stash = biggie.Stash(Data.fp.name)
+    data_gen = util.random_ndarray_generator((8, 4), max_items=50)
+    for idx, (key, value) in enumerate(data_gen):
+        key = str(key)
+        Data.values[key] = value
+        stash.add(key, biggie.Entity(data=value, label=idx))
+    stash.close()
+    return Data
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('backend', ['thread', 'process'])
+def test_Stash_iterate(stream_data, backend):
+    stash = biggie.Stash(stream_data.fp.name, mode='r')
+    keys = sorted(stash.keys())
+    with stash.iterate(keys, prefetch=4, workers=3, backend=backend) as its:
+        results = list(its)
+    assert [key for key, entity in results] == keys
+    for key, entity in results:
+        np.testing.assert_array_equal(entity.data, stream_data.values[key])
+        assert isinstance(entity['data'], biggie.core.Field)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('backend', ['thread', 'process'])
+def test_Stash_iterate_unordered(stream_data, backend):
+    stash = biggie.Stash(stream_data.fp.name, mode='r')
+    results = dict(stash.iterate(workers=2, fields=['data'], ordered=False,
+                                 backend=backend))
+    assert sorted(results.keys()) == sorted(stream_data.values.keys())
+    for key, entity in results.items():
+        assert list(entity.keys()) == ['data']
+        np.testing.assert_array_equal(entity.data, stream_data.values[key])
+
+
+@pytest.mark.unit
+def test_Stash_iterate_backpressure(stream_data):
+    stash = biggie.Stash(stream_data.fp.name, mode='r')
+    fetched = []
+
+    def keys():
+        for key in stash.keys():
+            fetched.append(key)
+            yield key
+
+    its = stash.iterate(keys(), prefetch=3, workers=2)
+    next(its)
+    time.sleep(0.2)
+    # One consumed, three in flight, and one waiting on a permit.
+    assert len(fetched) == 5
+    its.close()
+    assert not its._feeder.is_alive()
+    assert not any(worker.is_alive() for worker in its._workers)
+    with pytest.raises(StopIteration):
+        next(its)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('backend', ['thread', 'process'])
+def test_Stash_iterate_missing_key(stream_data, backend):
+    stash = biggie.Stash(stream_data.fp.name, mode='r')
+    keys = list(stash.keys())[:2] + ['not-a-key']
+    its = stash.iterate(keys, backend=backend)
+    next(its)
+    next(its)
+    with pytest.raises((KeyError, RuntimeError)):
+        next(its)
+
+
+@pytest.mark.unit
+def test_Prefetcher_bad_args(stream_data):
+    stash = biggie.Stash(stream_data.fp.name, mode='r')
+    with pytest.raises(ValueError):
+        stream.Prefetcher(stash, backend='gpu')
+    with pytest.raises(ValueError):
+        stream.Prefetcher(stash, prefetch=0)
@@ -0,0 +1,117 @@
+import pytest
+
+import itertools
+import numpy as np
+import tempfile as tmp
+
+import biggie
+import biggie.util as util
+
+
+@pytest.mark.unit
+def test_expand_hex():
+    assert util.expand_hex(hex(843), 4) == '0x034b'
+    with pytest.raises(ValueError):
+        util.expand_hex(hex(843), 2)
+
+
+@pytest.mark.unit
+def test_index_to_hexkey():
+    assert util.index_to_hexkey(843, 2) == '03/4b'
+
+
+@pytest.mark.unit
+def test_uniform_hexkey():
+    assert util.uniform_hexkey(0, 3) == '00/00/00'
+    assert util.uniform_hexkey(1, 3) == '01/00/00'
+    assert util.uniform_hexkey(843, 3) == '4b/03/00'
+    assert util.uniform_hexkey(17, 2, width=16) == '1/1'
+    with pytest.raises(ValueError):
+        util.uniform_hexkey(256 ** 3, 3)
+
+
+@pytest.mark.unit
+def test_hexkey_to_index():
+    for index in [0, 1, 255, 256, 843, 256 ** 3 - 1]:
+        assert util.hexkey_to_index(util.uniform_hexkey(index, 3)) == index
+
+
+@pytest.mark.unit
+def test_uniform_hexgen():
+    keys = list(itertools.islice(util.uniform_hexgen(3, 256), 600))
+    assert keys[:3] == ['00/00/00', '01/00/00', '02/00/00']
+    assert keys[256] == '00/01/00'
+    assert keys == [util.uniform_hexkey(n, 3) for n in range(600)]
+
+
+@pytest.fixture(scope='module')
+def collate_data():
+    class Data(object):
+        fp = tmp.NamedTemporaryFile(suffix=".hdf5")
+        values = []
+
+    stash = biggie.Stash(Data.fp.name)
+    data_gen = util.random_ndarray_generator((128, 64), max_items=20)
+    for idx, (key, value) in enumerate(data_gen):
+        Data.values.append(value)
+        stash.add(str(idx), biggie.Entity(data=value, label=idx,
+                                          ragged=np.arange(idx % 3 + 1)))
+    stash.close()
+    return Data
+
+
+@pytest.mark.unit
+def test_collate_entities():
+    entities = [biggie.Entity(x=np.ones(3) * n, y=n, z='abc'[n])
+                for n in range(3)]
+    arrays = util.collate_entities(entities + [None])
+    expected = util.unpack_entity_list(entities)
+    assert sorted(arrays.keys()) == ['x', 'y', 'z']
+    for key in expected:
+        np.testing.assert_array_equal(arrays[key], expected[key])
+        assert arrays[key].dtype == expected[key].dtype
+    assert util.collate_entities([None, None]) == dict()
+
+
+@pytest.mark.unit
+def test_collate_entities_lazy(collate_data):
+    stash = biggie.Stash(collate_data.fp.name, mode='r')
+    entities = [stash.get(str(idx)) for idx in range(20)]
+    arrays = util.collate_entities(entities, fields=['data', 'label'])
+    np.testing.assert_array_equal(arrays['data'], collate_data.values)
+    np.testing.assert_array_equal(arrays['label'], np.arange(20))
+
+
+@pytest.mark.unit
+def test_collate_entities_ragged(collate_data):
+    stash = biggie.Stash(collate_data.fp.name, mode='r')
+    entities = [stash.get(str(idx)) for idx in range(4)]
+    with pytest.raises(ValueError):
+        util.collate_entities(entities)
+    with pytest.raises(ValueError):
+        util.collate_entities(entities, pad_value=0, ragged=True)
+
+    arrays = util.collate_entities(entities, fields=['ragged'], pad_value=-1)
+    np.testing.assert_array_equal(
+        arrays['ragged'], [[0, -1, -1], [0, 1, -1], [0, 1, 2], [0, -1, -1]])
+
+    arrays = util.collate_entities(entities, fields=['ragged'], ragged=True)
+    assert arrays['ragged'].dtype == object
+    for idx, value in enumerate(arrays['ragged']):
+        np.testing.assert_array_equal(value, np.arange(idx % 3 + 1))
+
+
+@pytest.mark.benchmark(min_rounds=50)
+def testbench_unpack_entity_list(benchmark, collate_data):
+    stash = biggie.Stash(collate_data.fp.name, mode='r')
+    entities = [stash.get(str(idx)) for idx in range(20)]
+    for entity in entities:
+        del entity['ragged']
+    benchmark(util.unpack_entity_list, entities)
+
+
+@pytest.mark.benchmark(min_rounds=50)
+def testbench_collate_entities(benchmark, collate_data):
+    stash = biggie.Stash(collate_data.fp.name, mode='r')
+    entities = [stash.get(str(idx)) for idx in range(20)]
+    benchmark(util.collate_entities, entities, fields=['data', 'label'])
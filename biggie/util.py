@@ -56,6 +56,60 @@ def index_to_hexkey(index, depth):
     return tmp[3:-1]
 
 
+def uniform_hexkey(index, depth, width=256):
+    """Compute the hexkey at a given position of `uniform_hexgen` directly.
+
+    The digits of the index (in base `width`) are reversed, such that
+    consecutive indices are spread uniformly over the first level of the tree.
+
+    Example: uniform_hexkey(843, 3) -> '4b/03/00'
+
+    Parameters
+    ----------
+    index : int
+        Position in the sequence of keys.
+    depth : int
+        Number of nodes in a single branch.
+    width : int
+        Child nodes per parent.
+
+    Returns
+    -------
+    key : str
+        Hexadecimal key path.
+    """
+    index = int(index)
+    if not 0 <= index < width ** depth:
+        raise ValueError("Unique keys exhausted.")
+    fmt = '{{:0{}x}}'.format(len('{:x}'.format(width - 1)))
+    digits = []
+    for _ in range(depth):
+        index, digit = divmod(index, width)
+        digits.append(fmt.format(digit))
+    return '/'.join(digits)
+
+
+def hexkey_to_index(hexkey, width=256):
+    """Invert `uniform_hexkey`, returning the position of a hexkey.
+
+    Parameters
+    ----------
+    hexkey : str
+        Hexadecimal key path.
+    width : int
+        Child nodes per parent.
+
+    Returns
+    -------
+    index : int
+        Position of the key in the sequence of `uniform_hexgen`.
+    """
+    index = 0
+    for digit in reversed(hexkey.split('/')):
+        index = index * width + int(digit, 16)
+    return index
+
+
 def uniform_hexgen(depth, width=256):
     """Generator to produce uniformly distributed hexkeys at a given depth.
 
@@ -76,20 +130,16 @@ def uniform_hexgen(depth, width=256):
     key : str
         Hexadecimal key path.
     """
-    max_index = width ** depth
-    index = 0
-    for index in range(max_index):
-        v = expand_hex(hex(index), depth * 2)
-        hexval = "0x" + "".join([a + b for a, b in zip(v[-2:1:-2], v[:1:-2])])
-        yield index_to_hexkey(int(hexval, 16), depth)
+    for index in range(width ** depth):
+        yield uniform_hexkey(index, depth, width)
     raise ValueError("Unique keys exhausted.")
 
 
 def unpack_entity_list(entities, filter_nulls=True):
     """Turn a list of entities into key-np.ndarray objects.
 
-    TODO(ejhumphrey): Is this a bottleneck in the data
-    bundling / presentation process?
+    Note: This copies every value twice, and goes through Python lists;
+    `collate_entities` is considerably faster.
 
     Parameters
     ----------
@@ -115,6 +165,89 @@ def unpack_entity_list(entities, filter_nulls=True):
     return data
 
 
+def collate_entities(entities, fields=None, filter_nulls=True,
+                     pad_value=None, ragged=False):
+    """Stack the fields of a list of entities into arrays.
+
+    Like `unpack_entity_list`, but each field is written directly into a
+    single preallocated array; the fields of entities loaded from a Stash
+    are read from disk straight into their slot of the output.
+
+    The schema (field names and data types) is taken from the first entity.
+    Fields whose shapes vary across entities are either padded to the
+    largest shape, or returned as ragged object arrays of arrays.
+
+    Parameters
+    ----------
+    entities : list of Entities
+        Entities to collate; all must have the fields of the first.
+
+    fields : iterable of str, default=None
+        Fields to collate; if None, all fields of the first entity.
+
+    filter_nulls : bool, default=True
+        Skip entities that are None.
+
+    pad_value : scalar, default=None
+        If given, fields of varying shapes are padded with this value to the
+        largest shape (per dimension); otherwise these raise a ValueError,
+        unless `ragged` is True.
+
+    ragged : bool, default=False
+        If True, fields of varying shapes are returned as object arrays of
+        arrays.
+
+    Returns
+    -------
+    arrays : dict of np.ndarrays
+        Values keyed by field, with the entities along the first axis.
+    """
+    if pad_value is not None and ragged:
+        raise ValueError("Only one of `pad_value` and `ragged` may be given.")
+    entities = [e for e in entities if e is not None or not filter_nulls]
+    if not entities:
+        return dict()
+    fields = list(entities[0].keys()) if fields is None else list(fields)
+
+    arrays = dict()
+    for field in fields:
+        values = [entity[field] for entity in entities]
+        dtype = values[0].dtype
+        shapes = [value.shape for value in values]
+        if dtype.kind in 'OSU':
+            # Strings have no fixed width to preallocate.
+            arrays[field] = np.asarray([value.value for value in values])
+        elif shapes.count(shapes[0]) == len(shapes):
+            arr = np.empty((len(values),) + shapes[0], dtype=dtype)
+            for idx, value in enumerate(values):
+                value.read_direct(arr, dest_sel=idx)
+            arrays[field] = arr
+        elif ragged:
+            arr = np.empty(len(values), dtype=object)
+            for idx, value in enumerate(values):
+                arr[idx] = np.asarray(value.value)
+            arrays[field] = arr
+        elif pad_value is not None:
+            if len(set(len(shape) for shape in shapes)) > 1:
+                raise ValueError("Cannot pad '{}'; number of dimensions vary."
+                                 "".format(field))
+            max_shape = tuple(np.max(shapes, axis=0))
+            arr = np.empty((len(values),) + max_shape,
+                           dtype=np.result_type(dtype, np.min_scalar_type(
+                               pad_value)))
+            arr.fill(pad_value)
+            for idx, (value, shape) in enumerate(zip(values, shapes)):
+                dest = (idx,) + tuple(slice(0, n) for n in shape)
+                value.read_direct(arr, dest_sel=dest)
+            arrays[field] = arr
+        else:
+            raise ValueError(
+                "Shapes of '{}' vary, e.g. {} and {}; use `pad_value` or "
+                "`ragged`.".format(field, shapes[0],
+                                   [s for s in shapes if s != shapes[0]][0]))
+    return arrays
+
+
 def random_ndarray_generator(shape, loc=0, scale=1.0, max_items=None,
                              dtype=np.float64, seed=12345):
     """Produce a number of key-value, normally distributed ndarrays.